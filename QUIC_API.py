@@ -1,14 +1,23 @@
 from socket import *
+import errno
+import select
 import ssl
 import os
 import uuid
 import hashlib
-import Utils
+import QUIC_Codec
+from QUIC_Congestion import NewRenoCongestionController, Pacer
+from QUIC_Timer import TimerWheel
+from QUIC_History import SentPacketHistory, AckRangeSet
+from QUIC_Stream import StreamReassemblyBuffer, StreamFrameQueue
+from QUIC_MTU import PathMTUDiscovery, PacketSizeController, set_dont_fragment
+from QUIC_Sender import DatagramSender
+from QUIC_Receiver import DatagramReceiver
 from QUIC_Packet import *
 import pickle
 import time
-from Utils import *
 import threading
+import collections
 
 """
 This project represents the QUIC protocol.
@@ -26,26 +35,49 @@ Each ID is unique and is not used by any other client or server.
 
 
 class QUIC_Protocol:
-    FRAME_SIZE = 65447  # Maximum frame size after subtracting protocol overhead
     PACKET_THRESHOLD = 3
+    MAX_PROBE_PACKETS = 2  # Maximum number of packets sent when the PTO expires
+    MAX_ACK_RANGES = 32  # Maximum number of ranges reported in an ack frame
     # Time Threshold >= 1 packet AND time > 9/8 * max(SRTT, latest_RTT)
     kRTTAlpha = 0.125
     kRTTBeta = 0.25
     kGranularity = 0.001  # 1 millisecond in seconds
     kTimeThreshold = 9 / 8  # RTT multiplier
     MAX_ACK_DELAY = 0.025
+    ACK_ELICITING_THRESHOLD = 2  # Ack at least every second ack-eliciting packet (RFC 9000, section 13.2.2)
     MAX_UDP_SIZE = 65507
-
-    def __init__(self, socket_fd, server_address, client_address=None):
+    MIN_DATAGRAM_SIZE = 1200  # The smallest datagram size every QUIC path supports (RFC 9000, section 14)
+    LEGACY_FRAME_OVERHEAD = 256  # The pickled frame is larger than its wire encoding (legacy mode)
+    SEND_WINDOW = 16 * MAX_UDP_SIZE  # Maximum number of bytes in flight before QUIC_send_data blocks
+    MAX_RECEIVE_BATCH = 64  # Maximum number of datagrams processed before the ack is decided
+    REASSEMBLY_BUFFER_SIZE = 4 * 1024 * 1024  # Maximum number of stream bytes the receiver buffers out of order
+
+    def __init__(self, socket_fd, server_address, client_address=None, legacy_pickle=False,
+                 congestion_controller=None, max_datagram_size=None, use_gso=True, use_gro=True, use_zerocopy=False,
+                 use_ecn=True):
         self.socket_fd = socket_fd
+        # Sends the datagrams, a run of data packets with a single UDP GSO send where the kernel supports it.
+        # The pickled packets can't be padded to the segment size, so the legacy mode sends them one by one.
+        # In the zerocopy mode the large sends are not copied, and their buffers (the slices of the send source)
+        # are kept until the kernel is done with them, QUIC_flush waits for it.
+        # With ECN, the datagrams are marked ECT(0) so the routers can mark congestion instead of dropping them.
+        self.datagram_sender = DatagramSender(socket_fd, use_gso and not legacy_pickle, use_zerocopy,
+                                              use_ecn=use_ecn)
+        # Use pickle instead of the binary wire codec (both peers must use the same format)
+        self.legacy_pickle = legacy_pickle
         self.server_address = server_address
         self.client_address = client_address
         self.packet_number_generator = QUICHeader.packet_number_generator()
         self.largest_acknowledged = 0
         self.acked_packets = {}
-        # Create a map set of packet numbers as keys and the frames as values
-        self.in_flight_packets = {}
-        self.ack_ranges = []
+        # The packets in flight ordered by packet number, each one with its (frames, send time, packet size)
+        self.in_flight_packets = SentPacketHistory()
+        # Limits the bytes in flight, NewReno (RFC 9002) by default, created below with the datagram size
+        self.congestion_controller = congestion_controller
+        # The packet numbers received from the peer, sent back in the ack frames
+        self.ack_ranges = AckRangeSet(self.MAX_ACK_RANGES)
+        # Our packets that carried an ack frame, each one with the largest packet number its ack frame reported
+        self.sent_ack_frames = SentPacketHistory()
         # Stores the send times of each packet
         self.packet_send_times = {}
         # The estimated network RTT
@@ -54,9 +86,93 @@ class QUIC_Protocol:
         self.latest_rtt = 0.1
         self.rttvar = 0.05  # Example initial value
         self.rttmin = float('inf')
-        # Timer for the Probe Timeout (PTO) period
-        self.lock = threading.Lock()
-        self.pto_timer = None
+        self.lock = threading.RLock()
+        # All the timers of the connection run on a single timer wheel thread
+        self.timer_wheel = TimerWheel()
+        # A single loss detection timer (RFC 9002, section 6.2), armed for the earliest loss time or the PTO
+        self.loss_detection_timer = None
+        # The timer that sends the rest of the retransmissions when the pacer allows it, the timer thread
+        # doesn't sleep for the pacer while it holds the lock
+        self.retransmission_timer = None
+        # The earliest time a packet in flight will be declared lost by the time threshold
+        self.loss_time = None
+        # The number of times the PTO expired without an ack, the PTO period is doubled each time
+        self.pto_count = 0
+        self.time_of_last_ack_eliciting_packet = 0
+        # The largest of our packet numbers that the peer has acknowledged
+        self.largest_acked_packet = -1
+        # A close packet that arrived from the peer while we were waiting for acks
+        self.pending_close_packet = None
+        # The time the largest packet number was received, the ack delay is measured from it
+        self.largest_received_time = None
+        # Delayed acks: the receiver acks every ack_eliciting_threshold ack-eliciting packets,
+        # or when max_ack_delay passed since the first unacknowledged one. The sender can change both.
+        self.ack_eliciting_threshold = self.ACK_ELICITING_THRESHOLD
+        self.max_ack_delay = self.MAX_ACK_DELAY
+        self.ack_eliciting_packets_received = 0
+        self.ack_delay_timer = None
+        self.ack_receiver_address = None
+        # The sequence number of the last ack frequency frame applied, older (retransmitted) frames are ignored
+        self.ack_frequency_sequence_received = -1
+        # The sender side of the ack frequency: the next sequence number, the frame waiting for the next
+        # data packet and the max ack delay the peer was asked to use (part of the PTO period)
+        self.ack_frequency_sequence_number = 0
+        self.pending_ack_frequency_frame = None
+        self.peer_max_ack_delay = self.MAX_ACK_DELAY
+        # The stream offset of the next byte sent, and the receiver buffer that puts the stream back in order
+        self.send_offset = 0
+        self.receive_stream = StreamReassemblyBuffer(self.REASSEMBLY_BUFFER_SIZE)
+        # When set, the stream data is written to its offset in the sink instead of the reassembly buffer
+        self.stream_sink = None
+        # The stream data of the lost packets and the new data, waiting to be packed into packets
+        self.retransmission_queue = StreamFrameQueue()
+        self.send_queue = StreamFrameQueue()
+        # The lost packets that are resent as they are (the probes and the text messages), waiting for the pacer
+        self.pending_resends = collections.deque()
+        # The largest size of the data packets.
+        # Without an explicit size, the path MTU is discovered from the minimum size of 1200 bytes.
+        # An explicit size turns the discovery and the loss-adaptive sizing off
+        # (e.g. the largest UDP datagram for loopback benchmarks).
+        self.path_mtu = None
+        self.packet_sizer = None
+        if max_datagram_size is not None:
+            if not self.MIN_DATAGRAM_SIZE <= max_datagram_size <= self.MAX_UDP_SIZE:
+                raise ValueError(f"Error: The datagram size must be between {self.MIN_DATAGRAM_SIZE} and "
+                                 f"{self.MAX_UDP_SIZE} bytes, not {max_datagram_size}.")
+            self.max_datagram_size = max_datagram_size
+        elif legacy_pickle:
+            # The pickled probes can't be padded to an exact size
+            self.max_datagram_size = self.MAX_UDP_SIZE
+        else:
+            self.path_mtu = PathMTUDiscovery(self.MAX_UDP_SIZE)
+            self.max_datagram_size = self.path_mtu.plpmtu
+            # The datagrams larger than the path MTU must be dropped, not fragmented
+            set_dont_fragment(socket_fd)
+        if max_datagram_size is None:
+            self.packet_sizer = PacketSizeController()
+        # The initial and the minimum congestion window and the pacing burst are counted in datagrams
+        # of the starting size, and follow the path MTU as it grows
+        if self.congestion_controller is None:
+            self.congestion_controller = NewRenoCongestionController(self.max_datagram_size)
+        # Spreads the sent packets over the RTT
+        self.pacer = Pacer(self.max_datagram_size)
+        # The outstanding path MTU probe: its packet number, size and send time
+        self.mtu_probe = None
+        # The size of the data packets, the packetizer fills every packet up to it
+        self.datagram_size = self.max_datagram_size
+        self.update_datagram_size()
+        # The connection stats: the data packets sent by datagram size, and the lost packets
+        self.packets_by_size = {}
+        self.lost_packet_count = 0
+        # The memory-mapped file that the stream frames in flight without data are read from again
+        self.send_source = None
+        self.send_source_offset = 0
+        # Reads the datagrams into a preallocated buffer, a batch at a time with UDP GRO where available
+        # With ECN, it also counts the received datagrams by their ECN codepoint for the ack frames
+        self.datagram_receiver = DatagramReceiver(socket_fd, use_gro, use_ecn)
+        # The largest CE count the peer reported in its ack frames, an increase is a congestion event
+        self.peer_ce_count = 0
+        self.ecn_congestion_events = 0
 
     """
     This function establishes the connection with the server.
@@ -91,32 +207,31 @@ class QUIC_Protocol:
         # Create the packet for the initial packet
         initial_packet = QUICPacket(long_header, total_frames)
 
-        # Serialize the initial packet with pickle
-        initial_packet = pickle.dumps(initial_packet)
+        # Serialize the initial packet with the wire codec, to the buffers of a scatter-gather send
+        initial_packet = self.encode_packet_parts(initial_packet)
         # Send the initial packet to the server
-        if self.socket_fd.sendto(initial_packet, server_address) < 0:
+        if self.send_datagram(initial_packet, server_address) < 0:
             raise Exception("Error: The initial packet is not sent.")
         send_time = time.time()
-        # self.packet_send_times[long_header.get_packet_number()] = send_time
-        self.in_flight_packets[long_header.get_packet_number()] = (total_frames, send_time)
+        self.register_sent_packet(long_header.get_packet_number(), total_frames, send_time,
+                                  sum(len(part) for part in initial_packet))
         with self.lock:
-            self.start_pto_timer(long_header.get_packet_number())
+            self.set_loss_detection_timer()
         print("Connection request sent to the server, waiting for the response.")
         initial_response = None
         while True:
             try:
                 # Receive the initial response from the server
-                initial_response, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                initial_response, _ = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
-                self.QUIC_detect_and_handle_loss_time(server_address)
                 continue
 
         # If the server address is not set, set it to the server address
         if self.server_address is None:
             self.server_address = server_address
-        # Deserialize the initial response with pickle
-        initial_response = pickle.loads(initial_response)
+        # Deserialize the initial response with the wire codec
+        initial_response = self.decode_packet(initial_response)
         # Check if the frames contain the ack frame
         print(f"Initial response received from the server: {initial_response.get_packet_number()}")
         self.largest_ack_update(initial_response)
@@ -129,37 +244,37 @@ class QUIC_Protocol:
         while True:
             try:
                 # Receive the handshake complete packet from the server
-                handshake_complete_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                handshake_complete_packet, _ = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
 
                 continue
 
-        # Deserialize the handshake complete packet with pickle
-        handshake_complete_packet = pickle.loads(handshake_complete_packet)
+        # Deserialize the handshake complete packet with the wire codec
+        handshake_complete_packet = self.decode_packet(handshake_complete_packet)
 
         self.largest_ack_update(handshake_complete_packet)
         self.update_ack_ranges(handshake_complete_packet.get_packet_number())
 
         print(f"Handshake complete packet received from the server: {handshake_complete_packet.get_packet_number()}")
         # Send ack frame for the response packet
-        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges)
+        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges.to_ack_ranges())
         long_header = QUICLongHeader("Long", "Initial", next(self.packet_number_generator))
         total_frames = [ack_frame]
         ack_packet = QUICPacket(long_header, total_frames)
         # print(f"Ack packet number: {ack_packet.get_packet_number()}")
-        ack_packet = pickle.dumps(ack_packet)
-        if self.socket_fd.sendto(ack_packet, server_address) == -1:
+        ack_packet = self.encode_packet_parts(ack_packet)
+        if self.send_datagram(ack_packet, server_address) == -1:
             raise Exception("Error: The ack frame is not sent.")
         print("Ack frame sent for the response packet.")
 
         # Send ack frame for the handshake complete packet
-        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges)
+        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges.to_ack_ranges())
         long_header = QUICLongHeader("Long", "Handshake", next(self.packet_number_generator))
         total_frames = [ack_frame]
         ack_packet = QUICPacket(long_header, total_frames)
-        ack_packet = pickle.dumps(ack_packet)
-        if self.socket_fd.sendto(ack_packet, server_address) == -1:
+        ack_packet = self.encode_packet_parts(ack_packet)
+        if self.send_datagram(ack_packet, server_address) == -1:
             raise Exception("Error: The ack frame is not sent.")
         # If the handshake complete packet is received, the connection is established
         print(f"Connection established with the server: {server_address}")
@@ -187,7 +302,7 @@ class QUIC_Protocol:
         while True:
             try:
                 # Receive the initial packet from the client
-                initial_packet, client_address = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                initial_packet, client_address = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
 
@@ -195,8 +310,8 @@ class QUIC_Protocol:
         # If the client address is not set, set it to the client address
         if self.client_address is None:
             self.client_address = client_address
-        # Deserialize the initial packet with pickle
-        initial_packet = pickle.loads(initial_packet)
+        # Deserialize the initial packet with the wire codec
+        initial_packet = self.decode_packet(initial_packet)
 
         self.largest_ack_update(initial_packet)
         self.update_ack_ranges(initial_packet.get_packet_number())
@@ -207,22 +322,22 @@ class QUIC_Protocol:
         message = "Server Hello"
         # Create the frames for the response packet. Stream frame and ack frame
         stream_frame = QUICStreamFrame("Stream", message, len(message))
-        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges)
+        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges.to_ack_ranges())
         total_frames = [stream_frame, ack_frame]
         response_packet = QUICPacket(long_header, total_frames)
         response_packet_number = long_header.packet_number
         print(f"Response packet number: {response_packet.get_packet_number()}")
-        # Serialize the response packet with pickle
-        response_packet = pickle.dumps(response_packet)
+        # Serialize the response packet with the wire codec
+        response_packet = self.encode_packet_parts(response_packet)
         # Send the response packet to the client
-        if self.socket_fd.sendto(response_packet, client_address) == -1:
+        if self.send_datagram(response_packet, client_address) == -1:
             raise Exception("Error: The response packet is not sent.")
         print("Response packet sent to the client.")
         send_time = time.time()
-        # self.packet_send_times[long_header.get_packet_number()] = send_time
-        self.in_flight_packets[long_header.get_packet_number()] = (total_frames, send_time)
+        self.register_sent_packet(long_header.get_packet_number(), total_frames, send_time,
+                                  sum(len(part) for part in response_packet))
         with self.lock:
-            self.start_pto_timer(long_header.get_packet_number())
+            self.set_loss_detection_timer()
         # Create the long header for the handshake complete packet
         long_header = QUICLongHeader("Long", "Handshake", next(self.packet_number_generator))
         # Create the message for the handshake complete packet
@@ -233,28 +348,27 @@ class QUIC_Protocol:
         # Create the packet for the handshake complete packet
         handshake_complete_packet = QUICPacket(long_header, total_frames)
         handshake_complete_packet_number = long_header.packet_number
-        # Serialize the handshake complete packet with pickle
-        handshake_complete_packet = pickle.dumps(handshake_complete_packet)
+        # Serialize the handshake complete packet with the wire codec
+        handshake_complete_packet = self.encode_packet_parts(handshake_complete_packet)
         # Send the handshake complete packet to the client
-        if self.socket_fd.sendto(handshake_complete_packet, client_address) == -1:
+        if self.send_datagram(handshake_complete_packet, client_address) == -1:
             raise Exception("Error: The handshake complete packet is not sent.")
         print("Handshake complete packet sent to the client.")
         send_complete_time = time.time()
-        # self.packet_send_times[long_header.get_packet_number()] = send_complete_time
-        self.in_flight_packets[long_header.get_packet_number()] = (total_frames, send_complete_time)
+        self.register_sent_packet(long_header.get_packet_number(), total_frames, send_complete_time,
+                                  sum(len(part) for part in handshake_complete_packet))
         with self.lock:
-            self.start_pto_timer(long_header.get_packet_number())
+            self.set_loss_detection_timer()
         # Receive the ack frame for the response packet
         ack_packet = None
         while True:
             try:
-                ack_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                ack_packet, _ = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
-                self.QUIC_detect_and_handle_loss_time(client_address)
                 continue
-        # Deserialize the ack packet with pickle
-        ack_packet = pickle.loads(ack_packet)
+        # Deserialize the ack packet with the wire codec
+        ack_packet = self.decode_packet(ack_packet)
         self.largest_ack_update(ack_packet)
         self.update_ack_ranges(ack_packet.get_packet_number())
         self.QUIC_detect_loss(client_address, ack_packet, response_packet_number, send_time)
@@ -265,14 +379,13 @@ class QUIC_Protocol:
         ack_packet = None
         while True:
             try:
-                ack_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                ack_packet, _ = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
-                self.QUIC_detect_and_handle_loss_time(client_address)
                 continue
 
-        # Deserialize the ack packet with pickle
-        ack_packet = pickle.loads(ack_packet)
+        # Deserialize the ack packet with the wire codec
+        ack_packet = self.decode_packet(ack_packet)
         self.largest_ack_update(ack_packet)
         self.update_ack_ranges(ack_packet.get_packet_number())
         self.QUIC_detect_loss(client_address, ack_packet, handshake_complete_packet_number, send_complete_time)
@@ -285,191 +398,704 @@ class QUIC_Protocol:
 
     """
     This function sends data from one peer to another.
-    It takes the data and copy it to the frames.
-    It sends the data and makes sure that the data is received by the receiver.
+    The data is added to the send queue, and the packetizer sends it in full datagrams: the size of the writes
+    doesn't have to match the size of the datagrams. The data that doesn't fill a datagram waits for the next
+    call, or for QUIC_flush, which must be called after the last QUIC_send_data call.
+    The data is pipelined: the packet is sent and added to the in-flight packets without waiting for its ack.
+    The acks that already arrived are processed without blocking, and the function blocks only while
+    the number of packets in flight reaches the send window or the congestion window is full.
     Handles the packet loss and recovery mechanism.
     
     Parameters:
-    data(String): The data to be sent.
+    data(bytes): The data to be sent.
     receiver_address(Tuple): The address of the receiver.
-    size(double): The size of the data to be sent.
     
     Returns:
-    int: The number of bytes sent if the data is sent successfully, 0 if the receiver disconnects, -1 otherwise. 
+    int: The number of bytes queued for sending.
     """
 
     def QUIC_send_data(self, data, receiver_address):
-        bytes_sent = 0
-        # with self.lock:
+        # The queued data is sent later, so it must not change
+        data = bytes(data)
+        with self.lock:
+            if data:
+                self.send_queue.add(QUICStreamFrame("Stream", data, len(data), self.send_offset))
+            self.send_offset += len(data)
+        while len(self.send_queue) + len(self.retransmission_queue) >= self.datagram_size and \
+                self.pending_close_packet is None:
+            self.send_packet(receiver_address)
+        return len(data)
+
+    """
+    This function sends the whole content of a send source (a memory-mapped file).
+    The data of each packet is a memoryview slice of the mapping, so the file is never copied into frames.
+    Only the offset and the length of the data are kept in flight, and a lost packet reads its data
+    from the mapping again, so the memory of the sender doesn't depend on the window or the file size.
+    The source must stay open until QUIC_flush returns.
+    
+    Parameters:
+    source(FileStreamSource): The send source.
+    receiver_address(Tuple): The address of the receiver.
+    
+    Returns:
+    int: The number of bytes sent.
+    """
+
+    def QUIC_send_source(self, source, receiver_address):
+        with self.lock:
+            self.send_source = source
+            # The stream offset of the first byte of the source
+            self.send_source_offset = self.send_offset
+            # The whole source is queued as a single range, the packetizer reads it from the mapping
+            if source.size:
+                self.send_queue.add(QUICStreamFrame("Stream", None, source.size, self.send_offset))
+            self.send_offset += source.size
+        while self.send_queue and self.pending_close_packet is None:
+            self.send_packet(receiver_address)
+        return source.size
+
+    """
+    This function sends full data packets from the retransmission queue and the send queue.
+    It sends as many packets as the pacer releases at once, up to a run of one UDP GSO send.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    """
+
+    def send_packet(self, receiver_address):
+        # Block only while the send window or the congestion window is full.
+        # The packet is built after the wait, so its packet number is the newest one and its ack frame is up to date.
+        while not self.can_send(self.datagram_size) and self.pending_close_packet is None:
+            self.QUIC_process_acks(receiver_address, block=True)
+        # A path MTU probe goes first, so the next packets grow as soon as it is acknowledged
+        self.send_mtu_probe(receiver_address)
+        # Wait for the pacing time of the packet
+        self.pace(self.datagram_size, receiver_address)
+        self.transmit_packet(receiver_address, max_packets=self.pacer.burst_packets(self.datagram_size))
+
+        # Process the acks that are already waiting in the socket
+        self.QUIC_process_acks(receiver_address)
+
+    """
+    This function sends a path MTU probe if the discovery is not complete and no probe is outstanding.
+    The probe is a PING frame padded to the probed size. It is not added to the packets in flight,
+    so its loss is neither retransmitted nor a congestion signal (RFC 9000, section 14.4).
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    """
+
+    def send_mtu_probe(self, receiver_address):
+        with self.lock:
+            if self.path_mtu is None:
+                return
+            if self.mtu_probe is not None:
+                _, probe_size, send_time = self.mtu_probe
+                # A probe that wasn't acknowledged within a PTO period is lost
+                if time.time() - send_time <= self.calculate_pto_period():
+                    return
+                self.mtu_probe = None
+                self.path_mtu.on_probe_lost(probe_size)
+            probe_size = self.path_mtu.next_probe_size()
+            if probe_size is None:
+                return
+            header = QUICHeader("Short", next(self.packet_number_generator))
+            frames = [QUICPingFrame("Ping")]
+            padding = probe_size - QUIC_Codec.packet_size(QUICPacket(header, frames))
+            probe_packet = QUICPacket(header, frames + [QUICPaddingFrame("Padding", padding)])
+            try:
+                self.send_datagram(self.encode_packet_parts(probe_packet), receiver_address)
+            except OSError as error:
+                if error.errno != errno.EMSGSIZE:
+                    raise
+                # Larger than the MTU of the local interface, the kernel refused it right away
+                self.path_mtu.on_probe_too_big(probe_size)
+                return
+            self.mtu_probe = (header.packet_number, probe_size, time.time())
+            self.pacer.on_packet_sent(probe_size)
+
+    def on_mtu_probe_ack(self, ack_frame):
+        # Called under the lock for every ack frame received
+        if self.mtu_probe is None:
+            return
+        packet_number, probe_size, _ = self.mtu_probe
+        if self.is_acknowledged(packet_number, ack_frame):
+            self.mtu_probe = None
+            self.path_mtu.on_probe_acked(probe_size)
+            # The packetizer fills the packets up to the new size
+            self.max_datagram_size = self.path_mtu.plpmtu
+            self.congestion_controller.set_max_datagram_size(self.max_datagram_size)
+            self.pacer.set_max_datagram_size(self.max_datagram_size)
+            self.update_datagram_size()
+            print(f"Path MTU probe of {probe_size} bytes acknowledged.")
+        elif ack_frame.largest_acknowledged >= packet_number + self.PACKET_THRESHOLD:
+            # Packet threshold loss of the probe
+            self.mtu_probe = None
+            self.path_mtu.on_probe_lost(probe_size)
+
+    def is_acknowledged(self, packet_number, ack_frame):
+        if packet_number == ack_frame.largest_acknowledged:
+            return True
+        # Some ack frames are sent without ack ranges (the ack_ranges field is 0)
+        return any(start <= packet_number <= end
+                   for start, end in (ack_range.ack_range for ack_range in ack_frame.ack_ranges or []))
+
+    """
+    This function chooses the stream frames of a packet, so the packet fills the byte budget.
+    The lost data is taken first, then the new data. Each frame is cut to the room left in the packet.
+    
+    Parameters:
+    budget(int): The number of bytes left in the packet after the header and the other frames.
+    new_data(bool): Take new data from the send queue after the lost data.
+    
+    Returns:
+    list: The stream frames of the packet, the frames read from the send source have no data.
+    """
+
+    def packetize(self, budget, new_data=True):
+        frames = []
+        queues = [self.retransmission_queue, self.send_queue] if new_data else [self.retransmission_queue]
+        # In legacy mode a pickled frame is larger than its wire encoding
+        frame_overhead = self.LEGACY_FRAME_OVERHEAD if self.legacy_pickle else 0
+        for queue in queues:
+            while queue:
+                data_length = QUIC_Codec.stream_data_capacity(budget - frame_overhead, queue.first_offset())
+                if data_length == 0:
+                    return frames
+                frame = queue.take_frame(data_length)
+                budget -= QUIC_Codec.stream_frame_size(frame.offset, frame.data_length) + frame_overhead
+                frames.append(frame)
+        return frames
+
+    """
+    This function builds a run of data packets of datagram_size bytes, sends them and adds them to the
+    packets in flight. The packet numbers, the ack frames and the frames are chosen under the lock.
+    With UDP GSO the whole run is sent with a single system call, so every packet but the last one is
+    padded to the segment size.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    new_data(bool): Send new data in the room left by the lost data.
+    max_packets(int): The maximum number of packets of the run.
+    
+    Returns:
+    bool: True if a packet was sent, False if there was nothing to send.
+    """
+
+    def transmit_packet(self, receiver_address, new_data=True, max_packets=1):
+        # The packet numbers are allocated and registered under the lock, so a probe sent by the timer
+        # thread can't take a newer packet number in between
+        with self.lock:
+            datagram_size = self.datagram_size
+            max_packets = min(max_packets, self.datagram_sender.max_segments(datagram_size))
+            datagrams = []
+            packet_sizes = []
+            while len(datagrams) < max_packets:
+                # The rest of the run is only full packets, a partial packet waits for more data or the flush
+                queued_bytes = len(self.retransmission_queue) + (len(self.send_queue) if new_data else 0)
+                if datagrams and (queued_bytes < datagram_size or not self.can_send(datagram_size)):
+                    break
+                # A packet followed by another one of the run must be a full segment
+                pad = len(datagrams) + 1 < max_packets
+                packet = self.build_packet(datagram_size, new_data, pad)
+                if packet is None:
+                    break
+                datagrams.append(packet[0])
+                packet_sizes.append(packet[1])
+            if not datagrams:
+                return False
+
+            while True:
+                try:
+                    bytes_sent = self.datagram_sender.send_batch(datagrams, datagram_size, receiver_address)
+                    if bytes_sent < 0:
+                        raise Exception("Error: The data packet is not sent.")
+                    for packet_size in packet_sizes:
+                        self.pacer.on_packet_sent(packet_size)
+
+                    break  # Exit the loop if data is sent successfully
+                except BlockingIOError:
+
+                    continue  # Retry sending if a temporary resource unavailability occurs
+            self.set_loss_detection_timer()
+        return True
+
+    """
+    This function builds one data packet and adds it to the packets in flight. Called under the lock.
+    
+    Parameters:
+    datagram_size(int): The size of the packet.
+    new_data(bool): Take new data from the send queue after the lost data.
+    pad(bool): Pad the packet to datagram_size if more data waits to be sent.
+    
+    Returns:
+    Tuple: The buffers of the encoded packet and its size, None if there was nothing to send.
+    """
+
+    def build_packet(self, datagram_size, new_data, pad):
         # Create short header for the data packet
         header = QUICHeader("Short", next(self.packet_number_generator))
-
-        # Create the frame for the data packet
-        frames = self.divide_into_frames(data, self.FRAME_SIZE)
         # Create ACK frame for the data packet
-        ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges)
-        total_frames = frames + [ack_frame]
+        ack_frame = self.create_ack_frame()
+        control_frames = [ack_frame]
+        # A requested ack frequency is sent with the data, so it is retransmitted if the packet is lost
+        ack_frequency_frame = self.pending_ack_frequency_frame
+        if ack_frequency_frame is not None:
+            control_frames.insert(0, ack_frequency_frame)
+        budget = datagram_size - self.packet_size(QUICPacket(header, control_frames))
+        in_flight_frames = self.packetize(budget, new_data)
+        if not in_flight_frames:
+            return None
+        self.pending_ack_frequency_frame = None
+        frames = self.load_frames(in_flight_frames)
         # Create the data packet
-        data_packet = QUICPacket(header, total_frames)
-        # Serialize the data packet with pickle
-        ser_paket = pickle.dumps(data_packet)
-        # Check the size of the data packet
-        bytes_size_packet = Utils.calculate_bytes(ser_paket)
-        bytes_size_data = Utils.calculate_bytes(data)
-
-        if bytes_size_packet > self.MAX_UDP_SIZE:
+        data_packet = QUICPacket(header, frames + control_frames)
+        # Check the size of the data packet before it is encoded
+        bytes_size_packet = self.packet_size(data_packet)
+        if bytes_size_packet > datagram_size:
             raise ValueError(
-                f"Error: The data packet size is too large. Maximum vs actual size: {self.MAX_UDP_SIZE} vs {bytes_size_packet}")
+                f"Error: The data packet size is too large. Maximum vs actual size: {datagram_size} vs {bytes_size_packet}")
+        if pad and bytes_size_packet < datagram_size and \
+                (self.retransmission_queue or (new_data and self.send_queue)):
+            data_packet.frames.append(QUICPaddingFrame("Padding", datagram_size - bytes_size_packet))
+            bytes_size_packet = datagram_size
+        self.packets_by_size[datagram_size] = self.packets_by_size.get(datagram_size, 0) + 1
+        # Serialize the data packet with the wire codec, the stream data stays a separate buffer
+        packet_parts = self.encode_packet_parts(data_packet)
+        # The frames kept in flight keep the encoding of the frames that were sent
+        for in_flight_frame, frame in zip(in_flight_frames, frames):
+            in_flight_frame.encoded = frame.encoded
+        if ack_frequency_frame is not None:
+            in_flight_frames.append(ack_frequency_frame)
+
+        self.register_sent_packet(header.packet_number, in_flight_frames, time.time(), bytes_size_packet)
+        self.record_sent_ack_frame(header.packet_number)
+        return packet_parts, bytes_size_packet
+
+    def update_datagram_size(self):
+        # Choose the size of the next data packets, within the path MTU
+        with self.lock:
+            if self.packet_sizer is not None:
+                self.datagram_size = self.packet_sizer.datagram_size(
+                    self.max_datagram_size, self.congestion_controller.get_congestion_window())
+            else:
+                self.datagram_size = self.max_datagram_size
 
-        # Send the data packet to the receiver and start the timer
-        send_time = time.time()
-        # with self.lock:
-        self.in_flight_packets[header.packet_number] = (frames, send_time)
+    def can_send(self, packet_size):
+        if self.congestion_controller.bytes_in_flight + packet_size > self.SEND_WINDOW:
+            return False
+        return self.congestion_controller.can_send(packet_size)
+
+    """
+    This function waits until the pacer releases a packet of the given size.
+    Instead of sleeping, it waits on the socket, so the acks that arrive in the meantime are processed right away.
+    
+    Parameters:
+    packet_size(int): The size of the packet to be sent.
+    receiver_address(Tuple): The address of the receiver.
+    """
 
+    def pace(self, packet_size, receiver_address):
         while True:
-            try:
-                bytes_sent = self.socket_fd.sendto(ser_paket, receiver_address)
-                if bytes_sent < 0:
-                    raise Exception("Error: The data packet is not sent.")
+            self.pacer.update_rate(self.congestion_controller.get_congestion_window(), self.smoothed_rtt)
+            delay = self.pacer.time_until_send(packet_size)
+            if delay <= 0:
+                return
+            readable, _, _ = select.select([self.socket_fd], [], [], delay)
+            if readable:
+                self.QUIC_process_acks(receiver_address)
+
+    def register_sent_packet(self, packet_number, frames, send_time, packet_size):
+        self.in_flight_packets.add(packet_number, (frames, send_time, packet_size))
+        self.time_of_last_ack_eliciting_packet = send_time
+        self.congestion_controller.on_packet_sent(packet_size)
+
+    def acknowledge_packet(self, packet_number):
+        # Remove the packet from the in-flight packets and let the congestion window grow
+        _, send_time, packet_size = self.in_flight_packets.pop(packet_number)
+        self.congestion_controller.on_ack(packet_size, send_time)
+        if self.packet_sizer is not None:
+            self.packet_sizer.on_packet_acked(packet_size)
 
-                break  # Exit the loop if data is sent successfully
-            except BlockingIOError:
+    """
+    This function sends the queued data that didn't fill a whole datagram, and waits until all the packets
+    in flight are acknowledged by the receiver.
+    It should be called after the last QUIC_send_data call, before the connection is closed.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    """
 
-                continue  # Retry sending if a temporary resource unavailability occurs
-        with self.lock:
-            self.start_pto_timer(data_packet.get_packet_number())
+    def QUIC_flush(self, receiver_address):
+        while (self.in_flight_packets or self.retransmission_queue or self.send_queue or self.pending_resends) and \
+                self.pending_close_packet is None:
+            if self.retransmission_queue or self.send_queue:
+                # The data that didn't fill a whole packet, and the lost data
+                self.send_packet(receiver_address)
+            else:
+                self.QUIC_process_acks(receiver_address, block=True)
+        # The kernel may still read the buffers of the last zerocopy sends, the send source can be closed after it
+        self.datagram_sender.wait_for_completions()
 
-        # Receive the ack packet from the receiver in a while loop.
-        ack_packet = None
+    """
+    This function processes the ack packets that arrived from the receiver.
+    All the queued packets are drained from the socket without blocking.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    block(bool): Wait for at least one packet (up to the socket timeout) before draining the socket.
+    """
+
+    def QUIC_process_acks(self, receiver_address, block=False):
+        # Release the buffers of the completed zerocopy sends, the notifications also wake up the pacing wait
+        self.datagram_sender.reap_completions()
+        flags = 0 if block else MSG_DONTWAIT
+        # Only the first read blocks, the following ones drain the queued packets
+        first_read = True
         while True:
             try:
-                ack_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
-                break
+                ack_packet, _ = self.receive_datagram(flags)
             except BlockingIOError:
-                print("Error: The ack packet is not received.")
+                if block and first_read:
+                    # Nothing was received within the socket timeout, the loss detection timer handles the losses
+                    print("Error: The ack packet is not received.")
+                return
+            first_read = False
+            # Deserialize the ack packet with the wire codec
+            ack_packet = self.decode_packet(ack_packet)
+            if isinstance(ack_packet.header, QUICLongHeader) and ack_packet.header.long_packet_type == "Close":
+                # The peer closed the connection, nothing in flight will be acknowledged anymore
+                self.pending_close_packet = ack_packet
+                with self.lock:
+                    self.congestion_controller.on_packets_discarded(
+                        sum(packet_size for _, _, packet_size in self.in_flight_packets.values()))
+                    self.in_flight_packets.clear()
+                    self.set_loss_detection_timer()
+                return
+            self.on_ack_packet(ack_packet, receiver_address)
+            # Drain the rest of the queued packets without blocking
+            flags = MSG_DONTWAIT
+
+    def on_ack_packet(self, ack_packet, receiver_address):
+        self.largest_ack_update(ack_packet)
+        self.update_ack_ranges(ack_packet.get_packet_number())
+
+        for frame in ack_packet.frames:
+            if frame.get_frame_type() != "Ack":
+                continue
+            with self.lock:
+                acked_packets = self.acknowledged_packets(self.in_flight_packets, frame)
+                self.process_ack_of_ack(frame)
+                self.on_mtu_probe_ack(frame)
+                # Take an RTT sample only from the largest acknowledged packet
+                if frame.largest_acknowledged in acked_packets:
+                    _, send_time, _ = self.in_flight_packets[frame.largest_acknowledged]
+                    self.update_rtt(send_time, frame.ack_delay)
+                    self.process_ecn_counts(frame, send_time)
+                for packet_number in acked_packets:
+                    self.acknowledge_packet(packet_number)
+                if acked_packets:
+                    # The congestion window grew
+                    self.update_datagram_size()
+                self.largest_acked_packet = max(self.largest_acked_packet, frame.largest_acknowledged)
+                if not acked_packets:
+                    continue
+                # The peer is reachable, reset the PTO backoff
+                self.pto_count = 0
+
+                # Packet and time threshold loss detection
                 self.QUIC_detect_and_handle_loss_time(receiver_address)
-                continue  # Retry receiving if a temporary resource unavailability occurs
 
-        # Deserialize the ack packet with pickle
-        ack_packet = pickle.loads(ack_packet)
-        # If the method returns true, the packet is lost and the recovery mechanism is initiated
-        # with self.lock:
-        self.largest_ack_update(ack_packet)
-        self.update_ack_ranges(data_packet.get_packet_number())
+    """
+    This function handles the ECN counts of an ack frame that newly acknowledges its largest packet
+    (RFC 9002, section 7.1). An increase of the CE count means a router on the path marked our packets
+    instead of dropping them: the congestion window is reduced, but nothing is retransmitted.
 
-        self.QUIC_detect_loss(receiver_address, ack_packet, data_packet.get_packet_number(), send_time)
-        self.QUIC_detect_and_handle_loss_time(receiver_address)
-        return bytes_size_data
+    Parameters:
+    ack_frame(QUICAckFrame): An ack frame received from the peer.
+    time_sent(float): The time the largest acknowledged packet was sent.
+    """
+
+    def process_ecn_counts(self, ack_frame, time_sent):
+        if ack_frame.ecn_counts is None:
+            return
+        ce_count = ack_frame.ecn_counts[2]
+        if ce_count > self.peer_ce_count:
+            self.peer_ce_count = ce_count
+            self.ecn_congestion_events += 1
+            self.congestion_controller.on_ecn_congestion(time_sent)
+
+    def acknowledged_packets(self, history, ack_frame):
+        # Find the packets of the history that are acknowledged by the ack frame, a binary search per ack range
+        acked_packets = set(history.in_range(ack_frame.largest_acknowledged, ack_frame.largest_acknowledged))
+        # Some ack frames are sent without ack ranges (the ack_ranges field is 0)
+        for ack_range in ack_frame.ack_ranges or []:
+            start, end = ack_range.ack_range
+            acked_packets.update(history.in_range(start, end))
+        return sorted(acked_packets)
+
+    def record_sent_ack_frame(self, packet_number):
+        largest_reported = self.ack_ranges.largest()
+        if largest_reported is not None:
+            self.sent_ack_frames.add(packet_number, largest_reported)
+
+    """
+    This function handles the acknowledgement of our ack frames (RFC 9000, section 13.2.4).
+    Once the peer acknowledges a packet that carried one of our ack frames, the peer knows about every
+    packet number that ack frame reported, so they are pruned from the ack ranges.
+    This keeps the ack frames a bounded size no matter how long the connection lasts.
+    
+    Parameters:
+    ack_frame(QUICAckFrame): An ack frame received from the peer.
+    """
+
+    def process_ack_of_ack(self, ack_frame):
+        acked_packets = self.acknowledged_packets(self.sent_ack_frames, ack_frame)
+        if not acked_packets:
+            return
+        largest_reported = self.sent_ack_frames[acked_packets[-1]]
+        # The records of the older packets are not needed anymore, even if their acks were lost
+        for packet_number in self.sent_ack_frames.in_range(0, acked_packets[-1]):
+            self.sent_ack_frames.pop(packet_number)
+        self.ack_ranges.prune(largest_reported)
 
     """
     This function receives data from the sender. It receives the data and sends the acknowledgement to the sender.
+    Every datagram that is already queued is received in one batch (with UDP GRO where available),
+    and the ack and the ack delay timer are decided once for the whole batch (RFC 9000, section 13.2.2).
+    The stream data is appended to data_buffer in stream order, whatever the order of the packets was.
+    The data that arrives in order is a memoryview slice over the receive buffer (no copies are made),
+    so it has to be consumed before the next call.
     
     Returns:
     int: The number of bytes received if the data is received successfully, 0 if the sender disconnects, -1 otherwise.
     """
 
     def QUIC_receive_data(self, data_buffer, buffer_size, sender_address):
-        packet = None
-
-        bytes_received = 0
+        datagrams = []
         while True:
             try:
-                # Receive the packet from the sender
-                packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                # Receive the packets from the sender
+                datagrams = self.datagram_receiver.receive_burst(self.MAX_RECEIVE_BATCH)
                 break  # Exit the loop if something is received
             except BlockingIOError:
 
                 print("Error: The packet is not received.")
                 continue  # Retry receiving if a temporary resource unavailability occurs
 
-        # Deserialize the packet with pickle
-        packet = pickle.loads(packet)
-        recv_number = packet.get_packet_number()
-        # print(f"Packet received from the sender: {recv_number}")
-
-        # Check if the packet is received
-        if packet:
-            bytes_received = self.process_packet(packet, data_buffer, buffer_size, sender_address)
-            # print(f"Bytes received: {bytes_received}")
+        bytes_received = 0
+        immediate_ack = None
+        with self.lock:
+            for datagram, _ in datagrams:
+                # Deserialize the packet with the wire codec
+                packet = self.decode_packet(datagram)
+                packet_bytes, packet_ack = self.receive_packet(packet)
+                bytes_received += packet_bytes
+                if packet_ack is not None:
+                    immediate_ack = bool(immediate_ack) or packet_ack
+            bytes_received += self.read_stream(data_buffer)
+            self.schedule_ack(sender_address, immediate_ack)
         return bytes_received
 
     def process_packet(self, packet, data_buffer, buffer_size, sender_address):
-        # Add the packet to the acked packets in the packet number index
+        with self.lock:
+            data_bytes_received, immediate_ack = self.receive_packet(packet)
+            data_bytes_received += self.read_stream(data_buffer)
+            self.schedule_ack(sender_address, immediate_ack)
+        return data_bytes_received
+
+    """
+    This function processes the frames of a received packet and records its packet number. Called under the lock.
+    
+    Parameters:
+    packet(QUICPacket): The received packet.
+    
+    Returns:
+    Tuple: The number of stream bytes written to the sink, and the ack the packet needs:
+    None if no ack, True for an immediate ack, False for a delayed ack.
+    """
+
+    def receive_packet(self, packet):
         data_bytes_received = 0
         flag = True
-
+        ack_eliciting = False
         # Add the data to the buffer according to the buffer size
         for frame in packet.frames:
+            if frame.get_frame_type() == "Ack":
+                self.process_ack_of_ack(frame)
+                continue
+            if frame.get_frame_type() == "Padding":
+                continue
+            # Every frame other than an ack or a padding frame elicits an ack
+            ack_eliciting = True
             if frame.get_frame_type() == "Stream":
-                if isinstance(frame.data, bytes):
-                    data_buffer.append(frame.data)
-                    data_bytes_received += frame.data_length
+                if isinstance(frame.data, (bytes, memoryview)):
+                    if self.stream_sink is not None:
+                        data_bytes_received += self.stream_sink.write(frame.offset, frame.data)
+                    # Without room in the reassembly buffer the packet is not acked, so it is retransmitted
+                    elif not self.receive_stream.insert(frame.offset, frame.data):
+                        print("Error: The reassembly buffer is full.")
+                        flag = False
                 else:
                     print("Error: The data is not in bytes.")
                     flag = False
+            elif frame.get_frame_type() == "AckFrequency":
+                self.on_ack_frequency_frame(frame)
+
+        if not flag:
+            return data_bytes_received, None
+        largest_received = self.ack_ranges.largest()
+        self.largest_ack_update(packet)
+        is_new = self.update_ack_ranges(packet.get_packet_number())
+        if not ack_eliciting:
+            return data_bytes_received, None
+        self.ack_eliciting_packets_received += 1
+        # A reordered, duplicated or gap-creating packet is acked immediately,
+        # so the sender detects the loss (or stops retransmitting) without waiting
+        in_order = is_new and (largest_received is None or packet.get_packet_number() == largest_received + 1)
+        return data_bytes_received, not in_order
+
+    def read_stream(self, data_buffer):
+        # The stream data is released in order, duplicates are dropped
+        data_bytes_received = 0
+        for data in self.receive_stream.read():
+            data_buffer.append(data)
+            data_bytes_received += len(data)
+        return data_bytes_received
 
-        # with self.lock:
-
-        # print("Process packet")
-
-        # Send the ack packet to the sender
-        if flag:
+    def schedule_ack(self, sender_address, immediate_ack):
+        # Send the ack now, or arm the ack delay timer. Called under the lock.
+        if immediate_ack is None:
+            return
+        if immediate_ack or self.ack_eliciting_packets_received >= self.ack_eliciting_threshold:
+            self.send_ack(sender_address)
+        elif self.ack_delay_timer is None:
+            self.ack_receiver_address = sender_address
+            self.ack_delay_timer = self.timer_wheel.schedule(self.max_ack_delay, self.ack_delay_expired)
+
+    def create_ack_frame(self):
+        # The ack delay is the time since the largest acknowledged packet was received
+        ack_delay = 0 if self.largest_received_time is None else max(time.time() - self.largest_received_time, 0)
+        # The ECN counts are reported only when the TOS byte of the received datagrams is read
+        ecn_counts = tuple(self.datagram_receiver.ecn_counts) if self.datagram_receiver.ecn_enabled else None
+        return QUICAckFrame("Ack", self.largest_acknowledged, ack_delay, self.ack_ranges.to_ack_ranges(),
+                            ecn_counts)
 
-            self.largest_ack_update(packet)
-            self.update_ack_ranges(packet.get_packet_number())
+    """
+    This function sends an ack-only packet with the current ack ranges and cancels the pending delayed ack.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the peer.
+    """
 
-            ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, self.ack_ranges)
+    def send_ack(self, receiver_address):
+        with self.lock:
+            if self.ack_delay_timer is not None:
+                self.timer_wheel.cancel(self.ack_delay_timer)
+                self.ack_delay_timer = None
+            self.ack_eliciting_packets_received = 0
             short_header = QUICHeader("Short", next(self.packet_number_generator))
-            total_frames = [ack_frame]
-            ack_packet = QUICPacket(short_header, total_frames)
-            ack_packet = pickle.dumps(ack_packet)
+            ack_packet = QUICPacket(short_header, [self.create_ack_frame()])
+            ack_packet = self.encode_packet_parts(ack_packet)
+            self.record_sent_ack_frame(short_header.packet_number)
 
-            if self.socket_fd.sendto(ack_packet, sender_address) < 0:
+            if self.send_datagram(ack_packet, receiver_address) < 0:
                 raise Exception("Error: The ack packet is not sent.")
 
-            # print("Ack packet sent to the sender.")
+    def ack_delay_expired(self):
+        with self.lock:
+            if self.ack_delay_timer is None:
+                return
+            self.ack_delay_timer = None
+            self.send_ack(self.ack_receiver_address)
 
-        # Receive the data from the packet
-        frames_size = Utils.calculate_bytes(packet.frames)
-        # print(f"Frames size {frames_size}")
+    def flush_pending_ack(self):
+        # Send the delayed ack now, before the connection is closed
+        with self.lock:
+            if self.ack_delay_timer is not None:
+                self.send_ack(self.ack_receiver_address)
 
-        return data_bytes_received
+    def on_ack_frequency_frame(self, frame):
+        if frame.sequence_number <= self.ack_frequency_sequence_received:
+            return
+        self.ack_frequency_sequence_received = frame.sequence_number
+        self.ack_eliciting_threshold = max(frame.ack_eliciting_threshold, 1)
+        self.max_ack_delay = frame.request_max_ack_delay
 
-    def update_ack_ranges(self, packet_number):
+    """
+    This function asks the receiver to change how often it acknowledges the data packets
+    (draft-ietf-quic-ack-frequency). The ack frequency frame is sent with the next data packet.
+    Fewer acks save work on both peers, but delay the loss detection and the growth of the congestion window.
+    
+    Parameters:
+    ack_eliciting_threshold(int): The number of data packets the receiver may receive before it sends an ack.
+    max_ack_delay(float): The maximum time in seconds the receiver may delay an ack, MAX_ACK_DELAY by default.
+    """
 
-        # If ack_ranges is empty, add the first range
-        if not self.ack_ranges:
-            self.ack_ranges.append(AckRange(0, (packet_number, packet_number)))
-        else:
-            # Check if the packet number fits into an existing range
-            for i, ack_range in enumerate(self.ack_ranges):
-                start, end = ack_range.ack_range
-                if start <= packet_number <= end:
-                    # The packet number is already in a range, no need to update
-                    return
-                elif packet_number == end + 1:
-                    # The packet number extends the range by 1
-                    ack_range.ack_range = (start, packet_number)
-                    return
-                elif packet_number == start - 1:
-                    # The packet number extends the range by 1 at the start
-                    ack_range.ack_range = (packet_number, end)
-                    return
-                elif packet_number > end + 1:
-                    # Calculate the gap between the end of the range and the packet number
-                    gap = packet_number - 1 - end - 1
-                    # Create a new range with the gap
-                    self.ack_ranges.insert(i + 1, AckRange(gap, (packet_number, packet_number)))
-                    return
-                elif packet_number < start - 1:
-                    # Calculate the gap between the start of the range and the packet number
-                    gap = start - 1 - packet_number - 1
-                    # Create a new range with the gap
-                    self.ack_ranges.insert(i, AckRange(gap, (packet_number, packet_number)))
-                    return
+    def QUIC_request_ack_frequency(self, ack_eliciting_threshold, max_ack_delay=None):
+        if max_ack_delay is None:
+            max_ack_delay = self.MAX_ACK_DELAY
+        with self.lock:
+            self.pending_ack_frequency_frame = QUICAckFrequencyFrame(
+                "AckFrequency", self.ack_frequency_sequence_number, ack_eliciting_threshold, max_ack_delay)
+            self.ack_frequency_sequence_number += 1
+            # Until the frame arrives the receiver may still use the previous delay
+            self.peer_max_ack_delay = max(self.peer_max_ack_delay, max_ack_delay)
+
+    """
+    This function makes the received stream data go directly to a sink (for example a FileStreamSink),
+    which writes every frame to its offset. QUIC_receive_data then only returns the number of new bytes.
+    
+    Parameters:
+    sink(FileStreamSink): The sink of the stream data, None to use the data buffer again.
+    """
 
-            # If the packet number doesn't fit into any existing range, create a new range
-            self.ack_ranges.append(AckRange(0, (packet_number, packet_number)))
+    def QUIC_set_stream_sink(self, sink):
+        with self.lock:
+            self.stream_sink = sink
+
+    """
+    This function returns the stats of the connection, to check the packet sizes against the benchmarks.
+    
+    Returns:
+    dict: The current datagram size and its upper bound (the path MTU), the estimated loss rate per byte,
+    the number of data packets sent with each datagram size, the number of lost packets,
+    the smoothed RTT, the congestion window, and the send system calls per MB (with or without UDP GSO).
+    """
+
+    def QUIC_get_stats(self):
+        with self.lock:
+            return {
+                "datagram_size": self.datagram_size,
+                "max_datagram_size": self.max_datagram_size,
+                "loss_rate": self.packet_sizer.loss_rate if self.packet_sizer is not None else None,
+                "packets_by_size": dict(sorted(self.packets_by_size.items())),
+                "lost_packets": self.lost_packet_count,
+                "smoothed_rtt": self.smoothed_rtt,
+                "congestion_window": self.congestion_controller.get_congestion_window(),
+                "gso": self.datagram_sender.gso_enabled,
+                "send_syscalls": self.datagram_sender.syscalls,
+                "datagrams_sent": self.datagram_sender.datagrams_sent,
+                "zerocopy": self.datagram_sender.zerocopy_enabled,
+                "zerocopy_sends": self.datagram_sender.zerocopy_sends,
+                "zerocopy_copied": self.datagram_sender.zerocopy_copied,
+                "ecn": self.datagram_sender.ecn_enabled,
+                "ecn_counts": tuple(self.datagram_receiver.ecn_counts),
+                "peer_ce_count": self.peer_ce_count,
+                "ecn_congestion_events": self.ecn_congestion_events,
+                "syscalls_per_mb": self.datagram_sender.syscalls / max(self.datagram_sender.bytes_sent / 2 ** 20,
+                                                                       1 / 2 ** 20),
+                "gro": self.datagram_receiver.gro_enabled,
+                "receive_syscalls": self.datagram_receiver.syscalls,
+                "datagrams_received": self.datagram_receiver.datagrams_received,
+            }
+
+    def update_ack_ranges(self, packet_number):
+        # Add the packet number to the received intervals, merging it with the neighbor intervals
+        is_new = self.ack_ranges.add(packet_number)
+        if is_new and packet_number == self.ack_ranges.largest():
+            self.largest_received_time = time.time()
+        return is_new
 
     """
     This function closes the connection between the two peers.
@@ -479,6 +1105,8 @@ class QUIC_Protocol:
     """
 
     def QUIC_close_connection(self, is_client):
+        # The peer must not wait for an ack that was still delayed
+        self.flush_pending_ack()
         if is_client:
             # Create the long header for the close packet
             long_header = QUICLongHeader("Long", "Close", next(self.packet_number_generator))
@@ -490,30 +1118,29 @@ class QUIC_Protocol:
             # Create the packet for the close packet
             close_packet = QUICPacket(long_header, total_frames)
             close_packet_number = long_header.packet_number
-            # Serialize the close packet with pickle
-            close_packet = pickle.dumps(close_packet)
+            # Serialize the close packet with the wire codec
+            close_packet = self.encode_packet_parts(close_packet)
             # Send the close packet to the server
-            if self.socket_fd.sendto(close_packet, self.server_address) == -1:
+            if self.send_datagram(close_packet, self.server_address) == -1:
                 raise Exception("Error: The close packet is not sent.")
             send_time = time.time()
-            # self.packet_send_times[long_header.get_packet_number()] = send_time
-            self.in_flight_packets[long_header.get_packet_number()] = (total_frames, send_time)
+            self.register_sent_packet(long_header.get_packet_number(), total_frames, send_time,
+                                      sum(len(part) for part in close_packet))
             with self.lock:
-                self.start_pto_timer(long_header.get_packet_number())
+                self.set_loss_detection_timer()
             print("Close packet sent to the server.")
             # Receive the response from the server
             response_packet = None
             while True:
                 try:
-                    response_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                    response_packet, _ = self.receive_datagram()
                     break  # Exit the loop if something is received
                 except BlockingIOError:
                     print("Error: The response closing packet is not received.")
-                    self.QUIC_detect_and_handle_loss_time(self.server_address)
                     continue
 
-            # Deserialize the response with pickle
-            response_packet = pickle.loads(response_packet)
+            # Deserialize the response with the wire codec
+            response_packet = self.decode_packet(response_packet)
             if response_packet.header.header_form != "Long":
 
                 time.sleep(2)
@@ -527,17 +1154,17 @@ class QUIC_Protocol:
 
         # Server case
         else:
-            # Receive the client close packet
-            client_close_packet = None
-            while True:
+            # Receive the client close packet, unless it already arrived while waiting for acks
+            client_close_packet = self.pending_close_packet
+            while client_close_packet is None:
                 try:
-                    client_close_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                    client_close_packet, _ = self.receive_datagram()
+                    # Deserialize the client close packet with the wire codec
+                    client_close_packet = self.decode_packet(client_close_packet)
                     break  # Exit the loop if something is received
                 except BlockingIOError:
                     print("Error: The client close packet is not received.")
 
-            # Deserialize the client close packet with pickle
-            client_close_packet = pickle.loads(client_close_packet)
             self.largest_ack_update(client_close_packet)
             self.update_ack_ranges(client_close_packet.get_packet_number())
             # Send the response packet to the client
@@ -546,10 +1173,11 @@ class QUIC_Protocol:
             stream_frame = QUICStreamFrame("Stream", "Server Close", len("Server Close"))
             total_frames = [ack_frame, stream_frame]
             response_packet = QUICPacket(long_header, total_frames)
-            response_packet = pickle.dumps(response_packet)
-            if self.socket_fd.sendto(response_packet, self.client_address) == -1:
+            response_packet = self.encode_packet_parts(response_packet)
+            if self.send_datagram(response_packet, self.client_address) == -1:
                 raise Exception("Error: The response packet is not sent.")
             print("Response packet sent to the client, closing the connection...")
+        self.timer_wheel.stop()
         return True
 
     """
@@ -563,9 +1191,13 @@ class QUIC_Protocol:
             ack_time = time.time()
             self.latest_rtt = ack_time - sending_time
             # Remove the packet from the in-flight packets
-            if date_packet_number in self.in_flight_packets:
-                self.update_rtt(sending_time)
-                self.in_flight_packets.pop(date_packet_number)
+            with self.lock:
+                if date_packet_number in self.in_flight_packets:
+                    self.update_rtt(sending_time)
+                    self.acknowledge_packet(date_packet_number)
+                    self.largest_acked_packet = max(self.largest_acked_packet, date_packet_number)
+                    self.pto_count = 0
+                self.set_loss_detection_timer()
             # print(f"Round-trip time:{self.latest_rtt} seconds")
 
         else:
@@ -584,38 +1216,61 @@ class QUIC_Protocol:
                     print(f"Largest acknowledged: {frame.largest_acknowledged} vs. Data packet number: {date_packet_number}")
                     # Find the previous range of the largest acknowledged and compare the gap with the threshold
 
-                    for ack_range in self.ack_ranges:
+                    for ack_range in self.ack_ranges.to_ack_ranges():
                         start, end = ack_range.ack_range
                         if start <= frame.largest_acknowledged <= end:
                             if ack_range.gap >= self.PACKET_THRESHOLD:
                                 print("Packet loss recovery mechanism initiated.")
-                                for packet_number, (time_sent, frames) in self.in_flight_packets.items():
-                                    if frame.largest_acknowledged - self.PACKET_THRESHOLD > packet_number:
-                                        print(f"Packet number {packet_number} is lost.")
-                                        packets_to_recovery.append(packet_number)
+                                # Only the packets at least PACKET_THRESHOLD below the largest acknowledged are
+                                # lost, the history finds them without visiting the newer packets in flight
+                                for packet_number in self.in_flight_packets.in_range(
+                                        0, frame.largest_acknowledged - self.PACKET_THRESHOLD - 1):
+                                    print(f"Packet number {packet_number} is lost.")
+                                    packets_to_recovery.append(packet_number)
         if packets_to_recovery:
             self.QUIC_recovery(packets_to_recovery, receiver_address)
             return True
 
         return False
 
-    def QUIC_detect_and_handle_loss_time(self, receiver_address):
-        # print("Detect and handle loss time function")
-        packets_to_recovery = []
-        time_threshold = self.calculate_time_threshold()
-        current_time_value = time.time()
-        for packet_number, (_, send_time) in self.in_flight_packets.items():
+    """
+    This function detects the lost packets according to RFC 9002 (section 6.1).
+    Only the packets below the largest acknowledged packet can be declared lost:
+    1. Packet threshold: the largest acknowledged packet is at least PACKET_THRESHOLD packets after it.
+    2. Time threshold: it was sent more than 9/8 * max(SRTT, latest_RTT) before now.
+    For the other packets below the largest acknowledged, the earliest time they will be lost is kept in loss_time.
+    
+    Returns:
+    list: The packet numbers of the lost packets.
+    """
 
-            if current_time_value - time_threshold > send_time:
+    def detect_lost_packets(self):
+        self.loss_time = None
+        loss_delay = self.calculate_time_threshold()
+        lost_send_time = time.time() - loss_delay
+        lost_packets = []
+        # The packets are ordered by packet number and send time, so the scan stops at the first packet
+        # that is not lost: the packets after it are not lost either
+        for packet_number, (_, send_time, _) in self.in_flight_packets.items():
+            if packet_number > self.largest_acked_packet:
+                break
+            if send_time <= lost_send_time or self.largest_acked_packet >= packet_number + self.PACKET_THRESHOLD:
                 print(f"Packet number {packet_number} is lost.")
-                packets_to_recovery.append(packet_number)
+                lost_packets.append(packet_number)
             else:
-                print(f"Packet number {packet_number} is not lost.")
-        if packets_to_recovery:
-            print("Packet loss recovery mechanism initiated.")
-            self.QUIC_recovery(packets_to_recovery, receiver_address)
-            return True
-        return False
+                self.loss_time = send_time + loss_delay
+                break
+        return lost_packets
+
+    def QUIC_detect_and_handle_loss_time(self, receiver_address):
+        with self.lock:
+            packets_to_recovery = self.detect_lost_packets()
+            if packets_to_recovery:
+                print("Packet loss recovery mechanism initiated.")
+                self.QUIC_recovery(packets_to_recovery, receiver_address)
+            # The loss time and the packets in flight changed
+            self.set_loss_detection_timer()
+        return bool(packets_to_recovery)
 
     """
     This function implements the recovery mechanism in case of packet loss and reordering in the network.
@@ -624,54 +1279,177 @@ class QUIC_Protocol:
     1. Detect the lost packets.
     2. Detect the reordered packets.
     3. Implement the recovery mechanism.
+    The lost packets are reported to the congestion controller, except for PTO probes.
+    The frames of the lost data packets are added to the retransmission queue instead of being resent as is,
+    so the next packets pack the lost data together (and with new data). The probes and the handshake packets
+    are resent as they are, right away if the pacer allows it and otherwise from a timer.
     Parameters:
+    packets_to_recovery(list): The packet numbers of the lost packets.
+    receiver_address(Tuple): The address of the receiver.
+    is_probe(bool): The packets are resent as probes after a PTO expiration.
     
     Returns:
     
     """
 
-    def QUIC_recovery(self, packets_to_recovery, receiver_address):
+    def QUIC_recovery(self, packets_to_recovery, receiver_address, is_probe=False):
         print("Recovery mechanism initiated.")
-        total_bytes = 0
         packet_count = 0
 
         packets_to_remove = []
-        packets_to_add = []
+        lost_packets = []
 
         for packet_number in packets_to_recovery:
+            # The packet may have been acknowledged since it was declared lost
+            if packet_number not in self.in_flight_packets:
+                continue
             packet_count += 1
-            (frames, _) = self.in_flight_packets[packet_number]
+            (frames, time_sent, packet_size) = self.in_flight_packets[packet_number]
             # Get the frames of the lost packet and create a packet with a new packet number
             if not isinstance(frames, list):
                 print(f"Error: frames is not a list. Found: {type(frames).__name__}")
                 continue
+            if not is_probe and self.is_repackable(frames):
+                print(f"Lost packet {packet_number} detected, its frames are queued for retransmission.")
+                self.queue_lost_frames(frames)
+                packets_to_remove.append(packet_number)
+                lost_packets.append((time_sent, packet_size))
+                continue
 
-            header = QUICHeader("Short", next(self.packet_number_generator))
-            lost_packet = QUICPacket(header, frames)
-            # Serialize the lost packet with pickle
-            lost_packet = pickle.dumps(lost_packet)
-            # Get the size of the lost packet in bytes
-            lost_packet_size = Utils.calculate_bytes(lost_packet)
-            # Send the lost packet to the receiver
+            # The packet is resent with a new packet number after the old one is accounted as lost
             print(f"Lost packet {packet_number} detected.")
-            if self.socket_fd.sendto(lost_packet, receiver_address) < 0:
-                raise Exception("Error: The lost packet is not sent.")
-
-            print(f"Lost packet {packet_number} sent to the receiver.")
-            total_bytes += lost_packet_size
-            # Mark the old packet for removal and the new packet for addition
+            self.pending_resends.append((packet_number, frames, packet_size))
             packets_to_remove.append(packet_number)
-            packets_to_add.append((header.packet_number, (frames, time.time())))
+            lost_packets.append((time_sent, packet_size))
 
-        # Remove old packets and add new packets outside the loop to avoid runtime modification of the dictionary
+        # Remove the old packets outside the loop to avoid runtime modification of the dictionary
         for packet_number in packets_to_remove:
             self.in_flight_packets.pop(packet_number)
-        for packet_number, value in packets_to_add:
-            self.in_flight_packets[packet_number] = value
+        # A probe is not a loss, the old packet only stops counting as in flight
+        if is_probe:
+            self.congestion_controller.on_packets_discarded(sum(packet_size for _, packet_size in lost_packets))
+        else:
+            # Persistent congestion is only declared after the first RTT sample
+            pto_period = self.calculate_pto_period() if self.rttmin != float('inf') else None
+            self.congestion_controller.on_loss(lost_packets, pto_period)
+            self.lost_packet_count += len(lost_packets)
+            if self.packet_sizer is not None:
+                for _, packet_size in lost_packets:
+                    self.packet_sizer.on_packet_lost(packet_size)
+            # The next packets are smaller if the loss rate grew or the congestion window shrank
+            self.update_datagram_size()
+        if self.pending_resends:
+            self.send_pending_resends(receiver_address)
+        return packet_count
 
+    def is_repackable(self, frames):
+        # The stream data and the ack frequency frames can be sent in any packet, the text messages can't
+        return all((frame.get_frame_type() == "Stream" and not isinstance(frame.data, str)) or
+                   frame.get_frame_type() == "AckFrequency" for frame in frames)
 
-        print(f"Total bytes sent for the lost packets: {total_bytes}")
-        return packet_count
+    def queue_lost_frames(self, frames):
+        for frame in frames:
+            if frame.get_frame_type() == "Stream":
+                self.retransmission_queue.add(frame)
+            elif frame.get_frame_type() == "AckFrequency":
+                # Only the newest ack frequency frame is sent again, unless a newer one is already pending
+                if frame.sequence_number == self.ack_frequency_sequence_number - 1 and \
+                        self.pending_ack_frequency_frame is None:
+                    self.pending_ack_frequency_frame = frame
+
+    """
+    This function packs the retransmission queue into full packets and sends them right away.
+    It is used when the loss is detected on the timer thread, while the sending thread may be blocked.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    """
+
+    def send_retransmissions(self, receiver_address):
+        with self.lock:
+            if not self.send_pending_resends(receiver_address):
+                return
+            while self.retransmission_queue:
+                if not self.schedule_paced_retransmission(self.datagram_size, receiver_address):
+                    return
+                if not self.transmit_packet(receiver_address, new_data=False):
+                    break
+
+    """
+    This function resends the lost packets that are resent as they are, with new packet numbers,
+    as long as the pacer allows it.
+    
+    Parameters:
+    receiver_address(Tuple): The address of the receiver.
+    
+    Returns:
+    bool: All the pending packets were sent.
+    """
+
+    def send_pending_resends(self, receiver_address):
+        with self.lock:
+            total_bytes = 0
+            while self.pending_resends:
+                packet_number, frames, packet_size = self.pending_resends[0]
+                if not self.schedule_paced_retransmission(packet_size, receiver_address):
+                    break
+                self.pending_resends.popleft()
+                header = QUICHeader("Short", next(self.packet_number_generator))
+                # Only the header is encoded again, the frames are sent from their cached encoding and their data
+                lost_packet = self.encode_packet_parts(QUICPacket(header, self.load_frames(frames)))
+                lost_packet_size = sum(len(part) for part in lost_packet)
+                if self.send_datagram(lost_packet, receiver_address) < 0:
+                    raise Exception("Error: The lost packet is not sent.")
+                self.pacer.on_packet_sent(lost_packet_size)
+                print(f"Lost packet {packet_number} sent to the receiver.")
+                total_bytes += lost_packet_size
+                self.register_sent_packet(header.packet_number, frames, time.time(), lost_packet_size)
+                # The timer may be disarmed if the resent packet is the only one in flight
+                self.set_loss_detection_timer()
+            if total_bytes:
+                print(f"Total bytes sent for the lost packets: {total_bytes}")
+            return not self.pending_resends
+
+    """
+    This function checks if the pacer allows a retransmission now. Otherwise, the rest of the retransmissions
+    is sent by a timer when the pacer allows it, instead of sleeping while the lock is held.
+    
+    Parameters:
+    packet_size(int): The size of the next retransmitted packet.
+    receiver_address(Tuple): The address of the receiver.
+    
+    Returns:
+    bool: The packet can be sent now.
+    """
+
+    def schedule_paced_retransmission(self, packet_size, receiver_address):
+        if self.retransmission_timer is not None:
+            self.timer_wheel.cancel(self.retransmission_timer)
+            self.retransmission_timer = None
+        delay = self.pacer.time_until_send(packet_size)
+        if delay <= 0:
+            return True
+        self.retransmission_timer = self.timer_wheel.schedule(delay, self.retransmission_timer_expired,
+                                                              receiver_address)
+        return False
+
+    def retransmission_timer_expired(self, receiver_address):
+        with self.lock:
+            self.retransmission_timer = None
+            self.send_retransmissions(receiver_address)
+
+    def load_frames(self, frames):
+        # Read the data of the stream frames that only kept their offset and length from the send source
+        loaded_frames = []
+        for frame in frames:
+            if frame.get_frame_type() == "Stream" and frame.data is None:
+                data = self.send_source.read(frame.offset - self.send_source_offset, frame.data_length)
+                loaded_frame = QUICStreamFrame("Stream", data, frame.data_length, frame.offset)
+                # The encoding of the frame doesn't depend on where the data comes from
+                loaded_frame.encoded = frame.encoded
+                frame = loaded_frame
+            loaded_frames.append(frame)
+        return loaded_frames
 
     def largest_ack_update(self, packet):
 
@@ -696,29 +1474,28 @@ class QUIC_Protocol:
         # Create the packet for the request packet
         request_packet = QUICPacket(long_header, total_frames)
         request_packet_number = long_header.packet_number
-        # Serialize the request packet with pickle
-        request_packet = pickle.dumps(request_packet)
+        # Serialize the request packet with the wire codec
+        request_packet = self.encode_packet_parts(request_packet)
         # Send the request packet to the server
-        if self.socket_fd.sendto(request_packet, self.server_address) == -1:
+        if self.send_datagram(request_packet, self.server_address) == -1:
             raise Exception("Error: The request packet is not sent.")
         print("Request packet sent to the server.")
         send_time = time.time()
-        # self.packet_send_times[long_header.get_packet_number()] = send_time
-        self.in_flight_packets[long_header.get_packet_number()] = (total_frames, send_time)
+        self.register_sent_packet(long_header.get_packet_number(), total_frames, send_time,
+                                  sum(len(part) for part in request_packet))
         with self.lock:
-            self.start_pto_timer(long_header.get_packet_number())
+            self.set_loss_detection_timer()
         # Receive the response from the server
         response_packet = None
         while True:
             try:
-                response_packet, _ = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                response_packet, _ = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
-                self.QUIC_detect_and_handle_loss_time(self.server_address)
                 continue
 
-        # Deserialize the response with pickle
-        response_packet = pickle.loads(response_packet)
+        # Deserialize the response with the wire codec
+        response_packet = self.decode_packet(response_packet)
         self.largest_ack_update(response_packet)
         self.update_ack_ranges(response_packet.get_packet_number())
 
@@ -738,14 +1515,14 @@ class QUIC_Protocol:
         while True:
             try:
                 # Receive the request from the client
-                request_packet, client_address = self.socket_fd.recvfrom(self.MAX_UDP_SIZE)
+                request_packet, client_address = self.receive_datagram()
                 break  # Exit the loop if something is received
             except BlockingIOError:
                 print("Error: The request packet is not received.")
                 continue
 
-        # Deserialize the request with pickle
-        request_packet = pickle.loads(request_packet)
+        # Deserialize the request with the wire codec
+        request_packet = self.decode_packet(request_packet)
         self.largest_ack_update(request_packet)
         self.update_ack_ranges(request_packet.get_packet_number())
         print(f"Request received from the client: {request_packet.get_packet_number()}")
@@ -755,64 +1532,111 @@ class QUIC_Protocol:
         ack_frame = QUICAckFrame("Ack", self.largest_acknowledged, 0, 0)
         total_frames = [ack_frame]
         response_packet = QUICPacket(long_header, total_frames)
-        # Serialize the response packet with pickle
-        response_packet = pickle.dumps(response_packet)
+        # Serialize the response packet with the wire codec
+        response_packet = self.encode_packet_parts(response_packet)
         # Send the response packet to the client
-        if self.socket_fd.sendto(response_packet, self.client_address) == -1:
+        if self.send_datagram(response_packet, self.client_address) == -1:
             raise Exception("Error: The response packet is not sent.")
         print("Response packet sent to the client, beginning the file transfer.")
 
-    def divide_into_frames(self, data, frame_size):
-        try:
-            # Calculate the number of frames
-            data_bytes_size = Utils.calculate_bytes(data)
-            num_frames = data_bytes_size // frame_size
-            if data_bytes_size % frame_size != 0:
-                num_frames += 1  # Add one more frame if there's leftover data
-
-            # Create the frames
-            frames = []
-            for i in range(num_frames):
-                start = i * frame_size
-                end = start + frame_size
-                frame = QUICStreamFrame("Stream", data[start:end], Utils.calculate_bytes(data[start:end]))
-                frames.append(frame)
-            return frames
-        except Exception as e:
-            print(f"Error: {e}")
+    """
+    This function receives a single datagram into the preallocated receive buffer.
+    The returned memoryview (and the stream frames decoded from it) are only valid until the next receive.
+    
+    Parameters:
+    flags(int): The flags of the recvfrom_into call (MSG_DONTWAIT for a non-blocking receive).
+    
+    Returns:
+    Tuple: The memoryview of the received datagram and the address of the peer.
+    """
+
+    def receive_datagram(self, flags=0):
+        return self.datagram_receiver.receive(flags)
+
+    def encode_packet_parts(self, packet):
+        # Serialize the packet to the buffers of one datagram, the stream data is not copied
+        if self.legacy_pickle:
+            return [pickle.dumps(packet)]
+        return QUIC_Codec.encode_packet_parts(packet)
+
+    def packet_size(self, packet):
+        # The exact size of the packet on the wire, calculated from its fields without encoding it
+        if self.legacy_pickle:
+            return len(pickle.dumps(packet))
+        return QUIC_Codec.packet_size(packet)
 
-    def update_rtt(self, send_time):
+    def send_datagram(self, packet_parts, receiver_address):
+        # Scatter-gather send: the kernel gathers the buffers into one datagram
+        return self.datagram_sender.send(packet_parts, receiver_address)
+
+    def decode_packet(self, datagram):
+        # Deserialize the bytes received from the wire to a packet
+        if self.legacy_pickle:
+            return pickle.loads(datagram)
+        return QUIC_Codec.decode_packet(datagram)
+
+    def update_rtt(self, send_time, ack_delay=0):
 
         now = time.time()
         self.latest_rtt = now - send_time
+        # The first RTT sample replaces the initial estimates
+        first_sample = self.rttmin == float('inf')
         self.rttmin = min(self.rttmin, self.latest_rtt)
-        if self.smoothed_rtt == 0:
+        if first_sample:
             self.smoothed_rtt = self.latest_rtt
             self.rttvar = self.latest_rtt / 2
         else:
-            rttvar_sample = abs(self.smoothed_rtt - self.latest_rtt)
+            # The time the peer delayed the ack is not part of the network RTT (RFC 9002, section 5.3)
+            ack_delay = min(ack_delay, self.peer_max_ack_delay)
+            adjusted_rtt = self.latest_rtt
+            if self.latest_rtt >= self.rttmin + ack_delay:
+                adjusted_rtt -= ack_delay
+            rttvar_sample = abs(self.smoothed_rtt - adjusted_rtt)
             self.rttvar = (1 - self.kRTTBeta) * self.rttvar + self.kRTTBeta * rttvar_sample
-            self.smoothed_rtt = (1 - self.kRTTAlpha) * self.smoothed_rtt + self.kRTTAlpha * self.latest_rtt
+            self.smoothed_rtt = (1 - self.kRTTAlpha) * self.smoothed_rtt + self.kRTTAlpha * adjusted_rtt
 
     def calculate_time_threshold(self):
         return max(self.kTimeThreshold * max(self.smoothed_rtt, self.latest_rtt), self.kGranularity)
 
-    def start_pto_timer(self, packet_number):
+    def calculate_pto_period(self):
         # Calculate PTO timer period based on smoothed RTT, RTT variation, and maximum ACK delay
-        pto_timeout = self.smoothed_rtt + 4 * self.rttvar + self.MAX_ACK_DELAY
+        return self.smoothed_rtt + max(4 * self.rttvar, self.kGranularity) + self.peer_max_ack_delay
 
-        # Start a timer for PTO
-        threading.Timer(pto_timeout, self.pto_timer_expired, args=[packet_number]).start()
+    """
+    This function arms the single loss detection timer of the connection (RFC 9002, section 6.2).
+    If a packet can be declared lost by the time threshold, the timer expires at the earliest loss time.
+    Otherwise, if packets are in flight, it expires one PTO period after the last packet was sent,
+    and the PTO period is doubled for every PTO that expired without an ack.
+    """
+
+    def set_loss_detection_timer(self):
+        with self.lock:
+            if self.loss_detection_timer is not None:
+                self.timer_wheel.cancel(self.loss_detection_timer)
+                self.loss_detection_timer = None
+            if self.loss_time is not None:
+                timeout = self.loss_time
+            elif self.in_flight_packets:
+                timeout = self.time_of_last_ack_eliciting_packet + self.calculate_pto_period() * (2 ** self.pto_count)
+            else:
+                # Nothing to detect, the timer stays disarmed
+                return
+            self.loss_detection_timer = self.timer_wheel.schedule(max(timeout - time.time(), 0),
+                                                                  self.loss_detection_timer_expired)
 
-    def pto_timer_expired(self, packet_number):
+    def loss_detection_timer_expired(self):
         with self.lock:
-            if packet_number in self.in_flight_packets:
-                # Resend the packet as a probe
-                sending_time, frames = self.in_flight_packets[packet_number]
-                print(f"PTO Timer expired for packet {packet_number}. Resending as a probe.")
-                self.QUIC_recovery([packet_number], self.server_address)
-
-    def send_packet_pto(self, packet_number, frames):
-        sending_time = time.time()
-        self.in_flight_packets[packet_number] = (sending_time, frames)
-        self.start_pto_timer(packet_number)
+            self.loss_detection_timer = None
+            # On the server side the peer is the client
+            peer_address = self.client_address if self.client_address is not None else self.server_address
+            if self.loss_time is not None:
+                # Time threshold loss detection
+                self.QUIC_detect_and_handle_loss_time(peer_address)
+                self.send_retransmissions(peer_address)
+            elif self.in_flight_packets:
+                # PTO: resend the oldest packets in flight as probes
+                self.pto_count += 1
+                probe_packets = self.in_flight_packets.oldest(self.MAX_PROBE_PACKETS)
+                print(f"PTO Timer expired for packets {probe_packets}. Resending as probes.")
+                self.QUIC_recovery(probe_packets, peer_address, is_probe=True)
+                self.set_loss_detection_timer()
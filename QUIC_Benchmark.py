@@ -0,0 +1,92 @@
+import argparse
+import time
+from socket import *
+from QUIC_Sender import DatagramSender, ZEROCOPY_MIN_BYTES
+
+
+# Description: This file contains the benchmark of the zerocopy send mode.
+# It sends the same data with copying sends and with MSG_ZEROCOPY sends, one datagram per system call,
+# for a range of datagram sizes, and prints the size from which the zerocopy sends are faster.
+# By default the datagrams go to a local socket that is never read. On loopback the kernel copies the data anyway,
+# so the zerocopy sends only pay off through a network card: pass the address of a host on the LAN
+# (e.g. --address 192.168.1.2:9, the discard port).
+
+SIZES = [1200, 1472, 4096, 8192, 16384, 32768, 65507]
+BUFFER_SIZE = 1024 * 1024  # The datagrams are slices of this buffer
+REAP_INTERVAL = 64  # The number of sends between two reads of the completion notifications
+
+
+"""
+This function sends a number of bytes as datagrams of one size, and measures the send rate.
+
+Parameters:
+address(Tuple): The address of the receiver.
+datagram_size(int): The size of the datagrams.
+total_bytes(int): The number of bytes to send.
+use_zerocopy(bool): Send with MSG_ZEROCOPY instead of copying the data.
+
+Returns:
+Tuple: The send rate in MB/s, the number of zerocopy sends and the number of them the kernel copied anyway.
+"""
+
+
+def measure(address, datagram_size, total_bytes, use_zerocopy):
+    sender_socket = socket(AF_INET, SOCK_DGRAM)
+    sender = DatagramSender(sender_socket, use_gso=False, use_zerocopy=use_zerocopy, zerocopy_min_bytes=0)
+    buffer = memoryview(bytearray(BUFFER_SIZE))
+    datagrams = total_bytes // datagram_size
+    start_time = time.perf_counter()
+    for index in range(datagrams):
+        start = index * datagram_size % (BUFFER_SIZE - datagram_size)
+        sender.send([buffer[start:start + datagram_size]], address)
+        if index % REAP_INTERVAL == 0:
+            sender.reap_completions()
+    # The buffers are released only when the kernel is done with them
+    sender.wait_for_completions()
+    elapsed = time.perf_counter() - start_time
+    sender_socket.close()
+    return sender.bytes_sent / (1024 * 1024) / elapsed, sender.zerocopy_sends, sender.zerocopy_copied
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # The receiver of the datagrams, a local socket that is never read by default
+    parser.add_argument("--address", type=parse_address)
+    parser.add_argument("--megabytes", type=int, default=256)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    arguments = parser.parse_args()
+    sink_socket = None
+    address = arguments.address
+    if address is None:
+        sink_socket = socket(AF_INET, SOCK_DGRAM)
+        sink_socket.bind(('127.0.0.1', 0))
+        address = sink_socket.getsockname()
+
+    total_bytes = arguments.megabytes * 1024 * 1024
+    threshold = None
+    print(f"Sending {arguments.megabytes} MB to {address[0]}:{address[1]} with each datagram size")
+    print(f"{'Size':>8} {'Copy MB/s':>10} {'Zerocopy MB/s':>14} {'Copied by the kernel':>21}")
+    for datagram_size in arguments.sizes:
+        copy_rate, _, _ = measure(address, datagram_size, total_bytes, False)
+        zerocopy_rate, zerocopy_sends, zerocopy_copied = measure(address, datagram_size, total_bytes, True)
+        if zerocopy_sends == 0:
+            print("Error: The kernel doesn't support MSG_ZEROCOPY on this socket.")
+            break
+        print(f"{datagram_size:>8} {copy_rate:>10.1f} {zerocopy_rate:>14.1f} "
+              f"{zerocopy_copied / zerocopy_sends:>20.0%}")
+        # The threshold is the smallest size from which every larger size is faster with zerocopy
+        if zerocopy_rate > copy_rate:
+            threshold = datagram_size if threshold is None else threshold
+        else:
+            threshold = None
+    if threshold is None:
+        print("The zerocopy sends are not faster for any size on this path.")
+    else:
+        print(f"The zerocopy sends are faster from {threshold} bytes (the default threshold is {ZEROCOPY_MIN_BYTES}).")
+    if sink_socket is not None:
+        sink_socket.close()
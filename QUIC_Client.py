@@ -1,16 +1,22 @@
+import argparse
 import os
 import uuid
 from socket import *
 from QUIC_API import *
+from QUIC_Stream import FileStreamSink
 # from QUIC_API_Based_number_packet import *
 # from QUIC_API_Based_time import *
 import struct
 
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
 
 class QUIC_Client:
 
-    def __init__(self, server_name, server_port):
+    def __init__(self, server_name, server_port, use_gro=True):
         self.server_name = server_name
+        # Receive the coalesced datagrams with UDP GRO where the kernel supports it
+        self.use_gro = use_gro
         self.server_port = server_port
         self.server_address = (self.server_name, self.server_port)
         self.total_bytes_received = 0
@@ -24,9 +30,11 @@ class QUIC_Client:
         self.clientSocket = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP)
         self.clientSocket.setsockopt(SOL_SOCKET, SO_RCVTIMEO,
                                      struct.pack('ll', int(MAX_TIME_WAIT), int(timeout_microseconds)))
+        # Make room for a full send window of datagrams (the kernel caps it at net.core.rmem_max)
+        self.clientSocket.setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER_SIZE)
         print("Start the QUIC client...")
 
-        self.quic_connection = QUIC_Protocol(self.clientSocket, self.server_address)
+        self.quic_connection = QUIC_Protocol(self.clientSocket, self.server_address, use_gro=self.use_gro)
         print("Created the QUIC connection object")
 
     def connect_to_server(self):
@@ -45,22 +53,23 @@ class QUIC_Client:
         while True:
             bytes_received = 0
             self.total_bytes_received = 0
-            # A binary buffer to store the file content
+            # The sink writes the stream data directly to its offset in the preallocated file,
+            # so the data buffer stays empty and nothing is reassembled in memory
             file_buffer = []
 
             # Receive the file
-            with open('received_file.bin', 'wb') as f:
-                while self.total_bytes_received < FILE_SIZE:
+            with FileStreamSink('received_file.bin', FILE_SIZE) as sink:
+                self.quic_connection.QUIC_set_stream_sink(sink)
+                while not sink.is_complete():
                     bytes_received = self.quic_connection.QUIC_receive_data(file_buffer, BUFFER_SIZE,
                                                                             self.server_address)
                     self.total_bytes_received += bytes_received
-                    # Write the received data to a file
-                    for data in file_buffer:
-                        f.write(data)
                     # print(f"Received {bytes_received} bytes")
-                    # Clear the buffer
-                    file_buffer.clear()
+                self.quic_connection.QUIC_set_stream_sink(None)
             print(f"Total bytes received: {self.total_bytes_received}")
+            stats = self.quic_connection.QUIC_get_stats()
+            print(f"Receive syscalls: {stats['receive_syscalls']} for {stats['datagrams_received']} datagrams "
+                  f"(GRO {'on' if stats['gro'] else 'off'})")
             if self.total_bytes_received >= FILE_SIZE:
                 print("File received successfully")
 
@@ -78,7 +87,11 @@ if __name__ == '__main__':
     serverName = 'localhost'
     serverPort = 12000
     SERVER_ADDRESS = (serverName, serverPort)
-    client_quic = QUIC_Client(serverName, serverPort)
+    parser = argparse.ArgumentParser()
+    # Read every datagram with its own system call, to compare with UDP GRO
+    parser.add_argument("--no-gro", action="store_true")
+    arguments = parser.parse_args()
+    client_quic = QUIC_Client(serverName, serverPort, not arguments.no_gro)
     client_quic.start_client()
     client_quic.connect_to_server()
     client_quic.request_file_handshake()
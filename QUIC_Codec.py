@@ -0,0 +1,350 @@
+"""
+This file contains the binary wire codec of the QUIC packets.
+It replaces pickle on the wire with a compact encoding of the QUIC Packet classes:
+1. A fixed header byte that holds the header form and the long packet type.
+2. The packet number encoded as a variable-length integer (RFC 9000, section 16).
+3. The frames, each one starting with an integer frame type code.
+   The payload of a stream frame is length-prefixed and written as is.
+"""
+import struct
+from QUIC_Packet import *
+
+# The header forms and the long packet types are encoded by their index in the lists below.
+# Header byte: | form (2 bits) | long packet type (2 bits) | reserved (4 bits) |
+HEADER_FORMS = ["Short", "Long", "Initial"]
+LONG_PACKET_TYPES = ["Initial", "Handshake", "Close", "Client Hello"]
+
+# Frame type codes
+FRAME_TYPE_PADDING = 0x00
+FRAME_TYPE_PING = 0x01
+FRAME_TYPE_ACK = 0x02
+FRAME_TYPE_ACK_ECN = 0x03  # An ack frame followed by the ECT(0), ECT(1) and CE counts
+FRAME_TYPE_STREAM = 0x08
+FRAME_TYPE_ACK_FREQUENCY = 0xAF
+# Stream frame flag: the payload is a text message (handshake and close messages) and not raw bytes
+STREAM_TEXT_BIT = 0x01
+# Stream frame flag: the frame has an offset field (frames at offset 0 leave it out)
+STREAM_OFFSET_BIT = 0x04
+
+# The ack delay is carried on the wire in microseconds
+ACK_DELAY_UNIT = 1_000_000
+
+MAX_VARINT = (1 << 62) - 1
+
+
+def encode_varint(value):
+    # The two most significant bits of the first byte hold the length of the integer
+    if value < 0x40:
+        return bytes((value,))
+    elif value < 0x4000:
+        return struct.pack("!H", value | 0x4000)
+    elif value < 0x40000000:
+        return struct.pack("!I", value | 0x80000000)
+    elif value <= MAX_VARINT:
+        return struct.pack("!Q", value | 0xC000000000000000)
+    raise ValueError(f"Error: The value {value} is too large to be encoded as a varint.")
+
+
+def decode_varint(buffer, position):
+    # Returns the decoded integer and the position right after it
+    first = buffer[position]
+    prefix = first >> 6
+    if prefix == 0:
+        return first, position + 1
+    elif prefix == 1:
+        return struct.unpack_from("!H", buffer, position)[0] & 0x3FFF, position + 2
+    elif prefix == 2:
+        return struct.unpack_from("!I", buffer, position)[0] & 0x3FFFFFFF, position + 4
+    return struct.unpack_from("!Q", buffer, position)[0] & 0x3FFFFFFFFFFFFFFF, position + 8
+
+
+def varint_size(value):
+    # The number of bytes of the encoded varint
+    if value < 0x40:
+        return 1
+    elif value < 0x4000:
+        return 2
+    elif value < 0x40000000:
+        return 4
+    elif value <= MAX_VARINT:
+        return 8
+    raise ValueError(f"Error: The value {value} is too large to be encoded as a varint.")
+
+
+def encode_header(header):
+    form = HEADER_FORMS.index(header.header_form)
+    packet_type = 0
+    if isinstance(header, QUICLongHeader):
+        packet_type = LONG_PACKET_TYPES.index(header.long_packet_type)
+    return bytes(((form << 6) | (packet_type << 4),)) + encode_varint(header.packet_number)
+
+
+def decode_header(buffer, position):
+    first = buffer[position]
+    header_form = HEADER_FORMS[first >> 6]
+    packet_number, position = decode_varint(buffer, position + 1)
+    if header_form == "Short":
+        return QUICHeader(header_form, packet_number), position
+    return QUICLongHeader(header_form, LONG_PACKET_TYPES[(first >> 4) & 0x03], packet_number), position
+
+
+"""
+This function encodes a frame without the binary data of a stream frame.
+The encoding is cached on the frame, so a retransmitted frame is not encoded again.
+
+Parameters:
+frame(QUICFrame): The frame to encode.
+
+Returns:
+bytes: The encoded frame, up to the stream data.
+"""
+
+
+def encode_frame_prefix(frame):
+    if frame.encoded is not None:
+        return frame.encoded
+    buffer = bytearray()
+    frame_type = frame.get_frame_type()
+    if frame_type == "Stream":
+        data = frame.data
+        flags = 0
+        if isinstance(data, str):
+            data = data.encode()
+            flags |= STREAM_TEXT_BIT
+            length = len(data)
+        else:
+            # The binary data is not part of the prefix, a frame without data is read from the send source
+            length = frame.data_length if data is None else len(data)
+        offset = frame.offset
+        if offset:
+            flags |= STREAM_OFFSET_BIT
+        buffer += bytes((FRAME_TYPE_STREAM | flags,))
+        if offset:
+            buffer += encode_varint(offset)
+        buffer += encode_varint(length)
+        if flags & STREAM_TEXT_BIT:
+            buffer += data
+    elif frame_type == "Ack":
+        # Some packets are sent without ack ranges (the ack_ranges field is 0)
+        ack_ranges = frame.ack_ranges if frame.ack_ranges else []
+        buffer += bytes((FRAME_TYPE_ACK if frame.ecn_counts is None else FRAME_TYPE_ACK_ECN,))
+        buffer += encode_varint(frame.largest_acknowledged)
+        buffer += encode_varint(int(frame.ack_delay * ACK_DELAY_UNIT))
+        buffer += encode_varint(len(ack_ranges))
+        for ack_range in ack_ranges:
+            start, end = ack_range.ack_range
+            buffer += encode_varint(ack_range.gap)
+            buffer += encode_varint(start)
+            buffer += encode_varint(end - start)
+        if frame.ecn_counts is not None:
+            for count in frame.ecn_counts:
+                buffer += encode_varint(count)
+    elif frame_type == "AckFrequency":
+        buffer += bytes((FRAME_TYPE_ACK_FREQUENCY,))
+        buffer += encode_varint(frame.sequence_number)
+        buffer += encode_varint(frame.ack_eliciting_threshold)
+        buffer += encode_varint(int(frame.request_max_ack_delay * ACK_DELAY_UNIT))
+    elif frame_type == "Ping":
+        buffer += bytes((FRAME_TYPE_PING,))
+    elif frame_type == "Padding":
+        # Every padding byte is a padding frame of its own
+        buffer += bytes(frame.length)
+    else:
+        raise ValueError(f"Error: Unknown frame type {frame_type}.")
+    frame.encoded = bytes(buffer)
+    return frame.encoded
+
+
+def stream_payload(frame):
+    # The binary data of a stream frame, which is sent after the cached prefix
+    if frame.get_frame_type() == "Stream" and not isinstance(frame.data, str):
+        return frame.data
+    return None
+
+
+def encode_frame(frame, buffer):
+    buffer += encode_frame_prefix(frame)
+    payload = stream_payload(frame)
+    if payload is not None:
+        buffer += payload
+
+
+def decode_frame(buffer, position):
+    frame_type = buffer[position]
+    position += 1
+    if frame_type & ~(STREAM_TEXT_BIT | STREAM_OFFSET_BIT) == FRAME_TYPE_STREAM:
+        offset = 0
+        if frame_type & STREAM_OFFSET_BIT:
+            offset, position = decode_varint(buffer, position)
+        length, position = decode_varint(buffer, position)
+        # Slicing a memoryview does not copy, so the payload stays a view over the receive buffer
+        data = buffer[position:position + length]
+        position += length
+        if frame_type & STREAM_TEXT_BIT:
+            data = str(data, "utf-8")
+        return QUICStreamFrame("Stream", data, length, offset), position
+    elif frame_type in (FRAME_TYPE_ACK, FRAME_TYPE_ACK_ECN):
+        largest_acknowledged, position = decode_varint(buffer, position)
+        ack_delay, position = decode_varint(buffer, position)
+        range_count, position = decode_varint(buffer, position)
+        ack_ranges = []
+        for _ in range(range_count):
+            gap, position = decode_varint(buffer, position)
+            start, position = decode_varint(buffer, position)
+            length, position = decode_varint(buffer, position)
+            ack_ranges.append(AckRange(gap, (start, start + length)))
+        ecn_counts = None
+        if frame_type == FRAME_TYPE_ACK_ECN:
+            ecn_counts = []
+            for _ in range(3):
+                count, position = decode_varint(buffer, position)
+                ecn_counts.append(count)
+            ecn_counts = tuple(ecn_counts)
+        return QUICAckFrame("Ack", largest_acknowledged, ack_delay / ACK_DELAY_UNIT, ack_ranges,
+                            ecn_counts), position
+    elif frame_type == FRAME_TYPE_ACK_FREQUENCY:
+        sequence_number, position = decode_varint(buffer, position)
+        ack_eliciting_threshold, position = decode_varint(buffer, position)
+        request_max_ack_delay, position = decode_varint(buffer, position)
+        return QUICAckFrequencyFrame("AckFrequency", sequence_number, ack_eliciting_threshold,
+                                     request_max_ack_delay / ACK_DELAY_UNIT), position
+    elif frame_type == FRAME_TYPE_PING:
+        return QUICPingFrame("Ping"), position
+    elif frame_type == FRAME_TYPE_PADDING:
+        # The consecutive padding bytes are decoded as one frame
+        rest = bytes(buffer[position:])
+        length = 1 + len(rest) - len(rest.lstrip(b"\x00"))
+        return QUICPaddingFrame("Padding", length), position + length - 1
+    raise ValueError(f"Error: Unknown frame type code {frame_type}.")
+
+
+"""
+This function encodes a QUIC packet to its binary wire format.
+
+Parameters:
+packet(QUICPacket): The packet to be encoded.
+
+Returns:
+bytes: The encoded datagram.
+"""
+
+
+def encode_packet(packet):
+    buffer = bytearray(encode_header(packet.header))
+    for frame in packet.frames:
+        encode_frame(frame, buffer)
+    return bytes(buffer)
+
+
+"""
+The functions below compute the encoded size of the headers, the frames and the packets from their fields,
+without encoding them, so the sender can size a packet before building it.
+"""
+
+
+def header_size(header):
+    return 1 + varint_size(header.packet_number)
+
+
+def stream_frame_size(offset, data_length):
+    return 1 + (varint_size(offset) if offset else 0) + varint_size(data_length) + data_length
+
+
+def frame_size(frame):
+    if frame.encoded is not None:
+        payload = stream_payload(frame)
+        return len(frame.encoded) + (len(payload) if payload is not None else 0)
+    frame_type = frame.get_frame_type()
+    if frame_type == "Stream":
+        if isinstance(frame.data, str):
+            return stream_frame_size(frame.offset, len(frame.data.encode()))
+        return stream_frame_size(frame.offset, frame.data_length if frame.data is None else len(frame.data))
+    elif frame_type == "Ack":
+        ack_ranges = frame.ack_ranges if frame.ack_ranges else []
+        size = 1 + varint_size(frame.largest_acknowledged) + varint_size(int(frame.ack_delay * ACK_DELAY_UNIT)) + \
+            varint_size(len(ack_ranges))
+        for ack_range in ack_ranges:
+            start, end = ack_range.ack_range
+            size += varint_size(ack_range.gap) + varint_size(start) + varint_size(end - start)
+        if frame.ecn_counts is not None:
+            size += sum(varint_size(count) for count in frame.ecn_counts)
+        return size
+    elif frame_type == "AckFrequency":
+        return 1 + varint_size(frame.sequence_number) + varint_size(frame.ack_eliciting_threshold) + \
+            varint_size(int(frame.request_max_ack_delay * ACK_DELAY_UNIT))
+    elif frame_type == "Ping":
+        return 1
+    elif frame_type == "Padding":
+        return frame.length
+    raise ValueError(f"Error: Unknown frame type {frame_type}.")
+
+
+def packet_size(packet):
+    return header_size(packet.header) + sum(frame_size(frame) for frame in packet.frames)
+
+
+"""
+This function calculates how much stream data fits in a number of bytes.
+
+Parameters:
+budget(int): The number of bytes left in the packet for the stream frame.
+offset(int): The stream offset of the data.
+
+Returns:
+int: The largest data length whose stream frame is at most budget bytes, 0 if no data fits.
+"""
+
+
+def stream_data_capacity(budget, offset):
+    data_length = budget - 1 - (varint_size(offset) if offset else 0)
+    if data_length <= 0:
+        return 0
+    # The length field shrinks with the data, a shorter data may need a shorter length field
+    while data_length > 0 and stream_frame_size(offset, data_length) > budget:
+        data_length -= 1
+    return max(data_length, 0)
+
+
+"""
+This function encodes a QUIC packet to a list of buffers that form one datagram, for a scatter-gather send.
+The encoded header, the cached encoding of every frame (the ack frame, the stream frame prefixes) and the data
+of the stream frames are separate buffers, and the kernel gathers them. Nothing is joined or copied
+in user space: the data of a stream frame read from a send source is a memoryview of the file mapping.
+
+Parameters:
+packet(QUICPacket): The packet to encode.
+
+Returns:
+list: The buffers of the datagram, in order.
+"""
+
+
+def encode_packet_parts(packet):
+    parts = [encode_header(packet.header)]
+    for frame in packet.frames:
+        parts.append(encode_frame_prefix(frame))
+        payload = stream_payload(frame)
+        if payload:
+            parts.append(payload)
+    return parts
+
+
+"""
+This function decodes a datagram received from the socket to a QUIC packet.
+
+Parameters:
+datagram(bytes or memoryview): The received datagram.
+When a memoryview is given, the payloads of the stream frames are memoryview slices over it.
+
+Returns:
+QUICPacket: The decoded packet.
+"""
+
+
+def decode_packet(datagram):
+    header, position = decode_header(datagram, 0)
+    frames = []
+    while position < len(datagram):
+        frame, position = decode_frame(datagram, position)
+        frames.append(frame)
+    return QUICPacket(header, frames)
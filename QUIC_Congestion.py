@@ -0,0 +1,212 @@
+"""
+This file contains the congestion control of the QUIC protocol.
+The QUIC_Protocol class reports every sent, acknowledged and lost packet to a congestion controller,
+and sends a new packet only when the congestion window of the controller allows it.
+The default controller is NewReno, as described in RFC 9002 (section 7 and appendix B).
+Besides the losses, the CE marks reported in the ack frames (ECN) are a congestion signal.
+"""
+import time
+from abc import ABC, abstractmethod
+
+
+class CongestionController(ABC):
+
+    def __init__(self, max_datagram_size):
+        self.max_datagram_size = max_datagram_size
+        # The sum of the sizes of the packets that are sent and not yet acknowledged or declared lost
+        self.bytes_in_flight = 0
+
+    """
+    This function checks if a packet of the given size may be sent now.
+
+    Parameters:
+    sent_bytes(int): The size of the packet.
+
+    Returns:
+    bool: True if the packet fits in the congestion window, False otherwise.
+    """
+
+    def can_send(self, sent_bytes):
+        return self.bytes_in_flight + sent_bytes <= self.get_congestion_window()
+
+    def on_packet_sent(self, sent_bytes):
+        self.bytes_in_flight += sent_bytes
+
+    def set_max_datagram_size(self, max_datagram_size):
+        # Called when the path MTU discovery raises the datagram size
+        self.max_datagram_size = max_datagram_size
+
+    def on_packets_discarded(self, discarded_bytes):
+        # Packets that will never be acknowledged or declared lost (for example when the peer closed the connection)
+        self.bytes_in_flight = max(0, self.bytes_in_flight - discarded_bytes)
+
+    @abstractmethod
+    def get_congestion_window(self):
+        pass
+
+    """
+    This function is called for every packet that is acknowledged.
+
+    Parameters:
+    acked_bytes(int): The size of the acknowledged packet.
+    time_sent(float): The time the packet was sent.
+    """
+
+    @abstractmethod
+    def on_ack(self, acked_bytes, time_sent):
+        pass
+
+    """
+    This function is called once for all the packets that are declared lost together.
+
+    Parameters:
+    lost_packets(list): A list of (time_sent, sent_bytes) tuples of the lost packets.
+    pto_period(float): The current probe timeout period, None if there is no RTT sample yet.
+    """
+
+    @abstractmethod
+    def on_loss(self, lost_packets, pto_period):
+        pass
+
+    """
+    This function is called when an ack frame reports new CE marks (RFC 9002, section 7.1).
+    The marked packets were delivered, so nothing is retransmitted and no bytes leave the flight.
+
+    Parameters:
+    time_sent(float): The time the largest acknowledged packet of the ack frame was sent.
+    """
+
+    @abstractmethod
+    def on_ecn_congestion(self, time_sent):
+        pass
+
+
+class NewRenoCongestionController(CongestionController):
+    kLossReductionFactor = 0.5
+    kPersistentCongestionThreshold = 3
+
+    def __init__(self, max_datagram_size):
+        super().__init__(max_datagram_size)
+        self.kInitialWindow = min(10 * max_datagram_size, max(14720, 2 * max_datagram_size))
+        self.kMinimumWindow = 2 * max_datagram_size
+        self.congestion_window = self.kInitialWindow
+        # Slow start threshold, the controller is in slow start while the window is below it
+        self.ssthresh = float('inf')
+        # The time the current recovery period started, packets sent before it don't grow the window
+        self.congestion_recovery_start_time = 0
+
+    def get_congestion_window(self):
+        return self.congestion_window
+
+    def set_max_datagram_size(self, max_datagram_size):
+        super().set_max_datagram_size(max_datagram_size)
+        # The minimum window is two datagrams of the new size, and the window never stays below it
+        self.kMinimumWindow = 2 * max_datagram_size
+        self.congestion_window = max(self.congestion_window, self.kMinimumWindow)
+
+    def in_congestion_recovery(self, time_sent):
+        return time_sent <= self.congestion_recovery_start_time
+
+    def on_ack(self, acked_bytes, time_sent):
+        self.bytes_in_flight = max(0, self.bytes_in_flight - acked_bytes)
+        # Do not increase the congestion window during recovery
+        if self.in_congestion_recovery(time_sent):
+            return
+        if self.congestion_window < self.ssthresh:
+            # Slow start
+            self.congestion_window += acked_bytes
+        else:
+            # Congestion avoidance
+            self.congestion_window += self.max_datagram_size * acked_bytes // self.congestion_window
+
+    def on_congestion_event(self, time_sent):
+        # A single congestion event per recovery period
+        if self.in_congestion_recovery(time_sent):
+            return
+        self.congestion_recovery_start_time = time.time()
+        self.ssthresh = self.congestion_window * self.kLossReductionFactor
+        self.congestion_window = max(int(self.ssthresh), self.kMinimumWindow)
+
+    def on_ecn_congestion(self, time_sent):
+        # The same response as a loss, once per recovery period
+        self.on_congestion_event(time_sent)
+
+    def on_loss(self, lost_packets, pto_period):
+        if not lost_packets:
+            return
+        for _, sent_bytes in lost_packets:
+            self.bytes_in_flight = max(0, self.bytes_in_flight - sent_bytes)
+        send_times = [time_sent for time_sent, _ in lost_packets]
+        self.on_congestion_event(max(send_times))
+
+        # Persistent congestion: the lost packets span more than the persistent congestion duration.
+        # The lost packets are declared together, so no packet between them was acknowledged.
+        if pto_period is not None and len(lost_packets) >= 2:
+            if max(send_times) - min(send_times) > pto_period * self.kPersistentCongestionThreshold:
+                print("Persistent congestion detected.")
+                self.congestion_window = self.kMinimumWindow
+                self.congestion_recovery_start_time = 0
+
+
+"""
+This class paces the packets that are sent, as described in RFC 9002 (section 7.7).
+It is a token bucket that is refilled at N * congestion_window / smoothed_rtt bytes per second,
+so the congestion window is spread over a round trip instead of being sent in a single burst.
+The bucket holds up to BURST_PACKETS datagrams, so a short burst is still sent immediately.
+A burst is limited to the initial congestion window (RFC 9002, section 7.7), which is also the longest run
+of datagrams sent with a single UDP GSO call.
+"""
+
+
+class Pacer:
+    N = 1.25
+    BURST_PACKETS = 10  # The initial congestion window, in datagrams
+    kGranularity = 0.001  # 1 millisecond in seconds
+
+    def __init__(self, max_datagram_size):
+        self.capacity = self.BURST_PACKETS * max_datagram_size
+        self.tokens = self.capacity
+        # The pacing rate in bytes per second, not limited until the first update
+        self.pacing_rate = float('inf')
+        self.last_update = time.monotonic()
+
+    def set_max_datagram_size(self, max_datagram_size):
+        # The bucket holds BURST_PACKETS datagrams of the new size
+        self.capacity = self.BURST_PACKETS * max_datagram_size
+
+    def update_rate(self, congestion_window, smoothed_rtt):
+        self.pacing_rate = self.N * congestion_window / max(smoothed_rtt, self.kGranularity)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.pacing_rate == float('inf'):
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.pacing_rate)
+        self.last_update = now
+
+    """
+    This function calculates how long the sender has to wait before the packet can be sent.
+
+    Parameters:
+    packet_size(int): The size of the packet.
+
+    Returns:
+    float: The delay in seconds, 0 if the packet can be sent now.
+    """
+
+    def time_until_send(self, packet_size):
+        self.refill()
+        if self.tokens >= min(packet_size, self.capacity):
+            return 0
+        return (min(packet_size, self.capacity) - self.tokens) / self.pacing_rate
+
+    def burst_packets(self, packet_size):
+        # The number of packets of the given size that can be sent now, at least one
+        self.refill()
+        return max(1, int(self.tokens // packet_size))
+
+    def on_packet_sent(self, packet_size):
+        # The bucket may go negative, the next packets wait until it is refilled
+        self.refill()
+        self.tokens -= packet_size
@@ -0,0 +1,213 @@
+"""
+This file contains the packet histories of the QUIC protocol.
+The sent packet history stores the packets in flight ordered by packet number, so the loss detection and the
+ack processing only touch the packets they affect instead of scanning every packet in flight:
+1. The lost packets are found from the oldest packet and the scan stops at the first packet that is not lost.
+2. The packets acknowledged by an ack range are found with a binary search.
+Removed packets are dropped lazily from the ordered list, which is compacted when most of it is removed packets.
+The ack range set stores the received packet numbers as sorted intervals, which are sent in the ack frames.
+"""
+import bisect
+from QUIC_Packet import AckRange
+
+
+class SentPacketHistory:
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self):
+        # Maps the packet number to the packet record (frames, send time, packet size)
+        self.packets = {}
+        # The packet numbers in increasing order, may still contain removed packets
+        self.packet_numbers = []
+        # The index of the first packet number that may still be in the history
+        self.head = 0
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __contains__(self, packet_number):
+        return packet_number in self.packets
+
+    def __getitem__(self, packet_number):
+        return self.packets[packet_number]
+
+    def __iter__(self):
+        for packet_number, _ in self.items():
+            yield packet_number
+
+    def add(self, packet_number, record):
+        if not self.packet_numbers or packet_number > self.packet_numbers[-1]:
+            self.packet_numbers.append(packet_number)
+        elif packet_number not in self.packets:
+            # A packet number that was allocated before a newer one was added
+            bisect.insort(self.packet_numbers, packet_number, lo=self.head)
+        self.packets[packet_number] = record
+
+    def pop(self, packet_number, *default):
+        record = self.packets.pop(packet_number, *default)
+        self.trim()
+        return record
+
+    def clear(self):
+        self.packets.clear()
+        self.packet_numbers = []
+        self.head = 0
+
+    def trim(self):
+        # Skip the removed packets at the head of the list
+        while self.head < len(self.packet_numbers) and self.packet_numbers[self.head] not in self.packets:
+            self.head += 1
+        removed = len(self.packet_numbers) - self.head - len(self.packets)
+        if removed > max(self.COMPACT_THRESHOLD, len(self.packets)):
+            self.packet_numbers = [packet_number for packet_number in self.packet_numbers[self.head:]
+                                   if packet_number in self.packets]
+            self.head = 0
+        elif self.head > self.COMPACT_THRESHOLD and self.head * 2 > len(self.packet_numbers):
+            del self.packet_numbers[:self.head]
+            self.head = 0
+
+    """
+    This function iterates the packets from the oldest packet number.
+    The history must not be modified during the iteration.
+    """
+
+    def items(self):
+        for index in range(self.head, len(self.packet_numbers)):
+            packet_number = self.packet_numbers[index]
+            record = self.packets.get(packet_number)
+            if record is not None:
+                yield packet_number, record
+
+    def values(self):
+        for _, record in self.items():
+            yield record
+
+    def oldest(self, count):
+        oldest_packets = []
+        for packet_number, _ in self.items():
+            if len(oldest_packets) == count:
+                break
+            oldest_packets.append(packet_number)
+        return oldest_packets
+
+    """
+    This function finds the packets in the history that are inside a range of packet numbers.
+
+    Parameters:
+    start(int): The first packet number of the range.
+    end(int): The last packet number of the range.
+
+    Returns:
+    list: The packet numbers in the range.
+    """
+
+    def in_range(self, start, end):
+        first = bisect.bisect_left(self.packet_numbers, start, lo=self.head)
+        last = bisect.bisect_right(self.packet_numbers, end, lo=first)
+        return [packet_number for packet_number in self.packet_numbers[first:last] if packet_number in self.packets]
+
+
+"""
+This class stores the received packet numbers as a sorted set of disjoint intervals.
+A packet number is added with a binary search, and it is merged with the neighbor intervals it touches,
+so filling a gap coalesces the two intervals around it into one.
+The intervals are converted to the AckRange list of the ack frame, where the gap of each range is the
+number of missing packet numbers between it and the previous range minus one (the first range has gap 0).
+The set is bounded: it keeps at most max_ranges intervals (the oldest interval is dropped first),
+and prune() drops the packet numbers that the peer no longer needs to be told about.
+"""
+
+
+class AckRangeSet:
+
+    def __init__(self, max_ranges=None):
+        self.max_ranges = max_ranges
+        # The first and last packet numbers of each interval, in increasing order
+        self.starts = []
+        self.ends = []
+        # The packet numbers below it were dropped from the set and are considered already received
+        self.lowest_tracked = 0
+        # The AckRange list of the current intervals, rebuilt only after a change
+        self.cached_ack_ranges = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def __contains__(self, packet_number):
+        index = bisect.bisect_right(self.starts, packet_number) - 1
+        return index >= 0 and packet_number <= self.ends[index]
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    """
+    This function adds a packet number to the set.
+
+    Parameters:
+    packet_number(int): The received packet number.
+
+    Returns:
+    bool: True if the packet number is new, False if it was already in the set.
+    """
+
+    def add(self, packet_number):
+        if packet_number < self.lowest_tracked:
+            return False
+        # The interval that starts at or before the packet number
+        index = bisect.bisect_right(self.starts, packet_number) - 1
+        if index >= 0 and packet_number <= self.ends[index]:
+            return False
+        merge_previous = index >= 0 and self.ends[index] == packet_number - 1
+        merge_next = index + 1 < len(self.starts) and self.starts[index + 1] == packet_number + 1
+        if merge_previous and merge_next:
+            # The packet number fills the gap between the two intervals
+            self.ends[index] = self.ends[index + 1]
+            del self.starts[index + 1]
+            del self.ends[index + 1]
+        elif merge_previous:
+            self.ends[index] = packet_number
+        elif merge_next:
+            self.starts[index + 1] = packet_number
+        else:
+            self.starts.insert(index + 1, packet_number)
+            self.ends.insert(index + 1, packet_number)
+            if self.max_ranges is not None and len(self.starts) > self.max_ranges:
+                self.prune(self.ends[0])
+        self.cached_ack_ranges = None
+        return True
+
+    """
+    This function drops the packet numbers up to a packet number from the set.
+
+    Parameters:
+    packet_number(int): The largest packet number to drop.
+    """
+
+    def prune(self, packet_number):
+        if packet_number < self.lowest_tracked:
+            return
+        self.lowest_tracked = packet_number + 1
+        # The intervals that end at or before the packet number are dropped, an interval around it is cut
+        index = bisect.bisect_right(self.ends, packet_number)
+        del self.starts[:index]
+        del self.ends[:index]
+        if self.starts and self.starts[0] <= packet_number:
+            self.starts[0] = packet_number + 1
+        self.cached_ack_ranges = None
+
+    def largest(self):
+        return self.ends[-1] if self.ends else None
+
+    def to_ack_ranges(self):
+        if self.cached_ack_ranges is None:
+            ack_ranges = []
+            previous_end = None
+            for start, end in zip(self.starts, self.ends):
+                gap = 0 if previous_end is None else start - previous_end - 2
+                ack_ranges.append(AckRange(gap, (start, end)))
+                previous_end = end
+            self.cached_ack_ranges = ack_ranges
+        return self.cached_ack_ranges
@@ -0,0 +1,143 @@
+"""
+This file contains the path MTU discovery of the QUIC protocol (DPLPMTUD, RFC 8899 and RFC 9000 section 14.3).
+Datagrams larger than the path MTU are fragmented by IP, and the loss of a single fragment loses the whole packet.
+So the sender starts with 1200-byte datagrams (the smallest size every QUIC path supports) and probes larger sizes:
+1. The socket sets the Don't Fragment bit, so a datagram larger than the path MTU is dropped instead of fragmented,
+   and a datagram larger than the MTU of the local interface is refused right away with EMSGSIZE.
+2. A probe is a PING frame padded to the probed size. It is not retransmitted and its loss is not a congestion signal.
+3. An acknowledged probe raises the datagram size, and a size that is lost MAX_PROBES times bounds the search.
+The first probe is the largest size, then the search is a binary search between the acknowledged and the failed sizes.
+Below the path MTU, the packet size controller adapts the datagram size to the observed loss:
+a lost large datagram costs a large retransmission, so the datagrams shrink as the loss rate grows.
+"""
+import math
+import sys
+from socket import IPPROTO_IP
+
+# Linux values, the socket module does not export them
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_DO = 2
+
+
+def set_dont_fragment(socket_fd):
+    # Set the Don't Fragment bit on every datagram sent from the socket, where the platform supports it
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        socket_fd.setsockopt(IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+    except OSError:
+        return False
+    return True
+
+
+class PathMTUDiscovery:
+    BASE_PLPMTU = 1200  # The minimum datagram size of QUIC (RFC 9000, section 14)
+    MAX_PROBES = 3  # The number of lost probes of a size before it is considered too big
+    SEARCH_GRANULARITY = 16  # The search stops when the bounds are closer than this
+
+    def __init__(self, max_plpmtu):
+        # The largest datagram size that was acknowledged, the packetizer uses it
+        self.plpmtu = self.BASE_PLPMTU
+        # The largest datagram size that may still work
+        self.max_plpmtu = max_plpmtu
+        self.probe_count = 0
+        self.probed_sizes = 0
+
+    def is_complete(self):
+        return self.max_plpmtu - self.plpmtu < self.SEARCH_GRANULARITY
+
+    """
+    This function chooses the size of the next probe.
+
+    Returns:
+    int: The datagram size to probe, None if the search is complete.
+    """
+
+    def next_probe_size(self):
+        if self.is_complete():
+            return None
+        if self.probed_sizes == 0:
+            # Optimistic first probe, on a path with a large MTU (loopback) the search ends after one probe
+            return self.max_plpmtu
+        return (self.plpmtu + self.max_plpmtu + 1) // 2
+
+    def on_probe_acked(self, probe_size):
+        self.probed_sizes += 1
+        self.probe_count = 0
+        self.plpmtu = max(self.plpmtu, probe_size)
+
+    def on_probe_lost(self, probe_size):
+        self.probe_count += 1
+        if self.probe_count >= self.MAX_PROBES:
+            self.on_probe_too_big(probe_size)
+
+    def on_probe_too_big(self, probe_size):
+        # The probe size doesn't fit the path
+        self.probed_sizes += 1
+        self.probe_count = 0
+        self.max_plpmtu = min(self.max_plpmtu, probe_size - 1)
+
+
+"""
+This class chooses the size of the data packets from the loss rate and the congestion window.
+The loss rate is estimated per sent byte, from the acknowledged and lost packets.
+When a datagram of S bytes is lost with probability 1 - (1 - loss_rate)^S, and each packet costs
+PACKET_OVERHEAD bytes besides its data, the goodput is the largest at S = sqrt(PACKET_OVERHEAD / loss_rate).
+Without loss this is the largest size the path allows.
+The congestion window (the data the path delivers per RTT) limits the size too, so the window holds enough
+packets for the packet threshold loss detection and the ack clock.
+"""
+
+
+class PacketSizeController:
+    # The cost of a packet besides its data: the headers, the ack frame and the per-packet send and receive work
+    PACKET_OVERHEAD = 1024
+    SAMPLE_PACKETS = 32  # The number of acknowledged or lost packets in a loss rate sample
+    LOSS_RATE_GAIN = 0.25  # The weight of a new sample in the loss rate average
+    MIN_PACKETS_PER_WINDOW = 4  # One more than the packet threshold of the loss detection
+    SIZE_STEP = 256  # The chosen sizes are rounded down to this step, so they don't change on every sample
+
+    def __init__(self, min_size=PathMTUDiscovery.BASE_PLPMTU):
+        self.min_size = min_size
+        # The estimated number of lost packets per sent byte
+        self.loss_rate = 0.0
+        self.sample_packets = 0
+        self.sample_lost = 0
+        self.sample_bytes = 0
+
+    def on_packet_acked(self, packet_size):
+        self.add_sample(packet_size, False)
+
+    def on_packet_lost(self, packet_size):
+        self.add_sample(packet_size, True)
+
+    def add_sample(self, packet_size, lost):
+        self.sample_packets += 1
+        self.sample_bytes += packet_size
+        if lost:
+            self.sample_lost += 1
+        if self.sample_packets >= self.SAMPLE_PACKETS:
+            sample = self.sample_lost / self.sample_bytes
+            self.loss_rate += self.LOSS_RATE_GAIN * (sample - self.loss_rate)
+            self.sample_packets = 0
+            self.sample_lost = 0
+            self.sample_bytes = 0
+
+    """
+    This function chooses the datagram size of the next data packets.
+
+    Parameters:
+    max_size(int): The largest datagram size of the path.
+    congestion_window(int): The current congestion window in bytes.
+
+    Returns:
+    int: The datagram size, between the minimum size and max_size.
+    """
+
+    def datagram_size(self, max_size, congestion_window):
+        size = min(max_size, congestion_window // self.MIN_PACKETS_PER_WINDOW)
+        if self.loss_rate > 0:
+            size = min(size, int(math.sqrt(self.PACKET_OVERHEAD / self.loss_rate)))
+        if size < max_size:
+            size -= size % self.SIZE_STEP
+        return min(max(size, self.min_size), max_size)
@@ -57,14 +57,19 @@ class QUICLongHeader(QUICHeader):
 class QUICFrame(ABC):
     def __init__(self, frame_type):
         self.frame_type = frame_type
+        # The wire encoding of the frame without the stream data, cached by the codec for the retransmissions.
+        # The frame must not be changed after it is encoded.
+        self.encoded = None
 
     def __getstate__(self):
-        # Convert the object to a dictionary
+        # Convert the object to a dictionary, the cached encoding is not pickled
         state = self.__dict__.copy()
+        state.pop("encoded", None)
         return state
 
     def __setstate__(self, state):
         # Restore the object's state from the dictionary
+        self.encoded = None
         self.__dict__.update(state)
 
     def get_frame_type(self):
@@ -76,27 +81,86 @@ class QUICFrame(ABC):
 
 
 class QUICStreamFrame(QUICFrame):
-    def __init__(self, frame_type, data, data_length=None):
+    def __init__(self, frame_type, data, data_length=None, offset=0):
         super().__init__(frame_type)
         self.data = data
         self.data_length = data_length
+        # The offset of the data in the stream, the receiver reassembles the stream by it
+        self.offset = offset
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # A memoryview can't be pickled, the data sliced from a send source is copied
+        if isinstance(state["data"], memoryview):
+            state["data"] = state["data"].tobytes()
+        return state
 
     def __str__(self):
-        return f"Frame Type: {self.frame_type}, Data: {self.data}, Data Length: {self.data_length}"
+        return (f"Frame Type: {self.frame_type}, Offset: {self.offset}, Data: {self.data}, "
+                f"Data Length: {self.data_length}")
 
     __repr__ = __str__
 
 
 class QUICAckFrame(QUICFrame):
-    def __init__(self, frame_type, largest_acknowledged, ack_delay, ack_ranges):
+    def __init__(self, frame_type, largest_acknowledged, ack_delay, ack_ranges, ecn_counts=None):
         super().__init__(frame_type)
         self.largest_acknowledged = largest_acknowledged
         self.ack_delay = ack_delay
         self.ack_ranges = ack_ranges
+        # The number of packets received with the ECT(0), ECT(1) and CE marks, None if the receiver doesn't read them
+        self.ecn_counts = ecn_counts
+
+    def __setstate__(self, state):
+        # The frames pickled before the ECN counts existed have none
+        self.ecn_counts = None
+        super().__setstate__(state)
 
     def __str__(self):
         return (f"Frame Type: {self.frame_type}, Largest Acknowledged: {self.largest_acknowledged}, "
-                f"Ack Delay: {self.ack_delay}, Ack Ranges: {self.ack_ranges}")
+                f"Ack Delay: {self.ack_delay}, Ack Ranges: {self.ack_ranges}, ECN Counts: {self.ecn_counts}")
+
+    __repr__ = __str__
+
+
+class QUICAckFrequencyFrame(QUICFrame):
+    # Sent by the sender to change how often the receiver acknowledges (draft-ietf-quic-ack-frequency)
+    def __init__(self, frame_type, sequence_number, ack_eliciting_threshold, request_max_ack_delay):
+        super().__init__(frame_type)
+        # Only the frame with the largest sequence number is applied, retransmitted old frames are ignored
+        self.sequence_number = sequence_number
+        # The number of ack-eliciting packets the receiver may receive before it sends an ack
+        self.ack_eliciting_threshold = ack_eliciting_threshold
+        # The maximum time in seconds the receiver may delay an ack
+        self.request_max_ack_delay = request_max_ack_delay
+
+    def __str__(self):
+        return (f"Frame Type: {self.frame_type}, Sequence Number: {self.sequence_number}, "
+                f"Ack-Eliciting Threshold: {self.ack_eliciting_threshold}, "
+                f"Request Max Ack Delay: {self.request_max_ack_delay}")
+
+    __repr__ = __str__
+
+
+class QUICPingFrame(QUICFrame):
+    # An empty ack-eliciting frame, it makes the receiver acknowledge the packet (used by the path MTU probes)
+    def __init__(self, frame_type):
+        super().__init__(frame_type)
+
+    def __str__(self):
+        return f"Frame Type: {self.frame_type}"
+
+    __repr__ = __str__
+
+
+class QUICPaddingFrame(QUICFrame):
+    # Zero bytes that fill a packet up to a size, it is not ack-eliciting
+    def __init__(self, frame_type, length):
+        super().__init__(frame_type)
+        self.length = length
+
+    def __str__(self):
+        return f"Frame Type: {self.frame_type}, Length: {self.length}"
 
     __repr__ = __str__
 
@@ -0,0 +1,139 @@
+"""
+This file contains the datagram receive engine of the QUIC protocol.
+Reading one datagram per wakeup and processing it fully before the next read costs a system call and the
+per-packet work (ack decision, timers) for every datagram. The receive engine cuts this down:
+1. UDP GRO (Linux): the kernel coalesces the queued datagrams of a flow that have the same size into one buffer,
+   which is read with a single recvmsg call. The segment size is reported in a control message,
+   and the buffer is split back into the datagrams by it.
+2. Burst drain: on each wakeup, every queued datagram is read with non-blocking reads, so the caller can
+   process the whole batch and decide about the ack and the timers once.
+The datagrams are read one after the other into a preallocated arena, and returned as memoryview slices of it,
+so the datagrams of a batch stay valid until the next batch is read.
+With ECN, the TOS byte of every read is reported in a control message too (IP_RECVTOS), and the receiver
+counts the datagrams by their ECN codepoint. The ack frames carry the counts back to the sender.
+"""
+import struct
+import sys
+from socket import IPPROTO_UDP, IPPROTO_IP, IPPROTO_IPV6, MSG_DONTWAIT, CMSG_SPACE, AF_INET6, IP_TOS, IP_RECVTOS, \
+    IPV6_TCLASS, IPV6_RECVTCLASS
+from QUIC_Sender import ECN_ECT0, ECN_ECT1, ECN_CE, ECN_MASK
+
+# Linux value, the socket module does not export it
+UDP_GRO = 104
+
+
+def enable_gro(socket_fd):
+    if not sys.platform.startswith("linux") or not hasattr(socket_fd, "recvmsg_into"):
+        return False
+    try:
+        socket_fd.setsockopt(IPPROTO_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+
+def enable_ecn_receive(socket_fd):
+    # Report the TOS byte (the traffic class for IPv6) of every received datagram
+    if not hasattr(socket_fd, "recvmsg_into"):
+        return False
+    try:
+        if socket_fd.family == AF_INET6:
+            socket_fd.setsockopt(IPPROTO_IPV6, IPV6_RECVTCLASS, 1)
+        else:
+            socket_fd.setsockopt(IPPROTO_IP, IP_RECVTOS, 1)
+    except OSError:
+        return False
+    return True
+
+
+class DatagramReceiver:
+    READ_SIZE = 65536  # The room for one read: a datagram, or the coalesced datagrams of a GRO read
+    ARENA_SIZE = 16 * READ_SIZE
+
+    def __init__(self, socket_fd, use_gro=True, use_ecn=False):
+        self.socket_fd = socket_fd
+        self.gro_enabled = use_gro and enable_gro(socket_fd)
+        self.ecn_enabled = use_ecn and enable_ecn_receive(socket_fd)
+        # The control messages of the GRO segment size and of the TOS byte (an int at most)
+        self.ancillary_size = (CMSG_SPACE(struct.calcsize("i")) if self.gro_enabled else 0) + \
+            (CMSG_SPACE(struct.calcsize("i")) if self.ecn_enabled else 0)
+        # The number of datagrams received with the ECT(0), ECT(1) and CE codepoints
+        self.ecn_counts = [0, 0, 0]
+        # Preallocated arena, the datagrams of a batch are read into it one after the other
+        self.arena = bytearray(self.ARENA_SIZE)
+        self.arena_view = memoryview(self.arena)
+        # The end of the data of the current batch in the arena
+        self.position = 0
+        # The datagrams of the last GRO read that were not returned yet, with their address
+        self.pending = []
+        # The receive stats: the system calls and the datagrams
+        self.syscalls = 0
+        self.datagrams_received = 0
+
+    def read(self, flags):
+        # Read into the arena after the datagrams of the current batch, and split a GRO buffer into its datagrams
+        view = self.arena_view[self.position:self.position + self.READ_SIZE]
+        self.syscalls += 1
+        segment_size = 0
+        codepoint = None
+        if self.ancillary_size:
+            bytes_received, ancillary_data, _, address = self.socket_fd.recvmsg_into([view], self.ancillary_size,
+                                                                                    flags)
+            for level, message_type, data in ancillary_data:
+                if level == IPPROTO_UDP and message_type == UDP_GRO:
+                    segment_size = struct.unpack("i", data[:struct.calcsize("i")])[0]
+                elif (level, message_type) in ((IPPROTO_IP, IP_TOS), (IPPROTO_IPV6, IPV6_TCLASS)):
+                    # A byte for IPv4, an int for IPv6
+                    codepoint = data[0] & ECN_MASK if len(data) == 1 else struct.unpack("i", data[:4])[0] & ECN_MASK
+        else:
+            bytes_received, address = self.socket_fd.recvfrom_into(view, 0, flags)
+        if segment_size <= 0:
+            segment_size = max(bytes_received, 1)
+        datagrams = [view[start:min(start + segment_size, bytes_received)]
+                     for start in range(0, bytes_received, segment_size)] or [view[:0]]
+        self.position += bytes_received
+        self.datagrams_received += len(datagrams)
+        # The kernel coalesces only the datagrams with the same TOS byte
+        if codepoint in (ECN_ECT0, ECN_ECT1, ECN_CE):
+            self.ecn_counts[(ECN_ECT0, ECN_ECT1, ECN_CE).index(codepoint)] += len(datagrams)
+        return [(datagram, address) for datagram in datagrams]
+
+    """
+    This function receives one datagram.
+
+    Parameters:
+    flags(int): The flags of the read, MSG_DONTWAIT to raise BlockingIOError if nothing is queued.
+
+    Returns:
+    Tuple: The memoryview of the datagram, valid until the next call, and the address of the peer.
+    """
+
+    def receive(self, flags=0):
+        if not self.pending:
+            self.position = 0
+            self.pending = self.read(flags)
+        return self.pending.pop(0)
+
+    """
+    This function receives a batch of datagrams: it waits for the first one (up to the socket timeout),
+    then drains the datagrams that are already queued without blocking.
+
+    Parameters:
+    max_datagrams(int): The maximum number of datagrams of the batch.
+
+    Returns:
+    list: The (datagram, address) tuples of the batch, the datagrams are valid until the next call.
+    """
+
+    def receive_burst(self, max_datagrams):
+        if not self.pending:
+            self.position = 0
+            self.pending = self.read(0)
+        datagrams = self.pending
+        self.pending = []
+        while len(datagrams) < max_datagrams and self.position + self.READ_SIZE <= self.ARENA_SIZE:
+            try:
+                datagrams.extend(self.read(MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+        return datagrams
@@ -0,0 +1,243 @@
+"""
+This file contains the datagram send backend of the QUIC protocol.
+Every datagram sent with sendmsg or sendto costs one system call, which dominates the send cost once the
+datagrams are only as large as the path MTU. On Linux, UDP generic segmentation offload (GSO) sends a run of
+equal-size datagrams with a single sendmsg call:
+1. The datagrams are passed as one buffer (the scatter-gather list of all their parts).
+2. The UDP_SEGMENT control message tells the kernel the segment size, and the kernel (or the network card)
+   cuts the buffer into datagrams of that size. Only the last datagram may be shorter.
+The support is detected at runtime (getsockopt of UDP_SEGMENT). A GSO send that the kernel refuses turns GSO off,
+and the datagrams are sent one by one, as on the platforms without GSO.
+The opt-in zerocopy mode (MSG_ZEROCOPY, Linux) also removes the copy of the data into the kernel:
+1. The socket sets SO_ZEROCOPY, and the sends of at least zerocopy_min_bytes pass MSG_ZEROCOPY.
+   The kernel pins the pages of the buffers and reads them while the datagrams are transmitted.
+2. The buffers must not be freed or changed until the kernel is done with them. The sender keeps a reference
+   to every buffer of a zerocopy send, until its completion notification arrives on the socket error queue.
+3. The kernel numbers the zerocopy sends of a socket from 0, and a notification completes a range of them.
+Small sends cost more to pin and to notify than to copy, and on loopback the kernel copies the data anyway
+(the notification reports it), so the mode pays off only for large datagrams sent through a network card.
+A zerocopy send that the kernel refuses (too many notifications pending, or too many unaligned buffers
+for the fragments of one datagram) is sent again with a copy.
+QUIC_Benchmark.py measures the size from which it beats the copying sends on a given path.
+Every datagram is marked ECT(0) (ECN capable, RFC 3168) through the TOS byte of the socket, so a router whose queue
+builds up can mark it CE (congestion experienced) instead of dropping it.
+"""
+import errno
+import select
+import struct
+import sys
+from socket import IPPROTO_UDP, IPPROTO_IP, IPPROTO_IPV6, SOL_SOCKET, MSG_ERRQUEUE, MSG_DONTWAIT, CMSG_SPACE, \
+    AF_INET6, IP_TOS, IPV6_TCLASS
+
+# Linux values, the socket module does not export them
+UDP_SEGMENT = 103
+UDP_MAX_SEGMENTS = 64  # The maximum number of segments in a GSO send
+GSO_MAX_BYTES = 65507  # The whole run must fit in the largest UDP datagram
+IOV_MAX = 1024  # The maximum number of buffers of a sendmsg call
+SO_ZEROCOPY = 60
+MSG_ZEROCOPY = 0x4000000
+IP_RECVERR = 11
+IPV6_RECVERR = 25
+SO_EE_ORIGIN_ZEROCOPY = 5
+SO_EE_CODE_ZEROCOPY_COPIED = 1
+# struct sock_extended_err: errno, origin, type, code, pad, info, data.
+# A zerocopy notification completes the sends numbered from info to data.
+SOCK_EXTENDED_ERR = struct.Struct("=IBBBBII")
+# The smallest send that is not copied. A chosen default, tune it with QUIC_Benchmark.py on the network card
+ZEROCOPY_MIN_BYTES = 32768
+ZEROCOPY_WAIT_TIMEOUT = 1000  # The time in milliseconds of one wait for the completion notifications
+# The ECN codepoints, the two low bits of the TOS byte (RFC 3168)
+ECN_NOT_ECT = 0x00
+ECN_ECT1 = 0x01
+ECN_ECT0 = 0x02
+ECN_CE = 0x03
+ECN_MASK = 0x03
+
+
+def gso_supported(socket_fd):
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        socket_fd.getsockopt(IPPROTO_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+
+def enable_zerocopy(socket_fd):
+    if not sys.platform.startswith("linux") or not hasattr(socket_fd, "sendmsg"):
+        return False
+    try:
+        socket_fd.setsockopt(SOL_SOCKET, SO_ZEROCOPY, 1)
+    except OSError:
+        return False
+    return True
+
+
+def set_ecn_marking(socket_fd, codepoint):
+    # Set the ECN codepoint of every datagram sent from the socket, the DSCP bits are kept
+    if socket_fd.family == AF_INET6:
+        level, option = IPPROTO_IPV6, IPV6_TCLASS
+    else:
+        level, option = IPPROTO_IP, IP_TOS
+    try:
+        tos = socket_fd.getsockopt(level, option)
+        socket_fd.setsockopt(level, option, (tos & ~ECN_MASK) | codepoint)
+    except OSError:
+        return False
+    return True
+
+
+class DatagramSender:
+
+    def __init__(self, socket_fd, use_gso=True, use_zerocopy=False, zerocopy_min_bytes=ZEROCOPY_MIN_BYTES,
+                 use_ecn=False):
+        self.socket_fd = socket_fd
+        self.gso_enabled = use_gso and gso_supported(socket_fd)
+        # Mark the datagrams ECT(0)
+        self.ecn_enabled = use_ecn and set_ecn_marking(socket_fd, ECN_ECT0)
+        self.zerocopy_enabled = use_zerocopy and enable_zerocopy(socket_fd)
+        self.zerocopy_min_bytes = zerocopy_min_bytes
+        # The number the kernel gives to the next zerocopy send, and the buffers of the sends that are not complete
+        self.next_zerocopy_id = 0
+        self.pinned_buffers = {}
+        # The room for one notification: the extended error and the address of the sender of the error
+        self.notification_size = CMSG_SPACE(SOCK_EXTENDED_ERR.size + 28)
+        # The send stats: the system calls, the datagrams and the bytes
+        self.syscalls = 0
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+        # The zerocopy stats: the zerocopy sends, and the ones whose data the kernel copied anyway
+        self.zerocopy_sends = 0
+        self.zerocopy_copied = 0
+
+    """
+    This function sends the buffers of one sendmsg call, without copying them if they are large enough.
+
+    Parameters:
+    parts(list): The buffers of the call.
+    ancillary_data(list): The control messages of the call.
+    receiver_address(Tuple): The address of the receiver.
+
+    Returns:
+    int: The number of bytes sent.
+    """
+
+    def sendmsg(self, parts, ancillary_data, receiver_address):
+        if self.zerocopy_enabled and sum(len(part) for part in parts) >= self.zerocopy_min_bytes:
+            try:
+                bytes_sent = self.socket_fd.sendmsg(parts, ancillary_data, MSG_ZEROCOPY, receiver_address)
+            except OSError as error:
+                # ENOBUFS: too many zerocopy sends are waiting for their notification.
+                # EMSGSIZE: the pinned pages of the buffers don't fit the fragments of one datagram,
+                # which is not a path MTU limit. In both cases the same buffers are sent with a copy.
+                if error.errno not in (errno.ENOBUFS, errno.EMSGSIZE):
+                    raise
+                self.reap_completions()
+            else:
+                # The kernel reads the buffers after the call returns
+                self.pinned_buffers[self.next_zerocopy_id] = parts
+                self.next_zerocopy_id = (self.next_zerocopy_id + 1) % 2 ** 32
+                self.zerocopy_sends += 1
+                return bytes_sent
+        return self.socket_fd.sendmsg(parts, ancillary_data, 0, receiver_address)
+
+    """
+    This function reads the zerocopy completion notifications from the socket error queue without blocking,
+    and releases the buffers of the completed sends.
+
+    Returns:
+    int: The number of sends that are still not complete.
+    """
+
+    def reap_completions(self):
+        while self.pinned_buffers:
+            try:
+                _, ancillary_data, _, _ = self.socket_fd.recvmsg(0, self.notification_size,
+                                                                 MSG_ERRQUEUE | MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            for level, message_type, data in ancillary_data:
+                if (level, message_type) not in ((IPPROTO_IP, IP_RECVERR), (IPPROTO_IPV6, IPV6_RECVERR)):
+                    continue
+                _, origin, _, code, _, first, last = SOCK_EXTENDED_ERR.unpack_from(data)
+                if origin != SO_EE_ORIGIN_ZEROCOPY:
+                    continue
+                # The range of sends may wrap around the 32-bit counter
+                for offset in range((last - first) % 2 ** 32 + 1):
+                    self.pinned_buffers.pop((first + offset) % 2 ** 32, None)
+                if code & SO_EE_CODE_ZEROCOPY_COPIED:
+                    self.zerocopy_copied += (last - first) % 2 ** 32 + 1
+        return len(self.pinned_buffers)
+
+    """
+    This function waits until the kernel is done with the buffers of every zerocopy send.
+    It must be called before the buffers are freed or changed, e.g. before a sent file mapping is closed.
+    """
+
+    def wait_for_completions(self):
+        if not self.pinned_buffers:
+            return
+        # The notifications raise POLLERR, which poll reports without being asked for
+        poller = select.poll()
+        poller.register(self.socket_fd, 0)
+        while self.reap_completions():
+            poller.poll(ZEROCOPY_WAIT_TIMEOUT)
+
+    """
+    This function sends one datagram.
+
+    Parameters:
+    packet_parts(list): The buffers of the datagram, the kernel gathers them.
+    receiver_address(Tuple): The address of the receiver.
+
+    Returns:
+    int: The number of bytes sent.
+    """
+
+    def send(self, packet_parts, receiver_address):
+        self.syscalls += 1
+        # Scatter-gather send: the kernel gathers the buffers into one datagram
+        if hasattr(self.socket_fd, "sendmsg"):
+            bytes_sent = self.sendmsg(packet_parts, [], receiver_address)
+        else:
+            bytes_sent = self.socket_fd.sendto(b"".join(packet_parts), receiver_address)
+        self.datagrams_sent += 1
+        self.bytes_sent += bytes_sent
+        return bytes_sent
+
+    def max_segments(self, segment_size):
+        # The number of datagrams of the segment size that one send can carry
+        if not self.gso_enabled:
+            return 1
+        return max(1, min(UDP_MAX_SEGMENTS, GSO_MAX_BYTES // segment_size))
+
+    """
+    This function sends a run of datagrams, with a single GSO send when possible.
+
+    Parameters:
+    datagrams(list): The buffer lists of the datagrams. Every datagram but the last is segment_size bytes.
+    segment_size(int): The size of the datagrams.
+    receiver_address(Tuple): The address of the receiver.
+
+    Returns:
+    int: The number of bytes sent.
+    """
+
+    def send_batch(self, datagrams, segment_size, receiver_address):
+        parts = [part for packet_parts in datagrams for part in packet_parts]
+        # A run with more buffers than a sendmsg call takes is sent one datagram at a time
+        if self.gso_enabled and len(datagrams) > 1 and len(parts) <= IOV_MAX:
+            try:
+                self.syscalls += 1
+                bytes_sent = self.sendmsg(parts, [(IPPROTO_UDP, UDP_SEGMENT, struct.pack("=H", segment_size))],
+                                          receiver_address)
+                self.datagrams_sent += len(datagrams)
+                self.bytes_sent += bytes_sent
+                return bytes_sent
+            except OSError as error:
+                if error.errno not in (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP):
+                    raise
+                # The kernel or the device can't segment the datagrams, send them one by one from now on
+                self.gso_enabled = False
+        return sum(self.send(packet_parts, receiver_address) for packet_parts in datagrams)
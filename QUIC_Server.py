@@ -1,8 +1,10 @@
+import argparse
 import struct
 from socket import *
 import time
 import Utils
 from QUIC_API import *
+from QUIC_Stream import FileStreamSource
 # from QUIC_API_Based_number_packet import *
 # from QUIC_API_Based_time import *
 
@@ -15,9 +17,15 @@ from QUIC_API import *
 
 class QUIC_Server:
     # The QUIC server class
-    def __init__(self, server_port):
+    def __init__(self, server_port, max_datagram_size=None, use_gso=True, use_zerocopy=False):
         # The constructor
         self.server_port = server_port
+        # The size of the data packets, None to discover the path MTU
+        self.max_datagram_size = max_datagram_size
+        # Send runs of data packets with UDP GSO where the kernel supports it
+        self.use_gso = use_gso
+        # Send the large datagrams with MSG_ZEROCOPY, the file mapping is not copied into the kernel
+        self.use_zerocopy = use_zerocopy
         self.server_address = ('', self.server_port)
         self.total_bytes_sent = 0
         self.quic_connection = None
@@ -43,28 +51,24 @@ class QUIC_Server:
                                      struct.pack('ll', int(MAX_TIME_WAIT), int(timeout_microseconds)))
         
         print("Waiting for QUIC connection request from the client...")
-        self.quic_connection = QUIC_Protocol(self.serverSocket, self.server_address)
+        self.quic_connection = QUIC_Protocol(self.serverSocket, self.server_address,
+                                             max_datagram_size=self.max_datagram_size, use_gso=self.use_gso,
+                                             use_zerocopy=self.use_zerocopy)
         print("Created the QUIC connection object")
 
     def file_transfer(self):
         FILE_SIZE = 10 * 1024 * 1024
-        BUFFER_SIZE = 60 * 1024
         while True:
-            bytes_sent = 0
-            bytes_received = 0
             self.total_bytes_sent = 0
-            message_buffer = []
 
-            # Read the file to buffer
             # Start counting the time
             start_time = time.time()
-            with open('10MB_file.bin', 'rb') as f:
-                while True:
-                    data = f.read(BUFFER_SIZE)
-                    if not data:
-                        break
-                    bytes_sent = self.quic_connection.QUIC_send_data(data, self.quic_connection.client_address)
-                    self.total_bytes_sent += bytes_sent
+            # The file is memory-mapped and sent without copying it into frames
+            with FileStreamSource('10MB_file.bin') as source:
+                bytes_sent = self.quic_connection.QUIC_send_source(source, self.quic_connection.client_address)
+                self.total_bytes_sent += bytes_sent
+                # Wait for the acks of the packets that are still in flight, the lost packets are read from the source
+                self.quic_connection.QUIC_flush(self.quic_connection.client_address)
             # print(f"Total bytes sent: {total_bytes_sent}")
             if self.total_bytes_sent >= FILE_SIZE:
                 print("File sent successfully")
@@ -77,6 +81,13 @@ class QUIC_Server:
         total_bands = total_mb / time_taken
         print(f"Time taken to send the file: {time_taken} seconds")
         print(f"Total bandwidth: {total_bands} MB/s")
+        stats = self.quic_connection.QUIC_get_stats()
+        print(f"Send syscalls per MB: {stats['syscalls_per_mb']:.1f} (GSO {'on' if stats['gso'] else 'off'})")
+        if stats['zerocopy']:
+            print(f"Zerocopy sends: {stats['zerocopy_sends']}, copied by the kernel: {stats['zerocopy_copied']}")
+        if stats['ecn']:
+            print(f"ECN congestion events: {stats['ecn_congestion_events']} (CE count {stats['peer_ce_count']})")
+        print(f"Connection stats: {stats}")
 
     def accept_connection(self):
         self.quic_connection.QUIC_accept_connection()
@@ -92,8 +103,16 @@ class QUIC_Server:
 if __name__ == '__main__':
     # The server port
     serverPort = 12000
+    parser = argparse.ArgumentParser()
+    # An explicit datagram size turns off the path MTU discovery, e.g. 65507 for loopback benchmarks
+    parser.add_argument("max_datagram_size", type=int, nargs="?")
+    # Send every datagram with its own system call, to compare the syscalls per MB with and without GSO
+    parser.add_argument("--no-gso", action="store_true")
+    # Send the large datagrams without copying them (MSG_ZEROCOPY), see QUIC_Benchmark.py for the size threshold
+    parser.add_argument("--zerocopy", action="store_true")
+    arguments = parser.parse_args()
     # Instantiate the server object
-    server = QUIC_Server(serverPort)
+    server = QUIC_Server(serverPort, arguments.max_datagram_size, not arguments.no_gso, arguments.zerocopy)
     # Start the server
     server.start_server()
     # Accept the connection
@@ -0,0 +1,316 @@
+"""
+This file contains the receive side of the stream of the QUIC protocol.
+Every stream frame carries the offset of its data in the stream, so the receiver can put the data back in order
+no matter in which order the packets arrive, and the retransmitted data that was already received is dropped.
+The reassembly buffer releases the data to the application only in stream order:
+1. Data at the next expected offset is released right away, without being copied.
+2. Data after a gap is copied and kept until the gap is filled, up to a bounded memory budget.
+3. Data that was already released or is already buffered is dropped.
+On the send side, the file source memory-maps the file, and the sender slices the data of each packet out of
+the mapping and reads it again from the mapping when a packet is lost.
+The stream frame queues hold the data that waits to be packed into packets: the lost data (retransmission queue)
+and the new data written by the application (send queue).
+The file sink is the alternative for file transfers: every frame is written straight to its offset in the
+preallocated file, so nothing is buffered in memory whatever the reordering depth.
+"""
+import bisect
+import mmap
+import os
+from QUIC_Packet import QUICStreamFrame
+
+
+class StreamReassemblyBuffer:
+
+    def __init__(self, max_buffered_bytes):
+        # The maximum number of bytes after the read offset that are accepted, the rest is refused
+        self.max_buffered_bytes = max_buffered_bytes
+        # The offset of the next byte the application reads, everything before it was released
+        self.read_offset = 0
+        # The buffered out-of-order segments: their start offsets in increasing order and their data
+        self.offsets = []
+        self.segments = {}
+        self.buffered_bytes = 0
+        # The data released in order and not yet taken by read()
+        self.ready = []
+
+    def __len__(self):
+        return self.buffered_bytes
+
+    """
+    This function places the data of a stream frame in the buffer.
+
+    Parameters:
+    offset(int): The stream offset of the first byte of the data.
+    data(bytes): The data of the frame, a memoryview over the receive buffer is only kept until read() is called.
+
+    Returns:
+    bool: True if the data was accepted (or already received), False if it is beyond the memory budget.
+    """
+
+    def insert(self, offset, data):
+        end = offset + len(data)
+        if end > self.read_offset + self.max_buffered_bytes:
+            return False
+        if end <= self.read_offset:
+            # A duplicate of data that was already released
+            return True
+        if offset < self.read_offset:
+            data = data[self.read_offset - offset:]
+            offset = self.read_offset
+        if offset == self.read_offset and (not self.offsets or end <= self.offsets[0]):
+            # The common in-order case, the data is released without a copy
+            self.release(data)
+            self.release_buffered()
+            return True
+
+        # Copy only the gaps between the segments that are already buffered
+        index = bisect.bisect_left(self.offsets, offset)
+        position = offset
+        if index > 0:
+            previous_offset = self.offsets[index - 1]
+            position = max(position, previous_offset + len(self.segments[previous_offset]))
+        while position < end:
+            if index < len(self.offsets) and self.offsets[index] <= position:
+                # Skip the buffered segment
+                segment_offset = self.offsets[index]
+                position = max(position, segment_offset + len(self.segments[segment_offset]))
+                index += 1
+                continue
+            gap_end = min(self.offsets[index], end) if index < len(self.offsets) else end
+            self.store(index, position, bytes(data[position - offset:gap_end - offset]))
+            index += 1
+            position = gap_end
+        self.release_buffered()
+        return True
+
+    def store(self, index, offset, data):
+        self.offsets.insert(index, offset)
+        self.segments[offset] = data
+        self.buffered_bytes += len(data)
+
+    def release(self, data):
+        self.ready.append(data)
+        self.read_offset += len(data)
+
+    def release_buffered(self):
+        # Release the buffered segments that became contiguous with the read offset
+        while self.offsets and self.offsets[0] == self.read_offset:
+            data = self.segments.pop(self.offsets.pop(0))
+            self.buffered_bytes -= len(data)
+            self.release(data)
+
+    """
+    This function takes the data released in stream order since the last call.
+
+    Returns:
+    list: The released data chunks, in stream order.
+    """
+
+    def read(self):
+        ready = self.ready
+        self.ready = []
+        return ready
+
+
+"""
+This class queues stream data that waits to be sent, ordered by stream offset.
+It is used for the lost data: frames are queued instead of whole packets, so the sender can pack the lost
+data of several packets together and with new data, instead of resending every lost packet as is.
+It is also used for the new data, which the packetizer cuts to the room left in each packet.
+Adjacent ranges that are read from the send source (frames without data) are merged into one frame.
+"""
+
+
+class StreamFrameQueue:
+
+    def __init__(self):
+        # The stream offsets of the queued frames in increasing order, and the frames
+        self.offsets = []
+        self.frames = {}
+        self.queued_bytes = 0
+
+    def __len__(self):
+        return self.queued_bytes
+
+    def __bool__(self):
+        return bool(self.offsets)
+
+    def add(self, frame):
+        index = bisect.bisect_left(self.offsets, frame.offset)
+        if index > 0:
+            previous = self.frames[self.offsets[index - 1]]
+            if previous.data is None and frame.data is None and \
+                    previous.offset + previous.data_length == frame.offset:
+                previous.data_length += frame.data_length
+                previous.encoded = None
+                self.queued_bytes += frame.data_length
+                self.merge_next(index - 1)
+                return
+        self.offsets.insert(index, frame.offset)
+        queued_frame = QUICStreamFrame("Stream", frame.data, frame.data_length, frame.offset)
+        # A frame that is sent again unchanged keeps its encoding
+        queued_frame.encoded = frame.encoded
+        self.frames[frame.offset] = queued_frame
+        self.queued_bytes += frame.data_length
+        self.merge_next(index)
+
+    def merge_next(self, index):
+        if index + 1 >= len(self.offsets):
+            return
+        frame = self.frames[self.offsets[index]]
+        next_frame = self.frames[self.offsets[index + 1]]
+        if frame.data is None and next_frame.data is None and frame.offset + frame.data_length == next_frame.offset:
+            frame.data_length += next_frame.data_length
+            frame.encoded = None
+            del self.frames[self.offsets.pop(index + 1)]
+
+    def first_offset(self):
+        return self.offsets[0] if self.offsets else None
+
+    """
+    This function takes the first queued frame, split if it is longer than max_length.
+
+    Parameters:
+    max_length(int): The maximum number of data bytes to take.
+
+    Returns:
+    QUICStreamFrame: The frame with the lowest stream offset, None if the queue is empty.
+    """
+
+    def take_frame(self, max_length):
+        if not self.offsets or max_length <= 0:
+            return None
+        frame = self.frames.pop(self.offsets.pop(0))
+        if frame.data_length > max_length:
+            # Queue the rest of the frame again
+            rest_data = None if frame.data is None else memoryview(frame.data)[max_length:]
+            rest = QUICStreamFrame("Stream", rest_data, frame.data_length - max_length, frame.offset + max_length)
+            self.offsets.insert(0, rest.offset)
+            self.frames[rest.offset] = rest
+            data = None if frame.data is None else memoryview(frame.data)[:max_length]
+            frame = QUICStreamFrame("Stream", data, max_length, frame.offset)
+        self.queued_bytes -= frame.data_length
+        return frame
+
+    def take(self, max_length):
+        # Take the queued frames from the lowest stream offset, up to max_length data bytes
+        frames = []
+        while self.offsets and max_length > 0:
+            frame = self.take_frame(max_length)
+            frames.append(frame)
+            max_length -= frame.data_length
+        return frames
+
+
+"""
+This class writes the received stream directly to a file of known size.
+The file is preallocated (posix_fallocate where available), and the data of each stream frame is written to
+its offset with os.pwrite, so the data is never reassembled in memory.
+The received byte ranges are tracked as sorted disjoint intervals, to count every byte once and skip the
+writes of retransmitted data that was already written.
+"""
+
+
+class FileStreamSink:
+
+    def __init__(self, path, size):
+        self.size = size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            # Not supported by the platform or the file system, the file is only extended
+            os.ftruncate(self.fd, size)
+        # The received ranges [start, end) of the stream, in increasing order
+        self.starts = []
+        self.ends = []
+        self.received_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    """
+    This function writes the data of a stream frame to its offset in the file.
+
+    Parameters:
+    offset(int): The stream offset of the first byte of the data.
+    data(bytes): The data of the frame.
+
+    Returns:
+    int: The number of bytes that were not received before.
+    """
+
+    def write(self, offset, data):
+        end = offset + len(data)
+        if end > self.size:
+            raise ValueError(f"Error: The stream data ends at {end}, after the end of the file ({self.size}).")
+        new_bytes = self.add_range(offset, end)
+        if new_bytes:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self.fd, data, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                written = os.write(self.fd, data)
+            if written != len(data):
+                raise OSError(f"Error: Only {written} of {len(data)} bytes were written to the file.")
+        return new_bytes
+
+    def add_range(self, start, end):
+        # The intervals that touch or overlap [start, end) are merged with it into one interval
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        already_received = sum(min(self.ends[index], end) - max(self.starts[index], start)
+                               for index in range(first, last))
+        new_bytes = end - start - already_received
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        self.received_bytes += new_bytes
+        return new_bytes
+
+    def is_complete(self):
+        return self.received_bytes >= self.size
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+"""
+This class is a send source that memory-maps a file.
+read() returns memoryview slices of the mapping, so the data is not copied until it is encoded into a packet.
+"""
+
+
+class FileStreamSource:
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # An empty file can't be mapped
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.mapping) if self.mapping is not None else memoryview(b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, offset, length):
+        if offset < 0 or offset + length > self.size:
+            raise ValueError(f"Error: The range {offset}-{offset + length} is outside the source ({self.size}).")
+        return self.view[offset:offset + length]
+
+    def close(self):
+        self.view.release()
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.file.close()
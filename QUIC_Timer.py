@@ -0,0 +1,121 @@
+"""
+This file contains the timer wheel of the QUIC protocol.
+All the timers of a connection (PTO, loss time and ACK delay) run on a single thread instead of
+a threading.Timer thread per packet.
+The wheel is an array of slots, each slot holds the timers that expire in one tick.
+Arming a timer adds it to the slot of its deadline and cancelling removes it, both in O(1).
+The thread sleeps until the next occupied slot, so it doesn't wake up on every tick when the wheel is idle.
+"""
+import math
+import threading
+import time
+
+
+class TimerHandle:
+    __slots__ = ("deadline_tick", "callback", "args", "slot", "cancelled")
+
+    def __init__(self, deadline_tick, callback, args):
+        self.deadline_tick = deadline_tick
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.cancelled = False
+
+
+class TimerWheel:
+    TICK = 0.001  # 1 millisecond in seconds, the timer granularity of the protocol
+    SLOTS = 512
+
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.start_time = time.monotonic()
+        # The next tick that the thread processes
+        self.current_tick = 0
+        self.timer_count = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def now_tick(self):
+        return int((time.monotonic() - self.start_time) / self.tick)
+
+    """
+    This function arms a timer.
+
+    Parameters:
+    delay(float): The delay in seconds until the callback is called.
+    callback(function): The function that is called on the timer thread when the timer expires.
+    args: The arguments of the callback.
+
+    Returns:
+    TimerHandle: The handle of the timer, used to cancel it.
+    """
+
+    def schedule(self, delay, callback, *args):
+        with self.condition:
+            if self.timer_count == 0:
+                # The wheel was idle, continue from the current time
+                self.current_tick = self.now_tick()
+            deadline = time.monotonic() + delay - self.start_time
+            deadline_tick = max(math.ceil(deadline / self.tick), self.current_tick)
+            handle = TimerHandle(deadline_tick, callback, args)
+            handle.slot = self.slots[deadline_tick % len(self.slots)]
+            handle.slot.add(handle)
+            self.timer_count += 1
+            self.condition.notify()
+            return handle
+
+    def cancel(self, handle):
+        with self.condition:
+            # An expired timer whose callback didn't run yet is only marked as cancelled
+            handle.cancelled = True
+            if handle.slot is None:
+                return
+            handle.slot.discard(handle)
+            handle.slot = None
+            self.timer_count -= 1
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def next_occupied_tick(self):
+        # Scan at most one revolution of the wheel for the next slot with timers
+        for offset in range(len(self.slots)):
+            if self.slots[(self.current_tick + offset) % len(self.slots)]:
+                return self.current_tick + offset
+        return self.current_tick + len(self.slots)
+
+    def run(self):
+        while True:
+            expired = []
+            with self.condition:
+                if not self.running:
+                    return
+                if self.timer_count == 0:
+                    self.condition.wait()
+                    continue
+                target_tick = self.now_tick()
+                # Process every tick that passed, at most one revolution (a late timer fires on the first visit)
+                last_tick = min(target_tick, self.current_tick + len(self.slots) - 1)
+                while self.current_tick <= last_tick:
+                    slot = self.slots[self.current_tick % len(self.slots)]
+                    for handle in [handle for handle in slot if handle.deadline_tick <= target_tick]:
+                        slot.discard(handle)
+                        handle.slot = None
+                        self.timer_count -= 1
+                        expired.append(handle)
+                    self.current_tick += 1
+                if target_tick >= self.current_tick:
+                    self.current_tick = target_tick + 1
+                if not expired:
+                    wait_ticks = self.next_occupied_tick() - target_tick
+                    self.condition.wait(max(wait_ticks, 1) * self.tick)
+                    continue
+            # The callbacks run without the wheel lock, so they can arm and cancel timers
+            for handle in expired:
+                if not handle.cancelled:
+                    handle.callback(*handle.args)
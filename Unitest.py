@@ -1,10 +1,24 @@
 import unittest
+import errno
 from QUIC_Client import QUIC_Client
 from QUIC_Server import QUIC_Server
 import threading
 import os
 import time
 from QUIC_API import *
+from QUIC_Congestion import NewRenoCongestionController, Pacer
+from QUIC_Timer import TimerWheel
+from QUIC_Stream import StreamReassemblyBuffer, FileStreamSink, FileStreamSource, \
+    StreamFrameQueue
+from QUIC_History import SentPacketHistory, AckRangeSet
+from QUIC_MTU import PathMTUDiscovery, PacketSizeController
+import QUIC_Sender
+from QUIC_Sender import gso_supported, DatagramSender
+from QUIC_Receiver import DatagramReceiver
+import random
+import tempfile
+import io
+import contextlib
 
 
 class TestQUICProtocol(unittest.TestCase):
@@ -174,5 +188,1052 @@ class TestQUICConnectionClose(unittest.TestCase):
         self.assertTrue(result)
 
 
+class TestQUICCodec(unittest.TestCase):
+
+    def test_packet_round_trip(self):
+        header = QUICHeader("Short", 70000)
+        ack_frame = QUICAckFrame("Ack", 12, 0.002, [AckRange(0, (0, 5)), AckRange(2, (8, 12))])
+        stream_frame = QUICStreamFrame("Stream", os.urandom(1000), 1000, 3 * 65447)
+        packet = QUIC_Codec.decode_packet(QUIC_Codec.encode_packet(QUICPacket(header, [stream_frame, ack_frame])))
+
+        self.assertEqual(packet.get_packet_number(), 70000)
+        self.assertEqual(packet.header.header_form, "Short")
+        self.assertEqual(packet.frames[0].data, stream_frame.data)
+        self.assertEqual(packet.frames[0].offset, 3 * 65447)
+        self.assertEqual(packet.frames[1].largest_acknowledged, 12)
+        self.assertAlmostEqual(packet.frames[1].ack_delay, 0.002)
+        self.assertEqual([ack_range.ack_range for ack_range in packet.frames[1].ack_ranges], [(0, 5), (8, 12)])
+
+    def test_ack_ecn_counts_round_trip(self):
+        ack_ranges = [AckRange(0, (0, 20))]
+        ecn_frame = QUICAckFrame("Ack", 20, 0.001, ack_ranges, (18, 0, 3))
+        packet = QUICPacket(QUICHeader("Short", 4), [ecn_frame])
+        encoded = QUIC_Codec.encode_packet(packet)
+        decoded = QUIC_Codec.decode_packet(encoded).frames[0]
+
+        self.assertEqual(decoded.ecn_counts, (18, 0, 3))
+        self.assertEqual(decoded.largest_acknowledged, 20)
+        self.assertEqual(QUIC_Codec.packet_size(packet), len(encoded))
+        # Without counts the frame keeps the ACK type, and is three varints shorter
+        plain_frame = QUICAckFrame("Ack", 20, 0.001, ack_ranges)
+        plain_encoded = QUIC_Codec.encode_packet(QUICPacket(QUICHeader("Short", 4), [plain_frame]))
+        self.assertIsNone(QUIC_Codec.decode_packet(plain_encoded).frames[0].ecn_counts)
+        self.assertEqual(len(encoded) - len(plain_encoded), 3)
+
+    def test_long_header_text_frame(self):
+        header = QUICLongHeader("Long", "Close", 3)
+        frames = [QUICAckFrame("Ack", 5, 0, 0), QUICStreamFrame("Stream", "Server Close", len("Server Close"))]
+        packet = QUIC_Codec.decode_packet(QUIC_Codec.encode_packet(QUICPacket(header, frames)))
+
+        self.assertEqual(packet.header.long_packet_type, "Close")
+        self.assertEqual(packet.frames[0].ack_ranges, [])
+        self.assertEqual(packet.frames[1].data, "Server Close")
+
+    def test_scatter_gather_parts(self):
+        payload = memoryview(os.urandom(5000))
+        frame = QUICStreamFrame("Stream", payload, len(payload), 70000)
+        packet = QUICPacket(QUICHeader("Short", 9), [frame, QUICAckFrame("Ack", 3, 0, [AckRange(0, (0, 3))])])
+        parts = QUIC_Codec.encode_packet_parts(packet)
+
+        # The header, the frame encodings and the payload are separate buffers, the payload is not copied
+        self.assertEqual(len(parts), 4)
+        self.assertIs(parts[2], payload)
+        self.assertIs(parts[3], packet.frames[1].encoded)
+        self.assertEqual(b"".join(parts), QUIC_Codec.encode_packet(packet))
+        # A retransmission under a new header reuses the cached encoding of the frame
+        prefix = frame.encoded
+        parts = QUIC_Codec.encode_packet_parts(QUICPacket(QUICHeader("Short", 10), [frame]))
+        self.assertIs(QUIC_Codec.encode_frame_prefix(frame), prefix)
+        decoded = QUIC_Codec.decode_packet(b"".join(parts))
+        self.assertEqual((decoded.get_packet_number(), decoded.frames[0].offset), (10, 70000))
+        self.assertEqual(decoded.frames[0].data, payload.tobytes())
+
+    def test_size_accounting(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            offset = rng.choice([0, rng.randrange(1 << 40)])
+            data = os.urandom(rng.randrange(20000))
+            ack_ranges = [AckRange(rng.randrange(1 << 20), (start, start + rng.randrange(100)))
+                          for start in sorted(rng.sample(range(1 << 30), 3))]
+            packet = QUICPacket(QUICHeader("Short", rng.randrange(1 << 32)),
+                                [QUICStreamFrame("Stream", data, len(data), offset),
+                                 QUICAckFrame("Ack", rng.randrange(1 << 32), rng.random(), ack_ranges),
+                                 QUICAckFrequencyFrame("AckFrequency", rng.randrange(100), 2, 0.025)])
+            # The calculated size is the exact size on the wire
+            self.assertEqual(QUIC_Codec.packet_size(packet), len(QUIC_Codec.encode_packet(packet)))
+
+            budget = rng.randrange(1, 70000)
+            capacity = QUIC_Codec.stream_data_capacity(budget, offset)
+            if capacity:
+                self.assertLessEqual(QUIC_Codec.stream_frame_size(offset, capacity), budget)
+            self.assertGreater(QUIC_Codec.stream_frame_size(offset, capacity + 1), budget)
+
+    def test_decode_from_memoryview_is_zero_copy(self):
+        payload = os.urandom(60 * 1024)
+        datagram = bytearray(QUIC_Codec.encode_packet(QUICPacket(QUICHeader("Short", 1),
+                                                                 [QUICStreamFrame("Stream", payload, len(payload))])))
+        frame = QUIC_Codec.decode_packet(memoryview(datagram)).frames[0]
+
+        self.assertIsInstance(frame.data, memoryview)
+        self.assertIs(frame.data.obj, datagram)
+        self.assertEqual(frame.data, payload)
+
+    def test_varint_boundaries(self):
+        for value in [0, 63, 64, 16383, 16384, 2 ** 30 - 1, 2 ** 30, QUIC_Codec.MAX_VARINT]:
+            encoded = QUIC_Codec.encode_varint(value)
+            self.assertEqual(QUIC_Codec.decode_varint(encoded, 0), (value, len(encoded)))
+
+
+class TestNewRenoCongestionController(unittest.TestCase):
+    MAX_DATAGRAM_SIZE = 1200
+
+    def test_slow_start_and_loss(self):
+        controller = NewRenoCongestionController(self.MAX_DATAGRAM_SIZE)
+        initial_window = controller.get_congestion_window()
+        self.assertEqual(initial_window, 10 * self.MAX_DATAGRAM_SIZE)
+
+        send_time = time.time()
+        controller.on_packet_sent(self.MAX_DATAGRAM_SIZE)
+        controller.on_ack(self.MAX_DATAGRAM_SIZE, send_time)
+        self.assertEqual(controller.get_congestion_window(), initial_window + self.MAX_DATAGRAM_SIZE)
+        self.assertEqual(controller.bytes_in_flight, 0)
+
+        window = controller.get_congestion_window()
+        controller.on_packet_sent(self.MAX_DATAGRAM_SIZE)
+        controller.on_packet_sent(self.MAX_DATAGRAM_SIZE)
+        controller.on_loss([(send_time, self.MAX_DATAGRAM_SIZE)], 0.1)
+        self.assertEqual(controller.get_congestion_window(), window // 2)
+        self.assertEqual(controller.bytes_in_flight, self.MAX_DATAGRAM_SIZE)
+
+        # A packet sent before the recovery period started doesn't reduce or grow the window again
+        controller.on_loss([(send_time, self.MAX_DATAGRAM_SIZE)], 0.1)
+        self.assertEqual(controller.get_congestion_window(), window // 2)
+
+    def test_persistent_congestion(self):
+        controller = NewRenoCongestionController(self.MAX_DATAGRAM_SIZE)
+        now = time.time()
+        lost_packets = [(now - 1, self.MAX_DATAGRAM_SIZE), (now, self.MAX_DATAGRAM_SIZE)]
+        controller.on_loss(lost_packets, 0.1)
+        self.assertEqual(controller.get_congestion_window(), 2 * self.MAX_DATAGRAM_SIZE)
+
+    def test_ecn_congestion(self):
+        controller = NewRenoCongestionController(self.MAX_DATAGRAM_SIZE)
+        window = controller.get_congestion_window()
+        controller.on_packet_sent(self.MAX_DATAGRAM_SIZE)
+        controller.on_ecn_congestion(time.time())
+        self.assertEqual(controller.get_congestion_window(), window // 2)
+        # The marked packet was delivered, it is still in flight until its ack is processed
+        self.assertEqual(controller.bytes_in_flight, self.MAX_DATAGRAM_SIZE)
+
+    def test_can_send(self):
+        controller = NewRenoCongestionController(self.MAX_DATAGRAM_SIZE)
+        while controller.can_send(self.MAX_DATAGRAM_SIZE):
+            controller.on_packet_sent(self.MAX_DATAGRAM_SIZE)
+        self.assertEqual(controller.bytes_in_flight, controller.get_congestion_window())
+
+
+class TestPacer(unittest.TestCase):
+    MAX_DATAGRAM_SIZE = 1200
+
+    def test_burst_then_paced(self):
+        pacer = Pacer(self.MAX_DATAGRAM_SIZE)
+        # 1.25 * 12000 bytes per 10 milliseconds = 1.5 MB/s
+        pacer.update_rate(10 * self.MAX_DATAGRAM_SIZE, 0.01)
+        for _ in range(Pacer.BURST_PACKETS):
+            self.assertEqual(pacer.time_until_send(self.MAX_DATAGRAM_SIZE), 0)
+            pacer.on_packet_sent(self.MAX_DATAGRAM_SIZE)
+
+        delay = pacer.time_until_send(self.MAX_DATAGRAM_SIZE)
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, self.MAX_DATAGRAM_SIZE / pacer.pacing_rate)
+
+        time.sleep(delay)
+        self.assertEqual(pacer.time_until_send(self.MAX_DATAGRAM_SIZE), 0)
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel()
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def test_timers_fire_in_order(self):
+        fired = []
+        done = threading.Event()
+        self.wheel.schedule(0.03, fired.append, 3)
+        self.wheel.schedule(0.01, fired.append, 1)
+        # Longer than a revolution of the wheel
+        self.wheel.schedule(0.6, lambda: done.set())
+        self.wheel.schedule(0.02, fired.append, 2)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(fired, [1, 2, 3])
+
+    def test_cancelled_timer_does_not_fire(self):
+        fired = threading.Event()
+        handle = self.wheel.schedule(0.02, fired.set)
+        self.wheel.cancel(handle)
+        self.assertFalse(fired.wait(0.1))
+        self.assertEqual(self.wheel.timer_count, 0)
+
+
+class TestLossDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.quic_connection = QUIC_Protocol(self.socket, ('localhost', 12001))
+
+    def tearDown(self):
+        self.quic_connection.timer_wheel.stop()
+        self.socket.close()
+
+    def test_packet_and_time_threshold(self):
+        now = time.time()
+        # Packet 1 is above the packet threshold but it was sent long ago, so it is lost by the time threshold
+        for packet_number, send_time in enumerate([now - 10, now - 10, now, now]):
+            self.quic_connection.register_sent_packet(packet_number, [], send_time, 1000)
+        self.quic_connection.acknowledge_packet(3)
+        self.quic_connection.largest_acked_packet = 3
+
+        self.assertEqual(self.quic_connection.detect_lost_packets(), [0, 1])
+        # Packet 2 is below the largest acknowledged, it will be lost when the time threshold passes
+        self.assertAlmostEqual(self.quic_connection.loss_time, now + self.quic_connection.calculate_time_threshold())
+
+    def test_pto_backoff(self):
+        self.quic_connection.register_sent_packet(0, [], time.time(), 1000)
+        self.quic_connection.pto_count = 2
+        self.quic_connection.set_loss_detection_timer()
+        handle = self.quic_connection.loss_detection_timer
+        expected_tick = (time.monotonic() - self.quic_connection.timer_wheel.start_time +
+                         4 * self.quic_connection.calculate_pto_period()) / TimerWheel.TICK
+        self.assertAlmostEqual(handle.deadline_tick, expected_tick, delta=2)
+
+
+class TestDelayedAck(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.peer_socket = socket(AF_INET, SOCK_DGRAM)
+        self.peer_socket.bind(('localhost', 0))
+        self.peer_address = self.peer_socket.getsockname()
+        self.quic_connection = QUIC_Protocol(self.socket, self.peer_address)
+
+    def tearDown(self):
+        self.quic_connection.timer_wheel.stop()
+        self.socket.close()
+        self.peer_socket.close()
+
+    def receive(self, packet_number, *frames):
+        frames = list(frames) or [QUICStreamFrame("Stream", b"data", 4)]
+        self.quic_connection.process_packet(QUICPacket(QUICHeader("Short", packet_number), frames), [], 0,
+                                            self.peer_address)
+
+    def received_acks(self):
+        acks = []
+        while True:
+            try:
+                datagram = self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE, MSG_DONTWAIT)
+            except BlockingIOError:
+                return acks
+            acks.append(QUIC_Codec.decode_packet(datagram).frames[0])
+
+    def test_ack_every_second_packet_and_on_gap(self):
+        self.receive(0)
+        self.assertEqual(self.received_acks(), [])
+        self.receive(1)
+        self.assertEqual([ack.largest_acknowledged for ack in self.received_acks()], [1])
+        # Packet 3 leaves a gap, it is acked immediately
+        self.receive(3)
+        self.assertEqual([ack.largest_acknowledged for ack in self.received_acks()], [3])
+
+    def test_ack_delay_timer(self):
+        self.receive(0)
+        self.peer_socket.settimeout(1)
+        ack_frame = QUIC_Codec.decode_packet(self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE)).frames[0]
+        # The ack waited for the max ack delay and reports it
+        self.assertGreaterEqual(ack_frame.ack_delay, QUIC_Protocol.MAX_ACK_DELAY - TimerWheel.TICK)
+
+    def test_ack_frequency_frame(self):
+        self.receive(0, QUICAckFrequencyFrame("AckFrequency", 1, 4, 0.5), QUICStreamFrame("Stream", b"data", 4))
+        # A retransmitted older frame doesn't override the newer one
+        self.receive(1, QUICAckFrequencyFrame("AckFrequency", 0, 1, 0.01), QUICStreamFrame("Stream", b"data", 4))
+        self.receive(2)
+        self.assertEqual(self.received_acks(), [])
+        self.receive(3)
+        self.assertEqual([ack.largest_acknowledged for ack in self.received_acks()], [3])
+
+        frame = QUIC_Codec.decode_packet(QUIC_Codec.encode_packet(
+            QUICPacket(QUICHeader("Short", 4), [QUICAckFrequencyFrame("AckFrequency", 7, 10, 0.05)]))).frames[0]
+        self.assertEqual((frame.sequence_number, frame.ack_eliciting_threshold), (7, 10))
+        self.assertAlmostEqual(frame.request_max_ack_delay, 0.05)
+
+
+class TestStreamReassemblyBuffer(unittest.TestCase):
+
+    def test_reordered_and_duplicated_data(self):
+        data = os.urandom(10000)
+        chunks = [(offset, data[offset:offset + 1000]) for offset in range(0, len(data), 1000)]
+        # Reordered chunks, retransmissions and a retransmission that overlaps two chunks
+        arrivals = chunks[5:] + chunks[:5] + chunks[2:4] + [(1500, data[1500:2500])]
+        random.Random(1).shuffle(arrivals)
+        stream = StreamReassemblyBuffer(len(data))
+        received = bytearray()
+        for offset, chunk in arrivals:
+            self.assertTrue(stream.insert(offset, memoryview(chunk)))
+            for released in stream.read():
+                received += released
+
+        self.assertEqual(bytes(received), data)
+        self.assertEqual(len(stream), 0)
+
+    def test_memory_budget(self):
+        stream = StreamReassemblyBuffer(3000)
+        self.assertTrue(stream.insert(1000, b"x" * 1000))
+        # The data beyond the budget is refused, so the packet is not acked and is retransmitted later
+        self.assertFalse(stream.insert(2500, b"x" * 1000))
+        self.assertEqual(len(stream), 1000)
+        self.assertTrue(stream.insert(0, b"x" * 1000))
+        self.assertEqual(stream.read_offset, 2000)
+        self.assertTrue(stream.insert(2500, b"x" * 1000))
+
+
+class TestFileStreamSink(unittest.TestCase):
+
+    def test_positional_writes(self):
+        data = os.urandom(10000)
+        chunks = [(offset, data[offset:offset + 1000]) for offset in range(0, len(data), 1000)]
+        arrivals = chunks[::-1] + chunks[3:5] + [(1500, data[1500:2500])]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'received_file.bin')
+            with FileStreamSink(path, len(data)) as sink:
+                self.assertEqual(os.path.getsize(path), len(data))
+                # Every byte is counted once, the retransmitted data is not written again
+                self.assertEqual(sum(sink.write(offset, memoryview(chunk)) for offset, chunk in arrivals), len(data))
+                self.assertTrue(sink.is_complete())
+                self.assertEqual((sink.starts, sink.ends), ([0], [len(data)]))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+
+class StreamSendTestCase(unittest.TestCase):
+    # A connection that sends full-size datagrams to a bound peer socket, with a temporary directory for the files
+
+    def create_socket(self):
+        return socket(AF_INET, SOCK_DGRAM)
+
+    def setUp(self):
+        self.peer_socket = socket(AF_INET, SOCK_DGRAM)
+        self.peer_socket.bind(('localhost', 0))
+        # Room for a window of full-size datagrams, and a missing datagram fails the test instead of blocking it
+        self.peer_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 1024 * 1024)
+        self.peer_socket.settimeout(5)
+        self.peer_address = self.peer_socket.getsockname()
+        self.socket = self.create_socket()
+        self.quic_connection = QUIC_Protocol(self.socket, self.peer_address,
+                                             max_datagram_size=QUIC_Protocol.MAX_UDP_SIZE)
+        # No PTO probes during the test
+        self.quic_connection.timer_wheel.stop()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.socket.close()
+        self.peer_socket.close()
+        self.directory.cleanup()
+
+    def create_source(self, data):
+        path = os.path.join(self.directory.name, 'send_source.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return FileStreamSource(path)
+
+    def peer_receive(self):
+        return QUIC_Codec.decode_packet(self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE))
+
+
+class TestFileStreamSource(StreamSendTestCase):
+
+    def test_send_source_keeps_only_offsets_in_flight(self):
+        data = os.urandom(100000)
+        quic_connection = self.quic_connection
+        with self.create_source(data) as source:
+            self.assertEqual(quic_connection.QUIC_send_source(source, self.peer_address), len(data))
+            in_flight_frames = [frames[0] for frames, _, _ in quic_connection.in_flight_packets.values()]
+            self.assertTrue(all(frame.data is None for frame in in_flight_frames))
+            # A lost packet reads its data from the mapping again
+            reloaded = quic_connection.load_frames(in_flight_frames)
+            self.assertEqual(b"".join(bytes(frame.data) for frame in reloaded), data)
+            del reloaded
+            received = [self.peer_receive().frames[0] for _ in in_flight_frames]
+            self.assertEqual([frame.offset for frame in received], [0, received[0].data_length])
+
+
+class TestSendWindow(StreamSendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # The packets the peer received, it acks them only when the connection waits for acks
+        self.peer_packets = []
+        self.peer_packet_numbers = QUICHeader.packet_number_generator()
+        # The bytes in flight every time the connection blocked
+        self.blocked_bytes_in_flight = []
+        process_acks = self.quic_connection.QUIC_process_acks
+
+        def ack_and_process(receiver_address, block=False):
+            if block:
+                self.blocked_bytes_in_flight.append(self.quic_connection.congestion_controller.bytes_in_flight)
+                self.peer_ack()
+            process_acks(receiver_address, block)
+
+        self.quic_connection.QUIC_process_acks = ack_and_process
+
+    def peer_ack(self):
+        # Receive every packet in flight and ack all of them with one ack packet
+        largest = max(self.quic_connection.in_flight_packets)
+        while not self.peer_packets or self.peer_packets[-1].get_packet_number() < largest:
+            self.peer_packets.append(self.peer_receive())
+        ack_frame = QUICAckFrame("Ack", largest, 0, [AckRange(0, (0, largest))])
+        ack_packet = QUICPacket(QUICHeader("Short", next(self.peer_packet_numbers)), [ack_frame])
+        self.peer_socket.sendto(QUIC_Codec.encode_packet(ack_packet), ('localhost', self.socket.getsockname()[1]))
+
+    def test_packets_are_pipelined(self):
+        quic_connection = self.quic_connection
+        # A congestion window of four full datagrams
+        quic_connection.congestion_controller.congestion_window = 4 * QUIC_Protocol.MAX_UDP_SIZE
+        data = os.urandom(5 * 65536)
+        # Four datagrams are in flight before any ack is read
+        quic_connection.QUIC_send_data(data[:4 * 65536], self.peer_address)
+        self.assertEqual(len(quic_connection.in_flight_packets), 4)
+        self.assertEqual(quic_connection.largest_acked_packet, -1)
+        self.assertEqual(self.blocked_bytes_in_flight, [])
+
+        # The next datagram doesn't fit, so the connection blocks only now, with a full window
+        quic_connection.QUIC_send_data(data[4 * 65536:], self.peer_address)
+        self.assertEqual(self.blocked_bytes_in_flight, [4 * QUIC_Protocol.MAX_UDP_SIZE])
+        self.assertEqual(quic_connection.largest_acked_packet, 3)
+        self.assertEqual(len(quic_connection.in_flight_packets), 1)
+
+        # The flush sends the data that doesn't fill a datagram, and waits until every packet is acked
+        self.assertTrue(quic_connection.send_queue)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            quic_connection.QUIC_flush(self.peer_address)
+        # Every blocking wait received an ack, so no timeout is reported
+        self.assertNotIn("The ack packet is not received", output.getvalue())
+        self.assertFalse(quic_connection.send_queue)
+        self.assertEqual(len(quic_connection.in_flight_packets), 0)
+        self.assertEqual(quic_connection.congestion_controller.bytes_in_flight, 0)
+        frames = [frame for packet in self.peer_packets for frame in packet.frames
+                  if frame.get_frame_type() == "Stream"]
+        self.assertEqual(b"".join(bytes(frame.data) for frame in frames), data)
+
+
+class TestECNCongestion(StreamSendTestCase):
+
+    def peer_ack(self, largest, ecn_counts):
+        ack_frame = QUICAckFrame("Ack", largest, 0, [AckRange(0, (0, largest))], ecn_counts)
+        return QUIC_Codec.decode_packet(QUIC_Codec.encode_packet(QUICPacket(QUICHeader("Short", largest),
+                                                                            [ack_frame])))
+
+    def test_ce_increase_reduces_the_window(self):
+        quic_connection = self.quic_connection
+        controller = quic_connection.congestion_controller
+        controller.congestion_window = 8 * QUIC_Protocol.MAX_UDP_SIZE
+        quic_connection.QUIC_send_data(os.urandom(4 * 65536), self.peer_address)
+        self.assertEqual(len(quic_connection.in_flight_packets), 4)
+
+        # Unmarked deliveries grow the window in slow start
+        quic_connection.on_ack_packet(self.peer_ack(0, (1, 0, 0)), self.peer_address)
+        window = controller.get_congestion_window()
+        self.assertGreater(window, 8 * QUIC_Protocol.MAX_UDP_SIZE)
+        # A router marked the second packet: the window is halved, but nothing is lost or retransmitted
+        quic_connection.on_ack_packet(self.peer_ack(1, (1, 0, 1)), self.peer_address)
+        self.assertEqual(controller.get_congestion_window(), window // 2)
+        self.assertEqual(quic_connection.peer_ce_count, 1)
+        self.assertEqual(quic_connection.ecn_congestion_events, 1)
+        self.assertFalse(quic_connection.retransmission_queue)
+        self.assertEqual(sorted(quic_connection.in_flight_packets), [2, 3])
+        # The same CE count in a later ack is not a new congestion event
+        quic_connection.on_ack_packet(self.peer_ack(2, (2, 0, 1)), self.peer_address)
+        self.assertEqual(quic_connection.ecn_congestion_events, 1)
+
+
+class TestPacedRetransmission(StreamSendTestCase):
+
+    def test_paced_probe_is_sent_by_a_timer(self):
+        quic_connection = self.quic_connection
+        quic_connection.QUIC_send_data(os.urandom(QUIC_Protocol.MAX_UDP_SIZE), self.peer_address)
+        self.peer_receive()
+        [packet_number] = list(quic_connection.in_flight_packets)
+        # The pacer is empty and refills a datagram in 0.2 seconds
+        quic_connection.pacer.pacing_rate = QUIC_Protocol.MAX_UDP_SIZE / 0.2
+        quic_connection.pacer.tokens = 0
+        quic_connection.pacer.last_update = time.monotonic()
+
+        start_time = time.monotonic()
+        with quic_connection.lock:
+            quic_connection.QUIC_recovery([packet_number], self.peer_address, is_probe=True)
+        # The recovery doesn't wait for the pacer while it holds the lock, a timer sends the probe
+        self.assertLess(time.monotonic() - start_time, 0.1)
+        self.assertIsNotNone(quic_connection.retransmission_timer)
+        self.assertEqual(len(quic_connection.pending_resends), 1)
+        self.assertEqual(len(quic_connection.in_flight_packets), 0)
+
+        time.sleep(0.2)
+        quic_connection.retransmission_timer_expired(self.peer_address)
+        self.assertFalse(quic_connection.pending_resends)
+        probe = self.peer_receive()
+        self.assertGreater(probe.get_packet_number(), packet_number)
+        self.assertEqual(list(quic_connection.in_flight_packets), [probe.get_packet_number()])
+
+    def test_paced_retransmissions_are_sent_by_a_timer(self):
+        data = os.urandom(100000)
+        quic_connection = self.quic_connection
+        with self.create_source(data) as source:
+            quic_connection.QUIC_send_source(source, self.peer_address)
+            for _ in range(2):
+                self.peer_receive()
+            with quic_connection.lock:
+                quic_connection.QUIC_recovery(list(quic_connection.in_flight_packets), self.peer_address)
+            quic_connection.pacer.pacing_rate = QUIC_Protocol.MAX_UDP_SIZE / 0.2
+            quic_connection.pacer.tokens = 0
+            quic_connection.pacer.last_update = time.monotonic()
+
+            start_time = time.monotonic()
+            quic_connection.send_retransmissions(self.peer_address)
+            self.assertLess(time.monotonic() - start_time, 0.1)
+            self.assertIsNotNone(quic_connection.retransmission_timer)
+            self.assertEqual(len(quic_connection.retransmission_queue), len(data))
+
+            time.sleep(0.2)
+            quic_connection.retransmission_timer_expired(self.peer_address)
+            # The first repacked packet is sent, the pacer waits again for the second one
+            self.assertEqual(self.peer_receive().frames[0].offset, 0)
+            self.assertTrue(quic_connection.retransmission_queue)
+            self.assertIsNotNone(quic_connection.retransmission_timer)
+
+
+class RecordingSocket(socket):
+    # A UDP socket that records the buffers of every sendmsg call
+
+    def __init__(self):
+        super().__init__(AF_INET, SOCK_DGRAM)
+        self.sent_buffers = []
+
+    def sendmsg(self, buffers, *args):
+        buffers = list(buffers)
+        self.sent_buffers.append(buffers)
+        return super().sendmsg(buffers, *args)
+
+
+class TestScatterGatherSend(StreamSendTestCase):
+
+    def create_socket(self):
+        return RecordingSocket()
+
+    def test_payload_is_sent_from_the_mapping(self):
+        # Two packets, the initial congestion window holds them, so the peer doesn't have to ack
+        data = os.urandom(100000)
+        with self.create_source(data) as source:
+            self.quic_connection.QUIC_send_source(source, self.peer_address)
+            payloads = [part for buffers in self.socket.sent_buffers for part in buffers if len(part) > 100]
+            # Every payload is a slice of the file mapping, it was never copied in user space
+            self.assertEqual(sum(len(payload) for payload in payloads), len(data))
+            self.assertTrue(all(isinstance(payload, memoryview) and payload.obj is source.mapping
+                                for payload in payloads))
+            del payloads
+            self.socket.sent_buffers.clear()
+        # An ack-only packet is sent as its encoded header and its ack frame
+        self.quic_connection.send_ack(self.peer_address)
+        self.assertEqual(len(self.socket.sent_buffers[-1]), 2)
+        # Every datagram reached the peer
+        for _ in range(3):
+            self.peer_receive()
+
+
+class TestStreamFrameQueue(StreamSendTestCase):
+
+    def test_merge_and_split(self):
+        queue = StreamFrameQueue()
+        for offset in [3000, 0, 1000, 2000]:
+            queue.add(QUICStreamFrame("Stream", None, 1000, offset))
+        queue.add(QUICStreamFrame("Stream", b"x" * 500, 500, 5000))
+        # The adjacent ranges read from the send source are merged into one frame
+        self.assertEqual(queue.offsets, [0, 5000])
+        self.assertEqual(len(queue), 4500)
+
+        frames = queue.take(4200)
+        self.assertEqual([(frame.offset, frame.data_length) for frame in frames], [(0, 4000), (5000, 200)])
+        self.assertEqual(bytes(frames[1].data), b"x" * 200)
+        self.assertEqual(queue.offsets, [5200])
+        self.assertEqual(len(queue), 300)
+
+    def test_writes_are_packed_into_full_datagrams(self):
+        data = os.urandom(100005)
+        quic_connection = self.quic_connection
+        for start in range(0, len(data), 20001):
+            self.assertEqual(quic_connection.QUIC_send_data(data[start:start + 20001], self.peer_address), 20001)
+        # The rest doesn't fill a datagram, it waits for the next write or the flush
+        self.assertEqual(len(quic_connection.in_flight_packets), 1)
+        quic_connection.send_packet(self.peer_address)
+
+        datagrams = [self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE) for _ in range(2)]
+        self.assertEqual(len(datagrams[0]), QUIC_Protocol.MAX_UDP_SIZE)
+        frames = [frame for datagram in datagrams for frame in QUIC_Codec.decode_packet(datagram).frames
+                  if frame.get_frame_type() == "Stream"]
+        self.assertEqual(b"".join(bytes(frame.data) for frame in frames), data)
+
+    def test_lost_packets_are_repacked(self):
+        data = os.urandom(100000)
+        quic_connection = self.quic_connection
+        with self.create_source(data) as source:
+            quic_connection.QUIC_send_source(source, self.peer_address)
+            # Both packets are lost, their data is queued instead of being resent
+            with quic_connection.lock:
+                quic_connection.QUIC_recovery(list(quic_connection.in_flight_packets), self.peer_address)
+            self.assertEqual(len(quic_connection.in_flight_packets), 0)
+            self.assertEqual(len(quic_connection.retransmission_queue), len(data))
+
+            quic_connection.send_packet(self.peer_address)
+            quic_connection.send_packet(self.peer_address)
+            self.assertFalse(quic_connection.retransmission_queue)
+            for _ in range(2):
+                self.peer_receive()
+            datagrams = [self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE) for _ in range(2)]
+            # The lost ranges were merged, so the first packet is full
+            self.assertEqual(len(datagrams[0]), QUIC_Protocol.MAX_UDP_SIZE)
+            frames = [QUIC_Codec.decode_packet(datagram).frames[0] for datagram in datagrams]
+            self.assertEqual([(frame.offset, frame.data_length) for frame in frames],
+                             [(0, frames[0].data_length), (frames[0].data_length,
+                                                           len(data) - frames[0].data_length)])
+            self.assertEqual(b"".join(bytes(frame.data) for frame in frames), data)
+
+
+class TestPathMTUDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.peer_socket = socket(AF_INET, SOCK_DGRAM)
+        self.peer_socket.bind(('localhost', 0))
+        self.peer_address = self.peer_socket.getsockname()
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+
+    def tearDown(self):
+        self.socket.close()
+        self.peer_socket.close()
+
+    def create_connection(self, **kwargs):
+        quic_connection = QUIC_Protocol(self.socket, self.peer_address, **kwargs)
+        quic_connection.timer_wheel.stop()
+        return quic_connection
+
+    def test_search_converges_to_path_mtu(self):
+        # A path with an interface MTU of 9000 bytes and a smaller MTU of 1500 bytes further on the path
+        path_mtu = PathMTUDiscovery(QUIC_Protocol.MAX_UDP_SIZE)
+        self.assertEqual(path_mtu.plpmtu, 1200)
+        while True:
+            probe_size = path_mtu.next_probe_size()
+            if probe_size is None:
+                break
+            if probe_size > 9000:
+                path_mtu.on_probe_too_big(probe_size)
+            elif probe_size > 1500:
+                for _ in range(PathMTUDiscovery.MAX_PROBES):
+                    path_mtu.on_probe_lost(probe_size)
+            else:
+                path_mtu.on_probe_acked(probe_size)
+        self.assertLessEqual(path_mtu.plpmtu, 1500)
+        self.assertGreater(path_mtu.plpmtu, 1500 - PathMTUDiscovery.SEARCH_GRANULARITY)
+
+    def test_probe_raises_datagram_size(self):
+        peer_socket = self.peer_socket
+        peer_address = self.peer_address
+        quic_connection = self.create_connection()
+        self.assertEqual(quic_connection.max_datagram_size, 1200)
+        # The windows are counted in datagrams of the starting size (RFC 9002, section 7.2)
+        self.assertEqual(quic_connection.congestion_controller.get_congestion_window(), 10 * 1200)
+        self.assertEqual(quic_connection.congestion_controller.kMinimumWindow, 2 * 1200)
+        self.assertEqual(quic_connection.pacer.capacity, Pacer.BURST_PACKETS * 1200)
+        quic_connection.QUIC_send_data(os.urandom(1500), peer_address)
+
+        # The first probe tries the largest datagram, it is not in flight
+        datagram = peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE)
+        self.assertEqual(len(datagram), QUIC_Protocol.MAX_UDP_SIZE)
+        probe_packet = QUIC_Codec.decode_packet(datagram)
+        data_packet = QUIC_Codec.decode_packet(peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE))
+        self.assertEqual(QUIC_Codec.packet_size(data_packet), 1200)
+        self.assertEqual([frame.get_frame_type() for frame in probe_packet.frames], ["Ping", "Padding"])
+        self.assertNotIn(probe_packet.get_packet_number(), quic_connection.in_flight_packets)
+
+        ack_frame = QUICAckFrame("Ack", probe_packet.get_packet_number(), 0,
+                                 [AckRange(0, (0, probe_packet.get_packet_number()))])
+        quic_connection.on_ack_packet(QUICPacket(QUICHeader("Short", 0), [ack_frame]), peer_address)
+        self.assertEqual(quic_connection.max_datagram_size, QUIC_Protocol.MAX_UDP_SIZE)
+        self.assertIsNone(quic_connection.path_mtu.next_probe_size())
+        self.assertEqual(quic_connection.congestion_controller.kMinimumWindow, 2 * QUIC_Protocol.MAX_UDP_SIZE)
+        self.assertGreaterEqual(quic_connection.congestion_controller.get_congestion_window(),
+                                2 * QUIC_Protocol.MAX_UDP_SIZE)
+        self.assertEqual(quic_connection.pacer.capacity, Pacer.BURST_PACKETS * QUIC_Protocol.MAX_UDP_SIZE)
+
+    def test_explicit_datagram_size(self):
+        quic_connection = self.create_connection(max_datagram_size=9000)
+        self.assertEqual(quic_connection.max_datagram_size, 9000)
+        self.assertIsNone(quic_connection.path_mtu)
+        with self.assertRaises(ValueError):
+            self.create_connection(max_datagram_size=100000)
+
+    def test_packet_size_follows_loss_rate(self):
+        sizer = PacketSizeController()
+        self.assertEqual(sizer.datagram_size(65507, 10 ** 7), 65507)
+        # A small congestion window keeps room for several packets per window
+        self.assertEqual(sizer.datagram_size(65507, 40000), 9984)
+        for index in range(320):
+            if index % 10 == 0:
+                sizer.on_packet_lost(65507)
+            else:
+                sizer.on_packet_acked(65507)
+        lossy_size = sizer.datagram_size(65507, 10 ** 7)
+        self.assertLess(lossy_size, 65507 // 2)
+        self.assertGreaterEqual(lossy_size, PathMTUDiscovery.BASE_PLPMTU)
+        # Without loss the size grows back to the path MTU
+        for _ in range(40 * PacketSizeController.SAMPLE_PACKETS):
+            sizer.on_packet_acked(lossy_size)
+        self.assertEqual(sizer.datagram_size(65507, 10 ** 7), 65507)
+
+    def test_losses_shrink_datagrams(self):
+        quic_connection = self.create_connection()
+        quic_connection.max_datagram_size = QUIC_Protocol.MAX_UDP_SIZE
+        quic_connection.congestion_controller.congestion_window = 10 ** 7
+        quic_connection.update_datagram_size()
+        self.assertEqual(quic_connection.datagram_size, QUIC_Protocol.MAX_UDP_SIZE)
+        with quic_connection.lock:
+            for packet_number in range(PacketSizeController.SAMPLE_PACKETS):
+                quic_connection.register_sent_packet(packet_number, [], time.time(), QUIC_Protocol.MAX_UDP_SIZE)
+            quic_connection.QUIC_recovery(list(range(8)), self.peer_address)
+            for packet_number in range(8, PacketSizeController.SAMPLE_PACKETS):
+                quic_connection.acknowledge_packet(packet_number)
+            quic_connection.update_datagram_size()
+        stats = quic_connection.QUIC_get_stats()
+        self.assertEqual(stats["lost_packets"], 8)
+        self.assertGreater(stats["loss_rate"], 0)
+        self.assertLess(stats["datagram_size"], QUIC_Protocol.MAX_UDP_SIZE)
+
+    def test_legacy_pickle_sends_sliced_data(self):
+        quic_connection = self.create_connection(legacy_pickle=True)
+        data = os.urandom(100000)
+        quic_connection.QUIC_send_data(data, self.peer_address)
+        packet = pickle.loads(self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE))
+        self.assertEqual(packet.frames[0].data, data[:packet.frames[0].data_length])
+
+
+class TestDatagramSender(unittest.TestCase):
+
+    def setUp(self):
+        self.peer_socket = socket(AF_INET, SOCK_DGRAM)
+        self.peer_socket.bind(('localhost', 0))
+        self.peer_address = self.peer_socket.getsockname()
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+
+    def tearDown(self):
+        self.socket.close()
+        self.peer_socket.close()
+
+    def send_run(self, use_gso):
+        data = os.urandom(30000)
+        quic_connection = QUIC_Protocol(self.socket, self.peer_address, max_datagram_size=1200, use_gso=use_gso)
+        quic_connection.timer_wheel.stop()
+        # The congestion window and the pacer hold all the packets, so they leave as one run
+        quic_connection.congestion_controller.congestion_window = 32 * 1200
+        quic_connection.pacer.capacity = quic_connection.pacer.tokens = 32 * 1200
+        quic_connection.QUIC_send_data(data, self.peer_address)
+        quic_connection.send_packet(self.peer_address)
+
+        frames = []
+        for _ in range(quic_connection.datagram_sender.datagrams_sent):
+            datagram = self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE)
+            # The kernel cut the run into the datagrams of the packets
+            self.assertLessEqual(len(datagram), 1200)
+            frames += [frame for frame in QUIC_Codec.decode_packet(datagram).frames
+                       if frame.get_frame_type() == "Stream"]
+        self.assertEqual(b"".join(bytes(frame.data) for frame in sorted(frames, key=lambda frame: frame.offset)),
+                         data)
+        return quic_connection.QUIC_get_stats()
+
+    def test_gso_sends_a_run_with_one_syscall(self):
+        if not gso_supported(self.socket):
+            self.skipTest("UDP GSO is not supported by the kernel")
+        stats = self.send_run(True)
+        self.assertTrue(stats["gso"])
+        self.assertEqual(stats["send_syscalls"], 2)
+        self.assertEqual(stats["datagrams_sent"], 26)
+
+    def test_fallback_sends_every_datagram(self):
+        stats = self.send_run(False)
+        self.assertFalse(stats["gso"])
+        self.assertEqual(stats["send_syscalls"], stats["datagrams_sent"])
+
+
+class RefusingSocket(socket):
+    # A UDP socket whose zerocopy sends fail with an errno, like the kernel refusing them
+
+    def __init__(self, error_number):
+        super().__init__(AF_INET, SOCK_DGRAM)
+        self.error_number = error_number
+
+    def sendmsg(self, buffers, ancillary_data, flags, address):
+        if flags & QUIC_Sender.MSG_ZEROCOPY:
+            raise OSError(self.error_number, os.strerror(self.error_number))
+        return super().sendmsg(buffers, ancillary_data, flags, address)
+
+
+class TestZerocopySend(unittest.TestCase):
+
+    def setUp(self):
+        self.peer_socket = socket(AF_INET, SOCK_DGRAM)
+        self.peer_socket.bind(('localhost', 0))
+        self.peer_socket.settimeout(5)
+        self.peer_address = self.peer_socket.getsockname()
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.sender = DatagramSender(self.socket, use_gso=False, use_zerocopy=True, zerocopy_min_bytes=1000)
+        if not self.sender.zerocopy_enabled:
+            self.skipTest("MSG_ZEROCOPY is not supported by the kernel")
+
+    def tearDown(self):
+        self.socket.close()
+        self.peer_socket.close()
+
+    def test_buffers_are_pinned_until_the_completion(self):
+        parts = [b"header", memoryview(bytearray(os.urandom(30000)))]
+        self.sender.send(parts, self.peer_address)
+        # The send is numbered 0, its buffers are kept until the kernel notifies that it is done with them
+        self.assertIs(self.sender.pinned_buffers[0], parts)
+        # A send below the threshold is copied, nothing is kept
+        self.sender.send([b"small"], self.peer_address)
+        self.assertEqual((self.sender.zerocopy_sends, len(self.sender.pinned_buffers)), (1, 1))
+
+        self.sender.wait_for_completions()
+        self.assertEqual(self.sender.pinned_buffers, {})
+        # On loopback the kernel reports that it copied the data
+        self.assertEqual(self.sender.zerocopy_copied, 1)
+        self.assertEqual(self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE), b"header" + bytes(parts[1]))
+
+    def test_unaligned_buffers_fall_back_to_a_copy(self):
+        # The pinned pages of unaligned buffers don't fit the fragments of one datagram (EMSGSIZE),
+        # which must not be taken as a path MTU limit
+        data = os.urandom(QUIC_Protocol.MAX_UDP_SIZE - 3)
+        self.assertEqual(self.sender.send([b"ab", b"c", data], self.peer_address), QUIC_Protocol.MAX_UDP_SIZE)
+        self.assertEqual(self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE), b"abc" + data)
+
+    def test_refused_sends_are_copied(self):
+        for error_number in [errno.ENOBUFS, errno.EMSGSIZE]:
+            refusing_socket = RefusingSocket(error_number)
+            sender = DatagramSender(refusing_socket, use_gso=False, use_zerocopy=True, zerocopy_min_bytes=1000)
+            data = os.urandom(5000)
+            self.assertEqual(sender.send([data], self.peer_address), len(data))
+            self.assertEqual((sender.zerocopy_sends, sender.pinned_buffers), (0, {}))
+            self.assertEqual(self.peer_socket.recv(QUIC_Protocol.MAX_UDP_SIZE), data)
+            refusing_socket.close()
+        # Any other error reaches the caller
+        refusing_socket = RefusingSocket(errno.EBADF)
+        sender = DatagramSender(refusing_socket, use_gso=False, use_zerocopy=True, zerocopy_min_bytes=1000)
+        with self.assertRaises(OSError):
+            sender.send([os.urandom(5000)], self.peer_address)
+        refusing_socket.close()
+
+    def test_flush_releases_the_send_source(self):
+        quic_connection = QUIC_Protocol(self.socket, self.peer_address, max_datagram_size=QUIC_Protocol.MAX_UDP_SIZE,
+                                        use_zerocopy=True)
+        quic_connection.timer_wheel.stop()
+        data = os.urandom(50000)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'send_source.bin')
+            with open(path, 'wb') as f:
+                f.write(data)
+            with FileStreamSource(path) as source:
+                quic_connection.QUIC_send_source(source, self.peer_address)
+                # The slice of the mapping was sent without a copy
+                self.assertEqual(quic_connection.QUIC_get_stats()["zerocopy_sends"], 1)
+                # The peer acks the packet, the flush waits for the completion so the mapping can be closed
+                packet_number = max(quic_connection.in_flight_packets)
+                ack_frame = QUICAckFrame("Ack", packet_number, 0, [AckRange(0, (0, packet_number))])
+                self.peer_socket.sendto(QUIC_Codec.encode_packet(QUICPacket(QUICHeader("Short", 0), [ack_frame])),
+                                        ('localhost', self.socket.getsockname()[1]))
+                quic_connection.QUIC_flush(self.peer_address)
+                self.assertEqual(quic_connection.datagram_sender.pinned_buffers, {})
+
+
+class TestDatagramReceiver(unittest.TestCase):
+
+    def setUp(self):
+        self.receive_socket = socket(AF_INET, SOCK_DGRAM)
+        self.receive_socket.bind(('localhost', 0))
+        self.send_socket = socket(AF_INET, SOCK_DGRAM)
+
+    def tearDown(self):
+        self.receive_socket.close()
+        self.send_socket.close()
+
+    def test_gro_splits_coalesced_datagrams(self):
+        receiver = DatagramReceiver(self.receive_socket)
+        sender = DatagramSender(self.send_socket)
+        if not receiver.gro_enabled or not sender.gso_enabled:
+            self.skipTest("UDP GSO and GRO are not supported by the kernel")
+        datagrams = [[bytes([index]) * 1000] for index in range(10)] + [[b"last"]]
+        sender.send_batch(datagrams, 1000, self.receive_socket.getsockname())
+        received = receiver.receive_burst(64)
+        self.assertEqual([bytes(datagram) for datagram, _ in received], [parts[0] for parts in datagrams])
+        self.assertLess(receiver.syscalls, len(datagrams))
+
+    def test_burst_drains_queued_datagrams(self):
+        receiver = DatagramReceiver(self.receive_socket, use_gro=False)
+        for index in range(5):
+            self.send_socket.sendto(bytes([index]) * (index + 1), self.receive_socket.getsockname())
+        time.sleep(0.05)
+        received = receiver.receive_burst(64)
+        # Every datagram of the batch stays valid, each one has its own place in the arena
+        self.assertEqual([bytes(datagram) for datagram, _ in received],
+                         [bytes([index]) * (index + 1) for index in range(5)])
+        self.assertEqual(receiver.datagrams_received, 5)
+
+    def test_ecn_codepoints_are_counted_and_acked(self):
+        quic_connection = QUIC_Protocol(self.receive_socket, self.send_socket.getsockname())
+        quic_connection.timer_wheel.stop()
+        if not quic_connection.datagram_receiver.ecn_enabled:
+            self.skipTest("The TOS byte of the received datagrams can't be read")
+        self.send_socket.bind(('localhost', 0))
+        # Two datagrams marked ECT(0) by the peer, then one a router marked CE
+        for packet_number, codepoint in enumerate([QUIC_Sender.ECN_ECT0, QUIC_Sender.ECN_ECT0, QUIC_Sender.ECN_CE]):
+            self.assertTrue(QUIC_Sender.set_ecn_marking(self.send_socket, codepoint))
+            packet = QUICPacket(QUICHeader("Short", packet_number),
+                                [QUICStreamFrame("Stream", b"data", 4, packet_number * 4)])
+            self.send_socket.sendto(QUIC_Codec.encode_packet(packet), self.receive_socket.getsockname())
+        time.sleep(0.05)
+        self.assertEqual(quic_connection.QUIC_receive_data([], 0, self.send_socket.getsockname()), 12)
+        self.assertEqual(quic_connection.datagram_receiver.ecn_counts, [2, 0, 1])
+        ack_packet = QUIC_Codec.decode_packet(self.send_socket.recv(QUIC_Protocol.MAX_UDP_SIZE))
+        self.assertEqual(ack_packet.frames[0].ecn_counts, (2, 0, 1))
+
+    def test_one_ack_per_batch(self):
+        quic_connection = QUIC_Protocol(self.receive_socket, self.send_socket.getsockname())
+        self.send_socket.bind(('localhost', 0))
+        for packet_number in range(10):
+            packet = QUICPacket(QUICHeader("Short", packet_number),
+                                [QUICStreamFrame("Stream", b"data", 4, packet_number * 4)])
+            self.send_socket.sendto(QUIC_Codec.encode_packet(packet), self.receive_socket.getsockname())
+        time.sleep(0.05)
+        data_buffer = []
+        self.assertEqual(quic_connection.QUIC_receive_data(data_buffer, 0, self.send_socket.getsockname()), 40)
+        self.assertEqual(b"".join(bytes(data) for data in data_buffer), b"data" * 10)
+        ack_packet = QUIC_Codec.decode_packet(self.send_socket.recv(QUIC_Protocol.MAX_UDP_SIZE))
+        self.assertEqual(ack_packet.frames[0].largest_acknowledged, 9)
+        self.send_socket.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            self.send_socket.recv(QUIC_Protocol.MAX_UDP_SIZE)
+        quic_connection.timer_wheel.stop()
+
+
+    def test_acked_ack_frames_prune_the_ack_ranges(self):
+        quic_connection = QUIC_Protocol(self.receive_socket, self.send_socket.getsockname())
+        quic_connection.timer_wheel.stop()
+        self.send_socket.bind(('localhost', 0))
+        peer_address = self.send_socket.getsockname()
+        # Packets 3 and 4 are missing, the gap is acked right away
+        for packet_number in [0, 1, 2, 5, 6]:
+            packet = QUICPacket(QUICHeader("Short", packet_number),
+                                [QUICStreamFrame("Stream", b"data", 4, packet_number * 4)])
+            self.send_socket.sendto(QUIC_Codec.encode_packet(packet), self.receive_socket.getsockname())
+        time.sleep(0.05)
+        quic_connection.QUIC_receive_data([], 0, peer_address)
+        self.assertEqual(list(quic_connection.ack_ranges), [(0, 2), (5, 6)])
+        ack_packet = QUIC_Codec.decode_packet(self.send_socket.recv(QUIC_Protocol.MAX_UDP_SIZE))
+        self.assertEqual([ack_range.ack_range for ack_range in ack_packet.frames[0].ack_ranges], [(0, 2), (5, 6)])
+
+        # The peer acknowledges the packet that carried the ack frame, along with new data
+        ack_number = ack_packet.get_packet_number()
+        packet = QUICPacket(QUICHeader("Short", 7),
+                            [QUICAckFrame("Ack", ack_number, 0, [AckRange(0, (0, ack_number))]),
+                             QUICStreamFrame("Stream", b"data", 4, 7 * 4)])
+        self.send_socket.sendto(QUIC_Codec.encode_packet(packet), self.receive_socket.getsockname())
+        time.sleep(0.05)
+        quic_connection.QUIC_receive_data([], 0, peer_address)
+        # The peer knows about the packets up to 6, they are not reported again
+        self.assertEqual(list(quic_connection.ack_ranges), [(7, 7)])
+        self.assertEqual(len(quic_connection.sent_ack_frames), 0)
+        quic_connection.send_ack(peer_address)
+        ack_frame = QUIC_Codec.decode_packet(self.send_socket.recv(QUIC_Protocol.MAX_UDP_SIZE)).frames[0]
+        self.assertEqual(ack_frame.largest_acknowledged, 7)
+        self.assertEqual([ack_range.ack_range for ack_range in ack_frame.ack_ranges], [(7, 7)])
+
+
+class TestSentPacketHistory(unittest.TestCase):
+
+    def test_ordered_history(self):
+        history = SentPacketHistory()
+        for packet_number in range(0, 1000, 2):
+            history.add(packet_number, packet_number)
+        for packet_number in range(0, 900, 4):
+            history.pop(packet_number)
+
+        self.assertEqual(len(history), 275)
+        self.assertEqual(history.oldest(3), [2, 6, 10])
+        self.assertEqual(history.in_range(895, 905), [898, 900, 902, 904])
+        self.assertEqual(list(history), sorted(history.packets))
+        # Compaction keeps the order
+        self.assertLess(len(history.packet_numbers) - history.head, 2 * len(history) + SentPacketHistory.COMPACT_THRESHOLD)
+
+    def test_out_of_order_add(self):
+        history = SentPacketHistory()
+        history.add(5, "five")
+        history.add(3, "three")
+        self.assertEqual(list(history.items()), [(3, "three"), (5, "five")])
+
+
+class TestAckRangeSet(unittest.TestCase):
+
+    @staticmethod
+    def brute_force_ranges(received):
+        # Build the intervals and their gaps from the sorted packet numbers
+        ranges = []
+        for packet_number in sorted(received):
+            if ranges and ranges[-1][1] == packet_number - 1:
+                ranges[-1][1] = packet_number
+            else:
+                ranges.append([packet_number, packet_number])
+        return [(0 if index == 0 else start - ranges[index - 1][1] - 2, (start, end))
+                for index, (start, end) in enumerate(ranges)]
+
+    def test_random_reordering(self):
+        rng = random.Random(9002)
+        for _ in range(50):
+            # Packets are reordered within a window, some are lost and some are duplicated
+            packet_numbers = [packet_number for packet_number in range(300) if rng.random() > 0.1]
+            packet_numbers += rng.sample(packet_numbers, 20)
+            arrival = sorted(packet_numbers, key=lambda packet_number: packet_number + rng.uniform(0, 20))
+
+            ack_range_set = AckRangeSet()
+            received = set()
+            for packet_number in arrival:
+                self.assertEqual(ack_range_set.add(packet_number), packet_number not in received)
+                received.add(packet_number)
+                ack_ranges = [(ack_range.gap, ack_range.ack_range) for ack_range in ack_range_set.to_ack_ranges()]
+                self.assertEqual(ack_ranges, self.brute_force_ranges(received))
+            self.assertEqual(ack_range_set.largest(), max(received))
+            self.assertTrue(all(packet_number in ack_range_set for packet_number in received))
+
+    def test_prune_and_max_ranges(self):
+        ack_range_set = AckRangeSet(max_ranges=3)
+        for packet_number in [0, 1, 2, 4, 5, 7, 9]:
+            ack_range_set.add(packet_number)
+        # The oldest interval is dropped when there are more than 3 intervals
+        self.assertEqual(list(ack_range_set), [(4, 5), (7, 7), (9, 9)])
+        self.assertFalse(ack_range_set.add(1))
+
+        ack_range_set.prune(4)
+        self.assertEqual(list(ack_range_set), [(5, 5), (7, 7), (9, 9)])
+        self.assertEqual(ack_range_set.to_ack_ranges()[0].gap, 0)
+        ack_range_set.prune(9)
+        self.assertEqual(len(ack_range_set), 0)
+        self.assertTrue(ack_range_set.add(10))
+
+
 if __name__ == '__main__':
     unittest.main()